@@ -0,0 +1,84 @@
+"""Compare the columnar popularity scorers with the former row-wise `apply`
+
+Usage:
+    python -m benchmarks.popularity_scores [--sizes 10000 100000 1000000]
+
+Each catalog is a synthetic popularity dataframe (float32 `rating`, long-tailed uint32 `rating_count`), as returned by `request_for_popularity`.
+"""
+from time import perf_counter
+
+from src.content.popularity import scorers
+
+import pandas as pd
+import numpy as np
+import argparse
+
+
+def synthetic_ratings(n_items, seed=0):
+    """Build a popularity dataframe
+
+    Args:
+        n_items (int): number of content
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        DataFrame: content_id, rating and rating_count of each content
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "content_id": np.arange(n_items, dtype=np.uint32),
+        "rating": rng.uniform(.5, 5, size=n_items).round(2).astype(np.float32),
+        "rating_count": rng.zipf(1.5, size=n_items).clip(max=10**7).astype(np.uint32),
+    })
+
+
+def legacy_imdb(df):
+    """Former `Content.calc_popularity_score`"""
+    def weighted_rating(x, m, C):
+        v = x['rating_count']
+        R = x['rating']
+        return float(format((v/(v+m) * R) + (m/(m+v) * C), ".4f"))
+
+    c = df["rating"].mean()
+    m = df["rating_count"].quantile(0.90)
+    q_df = df.copy().loc[df['rating_count'] >= m]
+    q_df['popularity_score'] = q_df.apply(
+        lambda x: weighted_rating(x, m, c), axis=1, result_type="reduce")
+    return q_df
+
+
+def legacy_rating_count(df):
+    """Former `Track.calc_popularity_score` and `Application.calc_popularity_score`"""
+    m = df["rating_count"].quantile(0.90)
+    q_df = df.copy().loc[df['rating_count'] >= m]
+    q_df['popularity_score'] = q_df.apply(
+        lambda x: float(format(x["rating_count"] + x["rating"], ".4f")), axis=1, result_type="reduce")
+    return q_df
+
+
+def measure(func, df):
+    st_time = perf_counter()
+    result = func(df)
+    return perf_counter() - st_time, result["popularity_score"].to_numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print("%10s %14s %10s %10s %9s %10s" % (
+        "items", "scorer", "legacy", "columnar", "speedup", "same"))
+    for size in args.sizes:
+        df = synthetic_ratings(size)
+        for name, legacy in [("imdb", legacy_imdb), ("rating_count", legacy_rating_count)]:
+            legacy_time, expected = measure(legacy, df)
+            columnar_time, scores = measure(scorers[name], df)
+
+            print("%10d %14s %9.3fs %9.3fs %8.1fx %10s" % (
+                size, name, legacy_time, columnar_time, legacy_time / columnar_time, np.array_equal(expected, scores)))
+
+
+if __name__ == "__main__":
+    main()
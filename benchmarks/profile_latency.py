@@ -0,0 +1,79 @@
+"""Load test of the profile recommendation route (`PUT /recommend/profile/<uuid>/<event_id>`)
+
+Usage:
+    python -m benchmarks.profile_latency --profile <uuid> --events 1 2 3 [--url http://localhost:4041] [--requests 500] [--concurrency 8]
+
+Requests are sent by `concurrency` clients to a running service (with a warm profile serving, see `ProfileServing`),
+events are used in turn. Latency percentiles are printed, the exit status is 1 if the p99 is over the target.
+"""
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import numpy as np
+import argparse
+import os
+
+
+def send(url, token):
+    """Send a request
+
+    Returns:
+        tuple: (latency in seconds, HTTP status)
+    """
+    request = Request(url, method="PUT", headers={"X-API-TOKEN": token})
+    st_time = perf_counter()
+    try:
+        with urlopen(request) as response:
+            response.read()
+            status = response.status
+    except HTTPError as e:
+        status = e.code
+    return perf_counter() - st_time, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", default="http://localhost:%s" %
+                        os.environ.get("SERVICE_PORT", 4041))
+    parser.add_argument(
+        "--token", default=os.environ.get("API_TOKEN", "FOOBAR1"))
+    parser.add_argument("--profile", required=True, help="Profile uuid.")
+    parser.add_argument("--events", type=int, nargs="+",
+                        required=True, help="Recommendation event ids of the profile.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=20,
+                        help="Requests sent before measuring.")
+    parser.add_argument("--target", type=float, default=100,
+                        help="p99 target (ms).")
+    args = parser.parse_args()
+
+    urls = ["%s/recommend/profile/%s/%s" % (args.url.rstrip("/"), args.profile, args.events[i % len(args.events)])
+            for i in range(args.warmup + args.requests)]
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(lambda url: send(url, args.token), urls[:args.warmup]))
+
+        st_time = perf_counter()
+        results = list(executor.map(
+            lambda url: send(url, args.token), urls[args.warmup:]))
+        duration = perf_counter() - st_time
+
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    errors = sum(1 for _, status in results if status != 200)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    print("%s requests in %.1fs (%.0f req/s, concurrency %s), %s errors" % (
+        len(results), duration, len(results) / duration, args.concurrency, errors))
+    print("p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" %
+          (p50, p95, p99, latencies.max()))
+    print("p99 target %.0f ms: %s" %
+          (args.target, "ok" if p99 <= args.target else "missed"))
+
+    return 0 if p99 <= args.target and errors == 0 else 1
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,117 @@
+"""Latency of the in-process profile scoring of `ProfileServing` (no database: the two profile queries and the write are not measured)
+
+Usage:
+    python -m benchmarks.profile_scoring [--items 20000] [--interactions 50] [--requests 500]
+
+The warm catalog is synthetic: every media with genres gets `items` content with 1 to 3 of 30 genres, and `similars` similars per content.
+Each request scores a random profile (liked genres, and `interactions` rated content spread over the media), as `ProfileServing.recommend` does.
+See `benchmarks.profile_latency` for the end-to-end latency of the route.
+"""
+from time import perf_counter
+
+from src.content import Application, Book, Game, Movie, Serie, Track, Interactions, SimilarsIndex
+from src.content.genre import GenreMatrix
+from src.engines import ProfileServing
+from flask import Flask
+
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+import uuid
+
+
+def synthetic_catalog(n_items, n_similars=10, n_genres=30, seed=0):
+    """Build the warm structures of every media (see `ProfileServing.warm`)
+
+    Args:
+        n_items (int): number of content of each media
+        n_similars (int, optional): number of similars of each content. Defaults to 10.
+        n_genres (int, optional): number of genres of each media. Defaults to 30.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        tuple: (catalog, genre names of each content type)
+    """
+    rng = np.random.default_rng(seed)
+    logger = logging.getLogger("benchmark")
+
+    catalog, vocabularies = {}, {}
+    for i, media in enumerate([Application, Book, Game, Movie, Serie, Track]):
+        m = media(logger=logger)
+        # Content ids are unique across media
+        content_ids = np.arange(i * n_items, (i+1) * n_items, dtype=np.uint32)
+
+        genres = None
+        if media not in [Application, Book]:
+            vocabulary = ["%s%s" % (str(m.content_type).upper(), g)
+                          for g in range(n_genres)]
+            genres = GenreMatrix.from_strings(content_ids, [",".join(rng.choice(vocabulary, size=rng.integers(1, 4), replace=False))
+                                                            for _ in range(n_items)], vocabulary)
+            vocabularies[str(m.content_type)] = vocabulary
+
+        sources = np.repeat(content_ids, n_similars)
+        similars = SimilarsIndex.from_arrays(sources, rng.choice(content_ids, size=sources.shape[0]).astype(np.uint32),
+                                             rng.uniform(.5, 1, size=sources.shape[0]).astype(np.float32), rng.uniform(0, 10, size=sources.shape[0]).astype(np.float32))
+        catalog[str(m.content_type)] = (m, genres, similars)
+
+    return catalog, vocabularies
+
+
+def synthetic_profile(catalog, vocabularies, n_interactions, rng):
+    """Liked genres and interactions of a profile, as loaded by `ProfileServing.recommend`
+
+    Returns:
+        tuple: (profile dataframe, Interactions)
+    """
+    genres = [genre for vocabulary in vocabularies.values()
+              for genre in vocabulary]
+    liked = set(rng.choice(genres, size=5, replace=False))
+    profile_df = pd.DataFrame(
+        [[0] + [2 if genre in liked else 1 for genre in genres]], columns=["user_id"] + genres)
+
+    content_ids = np.concatenate([similars.content_ids for _, _, similars in catalog.values()])
+    meta_df = pd.DataFrame({
+        "content_id": rng.choice(content_ids, size=n_interactions, replace=False),
+        "rating": rng.integers(0, 6, size=n_interactions),
+        "review_see_count": rng.integers(0, 3, size=n_interactions),
+    })
+    return profile_df, Interactions.from_frame(meta_df, "content_id")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--items", type=int, default=20_000,
+                        help="Content of each media.")
+    parser.add_argument("--similars", type=int, default=10)
+    parser.add_argument("--interactions", type=int, default=50,
+                        help="Rated content of each profile.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    args = parser.parse_args()
+
+    catalog, vocabularies = synthetic_catalog(args.items, args.similars)
+    rng = np.random.default_rng(1)
+    profiles = [synthetic_profile(catalog, vocabularies, args.interactions, rng)
+                for _ in range(args.warmup + args.requests)]
+
+    latencies, lines = [], 0
+    with Flask(__name__).app_context():
+        for i, (profile_df, interactions) in enumerate(profiles):
+            st_time = perf_counter()
+            similar_values, profile_values = ProfileServing.score(
+                catalog, str(uuid.uuid4()), 1, profile_df, interactions)
+            if i >= args.warmup:
+                latencies.append(perf_counter() - st_time)
+                lines += len(similar_values) + len(profile_values)
+
+    latencies = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    print("%s profiles scored against %s content (%s similars each), %.0f lines per profile" % (
+        len(latencies), args.items * len(catalog), args.similars, lines / len(latencies)))
+    print("p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" %
+          (p50, p95, p99, latencies.max()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Compare the sparse top-k kernel with the former dense cosine + argsort path
+
+Usage:
+    python -m benchmarks.similarity_kernel [--sizes 10000 100000 1000000] [--chunks 5]
+
+Each catalog is a synthetic L2-normalized TF-IDF matrix (long-tailed vocabulary, like a real soup).
+Only `--chunks` chunks of 100 source rows are measured against the whole catalog, the total time is extrapolated from them.
+The kernel time includes its share of the one-time transposition of the catalog.
+"""
+from sklearn.feature_extraction.text import TfidfTransformer
+from sklearn.metrics.pairwise import cosine_similarity
+from scipy.sparse import csr_matrix
+from time import perf_counter
+
+from src.utils.topk import top_k_similarities
+
+import numpy as np
+import argparse
+
+ROWS_PER_CHUNK = 100
+
+
+def synthetic_catalog(n_items, n_features=50_000, tokens_per_item=20, family_size=5, seed=0):
+    """Build a L2-normalized TF-IDF matrix looking like the content soups
+
+    Items come by families (same director, same series, ...): each item keeps a random part of the tokens of its family prototype.
+
+    Args:
+        n_items (int): number of items (rows)
+        n_features (int, optional): vocabulary size. Defaults to 50_000.
+        tokens_per_item (int, optional): number of tokens for each item. Defaults to 20.
+        family_size (int, optional): average number of items sharing a prototype. Defaults to 5.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        csr_matrix: float32 TF-IDF matrix
+    """
+    rng = np.random.default_rng(seed)
+    # Long tail: a few frequent tokens (genres, languages, ...) and a lot of rare ones (names)
+    weights = 1 / (np.arange(n_features) + 10)
+    weights /= weights.sum()
+
+    n_families = max(1, n_items // family_size)
+    prototypes = rng.choice(
+        n_features, size=(n_families, tokens_per_item), p=weights)
+    indices = prototypes[rng.integers(0, n_families, size=n_items)]
+
+    # Each item replaces a random share of its family tokens
+    replaced = rng.random(size=indices.shape) < rng.uniform(
+        .1, .9, size=(n_items, 1))
+    indices[replaced] = rng.choice(
+        n_features, size=int(replaced.sum()), p=weights)
+
+    indptr = np.arange(0, n_items * tokens_per_item + 1, tokens_per_item)
+    counts = csr_matrix(
+        (np.ones(indices.size, dtype=np.float32), indices.ravel().astype(np.int32), indptr), shape=(n_items, n_features))
+    counts.sum_duplicates()
+
+    return TfidfTransformer().fit_transform(counts).astype(np.float32)
+
+
+def legacy_chunk(sources, targets, threshold, max_sim):
+    """Former path: dense cosine similarity then full sort of each row"""
+    pairs = []
+    for i, cosimilarity in enumerate(cosine_similarity(sources, targets)):
+        for target_i in cosimilarity.argsort()[-(max_sim+1):]:
+            if cosimilarity[target_i] >= threshold:
+                pairs.append((i, target_i))
+    return set(pairs)
+
+
+def kernel_chunk(sources, targets_t, threshold, max_sim):
+    rows, cols, _ = top_k_similarities(
+        sources, targets_t, k=max_sim+1, threshold=threshold)
+    return set(zip(rows.tolist(), cols.tolist()))
+
+
+def measure(func, mat, targets, starts, threshold, max_sim):
+    results = []
+    st_time = perf_counter()
+    for start in starts:
+        results.append(func(mat[start:start+ROWS_PER_CHUNK],
+                            targets, threshold, max_sim))
+    return (perf_counter() - st_time) / len(starts), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--chunks", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=.5)
+    parser.add_argument("--max-sim", type=int, default=10)
+    args = parser.parse_args()
+
+    print("%10s %8s %14s %14s %9s %12s %10s" % (
+        "items", "nnz/row", "legacy/chunk", "kernel/chunk", "speedup", "est. kernel", "same pairs"))
+    for size in args.sizes:
+        mat = synthetic_catalog(size)
+        starts = np.linspace(0, size - ROWS_PER_CHUNK,
+                             args.chunks, dtype=int)
+
+        legacy_time, legacy = measure(
+            legacy_chunk, mat, mat, starts, args.threshold, args.max_sim)
+
+        st_time = perf_counter()
+        mat_t = mat.T.tocsr()
+        transpose_time = perf_counter() - st_time
+        kernel_time, kernel = measure(
+            kernel_chunk, mat, mat_t, starts, args.threshold, args.max_sim)
+        kernel_time += transpose_time * ROWS_PER_CHUNK / size
+
+        # Ties can be broken differently, compare the number of shared pairs
+        shared = sum(len(a & b) for a, b in zip(legacy, kernel))
+        total = sum(len(a) for a in legacy) or 1
+
+        print("%10d %8.1f %13.1fms %13.1fms %8.1fx %11.1fs %9.2f%%" % (
+            size, mat.nnz / size, legacy_time * 1000, kernel_time * 1000, legacy_time / kernel_time,
+            kernel_time * size / ROWS_PER_CHUNK, 100 * shared / total))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,63 @@ DB_URI = "postgresql://%s:%s@%s:%s/%s" % (
     os.environ.get("DB_NAME", "recofinement")
 )
 
+# Local directory for engines working files (spilled results, persisted features, ...)
+ENGINE_DATA_DIR = os.environ.get("ENGINE_DATA_DIR", "data")
+
+# Number of content streamed at once from the database when (re)building the feature store
+FEATURES_CHUNK_SIZE = int(os.environ.get("FEATURES_CHUNK_SIZE", 10_000))
+
+# Worker processes of per-user engines (1: no worker process), and number of users given to a worker at once
+ENGINE_WORKERS = int(os.environ.get("ENGINE_WORKERS", 1))
+ENGINE_CHUNK_SIZE = int(os.environ.get("ENGINE_CHUNK_SIZE", 1_000))
+# Arrays given to worker processes from this size (bytes) are shared with them (memory-mapped file or shared memory), not copied
+ENGINE_SHARED_ARRAY_SIZE = int(os.environ.get("ENGINE_SHARED_ARRAY_SIZE", 1 << 20))
+# Number of content types an engine runs at once (1: one after the other), see `Engine.for_each_media`
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 1))
+# Maximum number of result batches waiting for the writer thread of an engine
+ENGINE_WRITER_QUEUE_SIZE = int(os.environ.get("ENGINE_WRITER_QUEUE_SIZE", 8))
+
+# Keep catalog structures in memory to score profiles in the request (`RecommendProfile`), instead of running the engines
+PROFILE_SERVING = os.environ.get("PROFILE_SERVING", "true").lower() == "true"
+
+# Merged recommendation lists served by `GET /recommend/<user_uuid>`: maximum number of cached lists, and their lifetime (seconds)
+RECOMMEND_CACHE_SIZE = int(os.environ.get("RECOMMEND_CACHE_SIZE", 10_000))
+RECOMMEND_CACHE_TTL = float(os.environ.get("RECOMMEND_CACHE_TTL", 300))
+
+# Maximum number of engines run at once by a pipeline (`Recommend`), and memory budget (MB) of running engines (see `Engine.__memory__`)
+PIPELINE_CONCURRENCY = int(os.environ.get("PIPELINE_CONCURRENCY", 2))
+PIPELINE_MEMORY_BUDGET = int(os.environ.get("PIPELINE_MEMORY_BUDGET", 4096))
+
+# Number of finished engine runs kept by the job registry (`GET /jobs`)
+JOBS_HISTORY = int(os.environ.get("JOBS_HISTORY", 100))
+
+# Save the similars index of each media (item -> similar items) and memory-map it, until similarities or popularity scores are recomputed
+SIMILARS_INDEX_MMAP = os.environ.get("SIMILARS_INDEX_MMAP", "true").lower() == "true"
+
+# Backend of similarity engines: "blocked" (exact, out-of-core, single box), "ann" (approximate, MinHash LSH) or "spark"
+SIMILARITY_BACKEND = os.environ.get("SIMILARITY_BACKEND", "blocked").strip()
+# Backend override per content type (ex: "movie:ann,track:ann")
+SIMILARITY_BACKEND_BY_TYPE = {
+    content_type.strip().lower(): backend.strip() for content_type, backend in (
+        item.split(":", 1) for item in os.environ.get("SIMILARITY_BACKEND_BY_TYPE", "").split(",") if item.strip())
+}
+for backend in [SIMILARITY_BACKEND, *SIMILARITY_BACKEND_BY_TYPE.values()]:
+    if backend not in ["blocked", "ann", "spark"]:
+        raise Exception("Unknown similarity backend '%s' (SIMILARITY_BACKEND, SIMILARITY_BACKEND_BY_TYPE)" % backend)
+# MinHash LSH parameters of the "ann" backend
+SIMILARITY_ANN_BANDS = int(os.environ.get("SIMILARITY_ANN_BANDS", 20))
+SIMILARITY_ANN_BAND_SIZE = int(os.environ.get("SIMILARITY_ANN_BAND_SIZE", 2))
+# RAM budget (in MB) of the blocked similarity pipeline
+SIMILARITY_RAM_BUDGET = int(os.environ.get("SIMILARITY_RAM_BUDGET", 1024))
+# Write path of the "spark" backend: "driver" (records are streamed to the driver one partition at a time)
+# or "executors" (each partition is copied to the database by its executor)
+SIMILARITY_SPARK_WRITE = os.environ.get("SIMILARITY_SPARK_WRITE", "driver")
+# Database seen from the Spark executors (defaults to DB_URI)
+SIMILARITY_SPARK_DB_URI = os.environ.get("SIMILARITY_SPARK_DB_URI") or DB_URI
+# Incremental similarity updates fall back to a full rebuild when new items bring more than this share of unknown tokens,
+# or grow the catalog by more than this share since the last full rebuild (stale IDF)
+SIMILARITY_VOCABULARY_DRIFT = float(os.environ.get("SIMILARITY_VOCABULARY_DRIFT", .1))
+
 DEFAULT_RENDERERS = [
     "flask_api.renderers.JSONRenderer"
 ]
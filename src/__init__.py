@@ -1,12 +1,17 @@
-from .recommend import Recommend, RecommendUser, RecommendProfile, start_popularity_engine, start_similarities_engine, start_collaborative_engine, start_from_profile_engine, start_from_similar_content_engine, start_from_profile_engine_for_group, start_from_similar_content_engine_for_group, start_similarities_between_items_engine, start_from_profile_engine_for_profile, start_from_similar_content_engine_for_profile
+from .recommend import Recommend, RecommendUser, RecommendProfile, jobs, start_popularity_engine, start_similarities_engine, start_collaborative_engine, start_from_profile_engine, start_from_similar_content_engine, start_from_profile_engine_for_group, start_from_similar_content_engine_for_group, start_similarities_between_items_engine, start_from_profile_engine_for_profile, start_from_similar_content_engine_for_profile, start_profile_serving_warmup
 
 from flask import request, current_app
 from flask_api import FlaskAPI
-from flask_api.exceptions import PermissionDenied
+from flask_api.exceptions import PermissionDenied, ParseError, NotFound
 from functools import wraps
 
 from src.addons import flask_uuid
+from src.content import ContentType
+from src.engines import Popularity, ContentSimilarities, CollaborativeFiltering, FromProfile, FromSimilarContent, LinkBetweenItems, UserServing
+from src.utils import tfidf_from_counts, evaluate_recall, recommendations_cache
 import settings
+import importlib
+import click
 
 
 def create_app():
@@ -26,73 +31,108 @@ def create_app():
             return f(*args, **kwargs)
         return decorated_function
 
+    # Profile requests are scored in process once catalog structures are loaded (engines are run until then)
+    # Loaded when the server gets its first request: CLI commands also create the app
+    if settings.PROFILE_SERVING:
+        @app.before_first_request
+        def warm_profile_serving():
+            start_profile_serving_warmup(wait=False)
+
+    # Background runs answer with their job (see `JobRegistry`), an identical running job is returned instead of starting a new one
+    def job_started(job, coalesced):
+        return {"job_id": job.id, "status": job.status, "coalesced": coalesced}, 202
+
     # ============ Routes ============
 
     @app.route("/up")
     def up():
         return {"up": True}, 200
 
+    @app.route("/jobs", methods=["GET"])
+    @token_auth
+    def list_jobs():
+        return {"jobs": [job.to_dict() for job in jobs.list()]}, 200
+
+    @app.route("/jobs/<job_id>", methods=["GET"])
+    @token_auth
+    def get_job(job_id):
+        job = jobs.get(job_id)
+        if job is None:
+            raise NotFound("Unknown job")
+        return job.to_dict(), 200
+
     @app.route("/popularity/train", methods=["PUT"])
     @token_auth
     def popularity_train():
-        start_popularity_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(Popularity))
 
     @app.route("/content_similarities/train", methods=["PUT"])
     @token_auth
     def content_similarities_train():
-        start_similarities_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(ContentSimilarities))
 
     @app.route("/link_between_items/train", methods=["PUT"])
     @token_auth
     def link_between_items():
-        start_similarities_between_items_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(LinkBetweenItems))
 
     @app.route("/collaborative_filtering/train", methods=["PUT"])
     @token_auth
     def collaborative_filtering_train():
-        start_collaborative_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(CollaborativeFiltering))
 
     @app.route("/from_profile/train", methods=["PUT"])
     @token_auth
     def from_profile_train():
-        start_from_profile_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(FromProfile))
 
     @app.route("/from_similar_content/train", methods=["PUT"])
     @token_auth
     def from_similar_content_train():
-        start_from_similar_content_engine(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(FromSimilarContent))
 
     @app.route("/from_profile/group/train", methods=["PUT"])
     @token_auth
     def from_group_profile_train():
-        start_from_profile_engine_for_group(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(FromProfile, is_group=True))
 
     @app.route("/from_similar_content/group/train", methods=["PUT"])
     @token_auth
     def from_similar_content_group_train():
-        start_from_similar_content_engine_for_group(wait=False)
-        return {"started": True}, 202
+        return job_started(*jobs.submit(FromSimilarContent, is_group=True))
 
     @app.route("/recommend/", methods=["PUT"])
     @token_auth
     def recommend():
-        eng = Recommend()
-        eng.start()
-        return {"started": True}, 202
+        return job_started(*jobs.submit(Recommend))
 
     @app.route("/recommend/<uuid:user_uuid>", methods=["PUT"])
     @token_auth
     def recommend_user(user_uuid):
-        eng = RecommendUser(user_uuid=user_uuid)
-        eng.start()
-        return {"started": True}, 202
+        return job_started(*jobs.submit(RecommendUser, user_uuid=str(user_uuid)))
+
+    @app.route("/recommend/<uuid:user_uuid>", methods=["GET"])
+    @token_auth
+    def get_recommendations(user_uuid):
+        try:
+            content_type = ContentType(request.args.get("type", ""))
+            k = int(request.args.get("k", 20))
+        except ValueError:
+            raise ParseError(
+                "'type' must be one of %s and 'k' an integer" % ", ".join(str(t) for t in ContentType))
+        if k < 1 or k > 200:
+            raise ParseError("'k' must be between 1 and 200")
+
+        recommendations = UserServing.recommend(
+            str(user_uuid), content_type, k)
+        if recommendations is None:
+            raise NotFound("Unknown user")
+        return {"user_uuid": str(user_uuid), "type": str(content_type), "k": k, "recommendations": recommendations}, 200
+
+    @app.route("/recommend/metrics", methods=["GET"])
+    @token_auth
+    def recommendations_metrics():
+        return recommendations_cache.metrics(), 200
 
     @app.route("/recommend/profile/<uuid:profile_uuid>/<int:event_id>", methods=["PUT"])
     @token_auth
@@ -107,4 +147,25 @@ def create_app():
             # Emit an error
             return {'status': False, 'message': 'Error during the process!'}, 500
 
+    # ============ Commands ============
+
+    @app.cli.command("ann-recall")
+    @click.argument("content_type", type=click.Choice([str(t) for t in ContentType]))
+    @click.option("--sample", default=1000, help="Number of evaluated items.")
+    @click.option("--threshold", default=.5, help="Minimum similarity.")
+    @click.option("--bands", default=settings.SIMILARITY_ANN_BANDS, help="Number of LSH bands.")
+    @click.option("--band-size", default=settings.SIMILARITY_ANN_BAND_SIZE, help="Number of minhashes in a band.")
+    def ann_recall(content_type, sample, threshold, bands, band_size):
+        """Measure recall@10 of the ANN similarity backend against the exact one"""
+        content_module = importlib.import_module("src.content")
+        m = getattr(content_module, content_type.capitalize())(
+            logger=app.logger)
+
+        tfidf = tfidf_from_counts(m.features("soup").counts)[0]
+        result = evaluate_recall(tfidf, sample=sample, k=10,
+                                 threshold=threshold, n_bands=bands, band_size=band_size)
+
+        click.echo("%s: recall@10 = %.4f on %s exact pairs (exact %.2fs, ann %.2fs)" % (
+            content_type, result["recall"], result["exact_pairs"], result["exact_duration"], result["ann_duration"]))
+
     return app
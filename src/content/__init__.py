@@ -10,3 +10,8 @@ from .group import Group
 from .profile import Profile
 
 from .content import Content, ContentType
+from .genre import GenreMatrix
+from .interactions import Interactions
+from .recommended import AlreadyRecommended
+from .similars import SimilarsIndex
+from .popularity import scorer, scorers
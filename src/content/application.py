@@ -8,50 +8,40 @@ import numpy as np
 class Application(Content):
     content_type = ContentType.APPLICATION
 
+    # NOTE IMDB measure of popularity does not seem to be relevant for this media.
+    __popularity_scorer__ = "rating_count"
+
     # For similarities between different content (different content type)
     cmp_column_name = "name"
 
     def request_for_popularity(self):
         return super().request_for_popularity(self.content_type)
 
-    def calc_popularity_score(self, df):
-        # NOTE IMDB measure of popularity does not seem to be relevant for this media.
-
-        # Calculate the minimum number of votes required to be in the chart
-        m = df["rating_count"].quantile(0.90)
-
-        # Filter out all qualified media into a new DataFrame
-        q_df = df.copy().loc[df['rating_count'] >= m]
-
-        q_df['popularity_score'] = q_df.apply(
-            lambda x: float(format(x["rating_count"] + x["rating"], ".4f")), axis=1, result_type="reduce")
-
-        return q_df
-
-    def get_with_genres(self):
+    def get_with_genres(self, content_ids=None, chunksize=None):
         """Get application
 
         NOTE can add 't.rating' and 't.reviews as rating_count' column if we introduce popularity filter to content-based engine
             example: this recommender would take the 30 most similar item, calculate the popularity score and then return the top 10
 
+        Args:
+            content_ids (list, optional): only get these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
         Returns:
-            DataFrame: dataframe of application data
+            DataFrame|iterator: dataframe of application data
         """
-        self.df = pd.read_sql_query(
-            'SELECT c.content_id, t.name, t.type, t.content_rating, ge.name AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id' % (self.tablename, self.content_type), con=db.engine)
-
-        # Reduce memory
-        self.reduce_memory()
+        return self._read_sql(
+            'SELECT c.content_id, t.name, t.type, t.content_rating, ge.name AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id %s' % (self.tablename, self.content_type, self._content_filter(content_ids)), chunksize)
 
-        return self.df
-
-    def prepare_sim(self):
+    def _prepare_sim(self, app_df):
         """Prepare application data for content similarity process
 
+        Args:
+            app_df (DataFrame): application data (see `get_with_genres`)
+
         Returns:
             DataFrame: result dataframe
         """
-        app_df = self.get_with_genres()
         app_df["content_type"] = self.content_type
         # Replace NaN with an empty string
         features = ['name', 'type', 'content_rating', 'genres']
@@ -14,7 +14,7 @@ class Book(Content):
     def request_for_popularity(self):
         return super().request_for_popularity(self.content_type)
 
-    def get_with_genres(self):
+    def get_with_genres(self, content_ids=None, chunksize=None):
         """Get book
 
         NOTE can add 't.rating' and 't.rating_count' column if we introduce popularity filter to content-based engine
@@ -22,24 +22,25 @@ class Book(Content):
 
         NOTE Warning, for now, we do not have any genre linked to books !
 
+        Args:
+            content_ids (list, optional): only get these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
         Returns:
-            DataFrame: dataframe of track data
+            DataFrame|iterator: dataframe of track data
         """
-        self.df = pd.read_sql_query(
-            'SELECT b.content_id, b.title, b.author, b.year_of_publication, b.publisher FROM "book" AS b', con=db.engine)
-
-        # Reduce memory
-        self.reduce_memory()
+        return self._read_sql(
+            'SELECT b.content_id, b.title, b.author, b.year_of_publication, b.publisher FROM "book" AS b %s' % self._content_filter(content_ids, alias="b"), chunksize)
 
-        return self.df
-
-    def prepare_sim(self):
+    def _prepare_sim(self, book_df):
         """Prepare book data for content similarity process
 
+        Args:
+            book_df (DataFrame): book data (see `get_with_genres`)
+
         Returns:
             DataFrame: result dataframe
         """
-        book_df = self.get_with_genres()
         book_df["content_type"] = self.content_type
         # remove '0' from year
         book_df["year_of_publication"] = book_df["year_of_publication"].astype(
@@ -1,4 +1,6 @@
-from src.utils import db, clean_data, create_soup
+from src.utils import db, clean_data, count_tokens, peak_rss, FeatureStore
+from settings import FEATURES_CHUNK_SIZE
+from .popularity import scorers
 
 from flask import current_app
 from sqlalchemy import text
@@ -21,6 +23,12 @@ class ContentType(enum.Enum):
     def __str__(self):
         return self.value
 
+    @property
+    def code(self):
+        """Compact code of the content type (its position in the enum), to be stored as uint8
+        """
+        return list(ContentType).index(self)
+
 
 class Content:
     id = "content_id"
@@ -35,6 +43,9 @@ class Content:
     __meta_cols__ = ["user_id", id, "rating", "last_rating_date",
                      "review_see_count", "last_review_see_date", "count", "last_count_increment"]
 
+    # Popularity scorer (see `src.content.popularity`)
+    __popularity_scorer__ = "imdb"
+
     # For similarities between different content (different content type)
     cmp_column_name = None
     other_content_cmp = []
@@ -78,6 +89,22 @@ class Content:
 
         return df
 
+    def _content_filter(self, content_ids, alias="c"):
+        """SQL filter on content ids
+
+        Args:
+            content_ids (list): content ids, None for no filter
+            alias (str, optional): alias of the table holding `content_id`. Defaults to "c".
+
+        Returns:
+            str: WHERE clause (or empty string)
+        """
+        if content_ids is None:
+            return ''
+        if len(content_ids) == 0:
+            return 'WHERE FALSE'
+        return 'WHERE %s.content_id IN (%s)' % (alias, ", ".join(str(int(x)) for x in content_ids))
+
     def get_meta(self, cols=None, user_id=None, limit=None, list_of_content_id=[]):
         """Get metadata as Dataframe
 
@@ -127,7 +154,7 @@ class Content:
         return self.df
 
     def calc_popularity_score(self, df):
-        """IMDB measure of popularity
+        """Measure of popularity, with the scorer declared by the media (`__popularity_scorer__`, see `src.content.popularity`)
 
         Args:
             df (Dataframe): content dataframe
@@ -135,38 +162,7 @@ class Content:
         Returns:
             Dataframe: df with new column for calculated popularity score
         """
-        # Can be overrided by child class
-        def weighted_rating(x, m, C):
-            """Function that computes the weighted rating of each media
-
-            Args:
-                x (DataFrame row): current row
-                m (int): minimum number of votes.
-                C (float): Average ratings of all medias.
-
-            Returns:
-                float: weight popularity score
-            """
-            v = x['rating_count']
-            R = x['rating']
-
-            # Calculation based on the IMDB formula
-            return float(format((v/(v+m) * R) + (m/(m+v) * C), ".4f"))
-
-        # Get average ratings of all media
-        c = df["rating"].mean()
-
-        # Calculate the minimum number of votes required to be in the chart
-        m = df["rating_count"].quantile(0.90)
-
-        # Filter out all qualified media into a new DataFrame
-        q_df = df.copy().loc[df['rating_count'] >= m]
-
-        # Define a new feature 'popularity_score' and calculate its value with `weighted_rating()`
-        q_df['popularity_score'] = q_df.apply(
-            lambda x: weighted_rating(x, m, c), axis=1, result_type="reduce")
-
-        return q_df
+        return scorers[self.__popularity_scorer__](df)
 
     def get_populars(self, size=200):
         """Set popularity score for each content
@@ -192,11 +188,54 @@ class Content:
 
         return q_df.head(size)
 
-    def get_with_genres(self):
+    def _read_sql(self, query, chunksize=None):
+        """Read content data (with reduced memory)
+
+        Args:
+            query (str): SQL query
+            chunksize (int, optional): stream DataFrames of `chunksize` rows from a server-side cursor instead of a single one. Defaults to None.
+
+        Returns:
+            DataFrame|iterator: content data
+        """
+        if chunksize is None:
+            self.df = pd.read_sql_query(query, con=db.engine)
+
+            # Reduce memory
+            self.reduce_memory()
+
+            return self.df
+        return self._stream_sql(query, chunksize)
+
+    def _stream_sql(self, query, chunksize):
+        with db.engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql_query(query, con=connection, chunksize=chunksize):
+                self.df = df
+
+                # Reduce memory
+                self.reduce_memory()
+
+                yield self.df
+
+    def get_with_genres(self, content_ids=None, chunksize=None):
         raise Exception("'get_with_genres' function must be created")
 
-    def prepare_sim(self):
-        raise Exception("'prepare_sim' function must be created")
+    def _prepare_sim(self, df):
+        raise Exception("'_prepare_sim' function must be created")
+
+    def prepare_sim(self, content_ids=None, chunksize=None):
+        """Prepare content data for content similarity process
+
+        Args:
+            content_ids (list, optional): only prepare these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
+        Returns:
+            DataFrame|iterator: result dataframe (with a `soup` column)
+        """
+        if chunksize is None:
+            return self._prepare_sim(self.get_with_genres(content_ids))
+        return (self._prepare_sim(df) for df in self.get_with_genres(content_ids, chunksize))
 
     def get_similars(self, content_id, same_type=True):
         """Get all similars content of a content
@@ -228,6 +267,30 @@ class Content:
 
         return self.df
 
+    def genre_matrix(self, df=None):
+        """Get content genres as a sparse one-hot matrix
+
+        Args:
+            df (DataFrame, optional): Content dataframe (see `get_for_profile`). Defaults to None (loaded).
+
+        Returns:
+            GenreMatrix: content x genre matrix, columns of the genres of at least one content, ordered as the genre table
+        """
+        # Imported here, genre module depends on this one
+        from .genre import Genre, GenreMatrix
+
+        if df is None:
+            df = self.get_for_profile()
+
+        genre_df = Genre.get_genres(self.content_type)
+        vocabulary = (genre_df['content_type'] + genre_df['name']).tolist()
+
+        genres = GenreMatrix.from_strings(df[self.id], df['genres'], vocabulary)
+
+        # Only genres used by at least one content (a liked genre without content must not weigh in a profile)
+        used = np.flatnonzero(np.diff(genres.matrix.tocsc().indptr) > 0)
+        return GenreMatrix(genres.matrix[:, used], genres.genres[used], genres.content_ids)
+
     def prepare_from_user_profile(self, df):
         """Get content with genre
 
@@ -237,57 +300,138 @@ class Content:
         Returns:
             DataFrame: content with genre weight (0 or 1)
         """
+        return self.genre_matrix(df).to_frame(self.id)
 
-        # Copying the content dataframe into a new one since we won't need to use the genre information in our first case.
-        contentWithGenres_df = df.copy()
+    def prepare_sim_name(self, content_ids=None, chunksize=None):
+        """Prepare the name (`cmp_column_name`) soup of content, for similarities between different content types
 
-        # For every row in the dataframe, iterate through the list of genres and place a 1 into the corresponding column
-        for index, row in df.iterrows():
-            if row['genres'] is not None:
-                for genre in row['genres'].split(","):
-                    contentWithGenres_df.at[index, genre] = 1
+        Args:
+            content_ids (list, optional): only prepare these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
 
-        # Filling in the NaN values with 0 to show that a content doesn't have that column's genre
-        contentWithGenres_df = contentWithGenres_df.fillna(0)
+        Returns:
+            DataFrame|iterator: content id, content type and soup of each content
+        """
+        dfs = self._read_sql(
+            'SELECT cc.content_id, cc.%s AS name FROM "%s" AS c INNER JOIN "%s" AS cc ON cc.content_id = c.content_id %s GROUP BY cc.content_id' % (self.cmp_column_name, self.tablename, self.content_type, self._content_filter(content_ids)), chunksize)
 
-        # Reduce memory
-        genre_cols = list(set(contentWithGenres_df.columns) -
-                          set(df.columns))
-        for c in genre_cols:
-            contentWithGenres_df[c] = contentWithGenres_df[c].astype("uint8")
+        if chunksize is None:
+            return self._prepare_sim_name(dfs)
+        return (self._prepare_sim_name(df) for df in dfs)
+
+    def _prepare_sim_name(self, df):
+        df["content_type"] = str(self.content_type)
 
-        contentWithGenres_df.drop(["genres"], axis=1, inplace=True)
+        # Replace NaN with empty string
+        df["name"].fillna('', inplace=True)
 
-        return contentWithGenres_df
+        # Clean and homogenise data
+        df["name"] = df["name"].apply(clean_data)
+
+        # Create a soup
+        df['soup'] = df["name"]
+
+        # Delete unused col
+        return df.drop(["name"], 1)
 
     def prepare_sim_between_content(self):
-        dfs = []
         content_module = importlib.import_module("src.content")
-        frames = [
-            self,
-            *[
-                getattr(content_module, str(o).capitalize())
-                for o in self.other_content_cmp
+        dfs = [
+            content(logger=self.logger).prepare_sim_name()
+            for content in [
+                self.__class__,
+                *[
+                    getattr(content_module, str(o).capitalize())
+                    for o in self.other_content_cmp
+                ]
             ]
         ]
-        for content in frames:
-            tmp = pd.read_sql_query(
-                'SELECT cc.content_id, cc.%s AS name FROM "%s" AS c INNER JOIN "%s" AS cc ON cc.content_id = c.content_id GROUP BY cc.content_id' % (content.cmp_column_name, self.tablename, content.content_type), con=db.engine)
-            tmp["content_type"] = str(content.content_type)
-            dfs.append(tmp)
 
-        for i in range(len(dfs)):
-            # Replace NaN with empty string
-            dfs[i]["name"].fillna('', inplace=True)
+        return dfs[0], dfs[1:]
 
-            # Clean and homogenise data
-            dfs[i]["name"] = dfs[i]["name"].apply(clean_data)
+    def catalog_fingerprint(self):
+        """Cheap summary of the catalog state, it changes when content are added, removed or changed
 
-            # Create a soup
-            dfs[i]['soup'] = dfs[i].apply(
-                lambda x: create_soup(x, ["name"]), axis=1)
+        Returns:
+            dict: number of content, greatest content id and date of the last change
+        """
+        df = pd.read_sql_query(
+            'SELECT COUNT(*) AS c, COALESCE(MAX(content_id), 0) AS max_id FROM "%s"' % self.content_type, con=db.engine)
+        changed = pd.read_sql_query(
+            'SELECT MAX(occured_at) AS changed_at FROM "changed_event" WHERE model_name = \'%s\'' % self.content_type, con=db.engine)
 
-            # Delete unused col
-            dfs[i] = dfs[i].drop(["name"], 1)
+        return {
+            "count": int(df.iloc[0]["c"]),
+            "max_id": int(df.iloc[0]["max_id"]),
+            "changed_at": str(changed.iloc[0]["changed_at"]),
+        }
 
-        return dfs[0], dfs[1:]
+    def _tokenize(self, prepare, content_ids=None, vocabulary=None):
+        """Tokenize content soups in a single pass, streamed chunk by chunk from the SQL cursor
+
+        Args:
+            prepare (function): `prepare_sim` or `prepare_sim_name`
+            content_ids (list, optional): only tokenize these content. Defaults to None (all).
+            vocabulary (dict, optional): known tokens, extended with new ones. Defaults to None.
+
+        Returns:
+            tuple: (count matrix, vocabulary, content id of each row, each content once)
+        """
+        ids = []
+        # Queries without GROUP BY (ex: application genres) give a row per genre: the first row of each content is kept
+        seen = np.zeros(0, dtype=np.uint32)
+
+        def soups():
+            nonlocal seen
+            for df in prepare(content_ids, chunksize=FEATURES_CHUNK_SIZE):
+                chunk_ids = df[self.id].to_numpy(dtype=np.uint32)
+                _, first = np.unique(chunk_ids, return_index=True)
+                first = np.sort(first[~np.isin(chunk_ids[first], seen)])
+
+                ids.append(chunk_ids[first])
+                seen = np.union1d(seen, chunk_ids[first])
+                yield from df["soup"].iloc[first]
+
+        counts, vocabulary = count_tokens(soups(), vocabulary)
+        return counts, vocabulary, np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.uint32)
+
+    def features(self, kind="soup"):
+        """Token counts of the catalog, read from the feature store
+
+        The store is refreshed only when the catalog fingerprint changed: new content are tokenized and appended,
+        any other change (content changed or removed) rebuilds the store.
+
+        Args:
+            kind (str, optional): "soup" (see `prepare_sim`) or "name" (see `prepare_sim_name`). Defaults to "soup".
+
+        Returns:
+            FeatureStore: loaded store
+        """
+        assert kind in ["soup", "name"], "kind must be 'soup' or 'name'"
+        prepare = self.prepare_sim if kind == "soup" else self.prepare_sim_name
+
+        store = FeatureStore("%s_%s" % (self.content_type, kind))
+        fingerprint = self.catalog_fingerprint()
+        if store.load() and store.fingerprint == fingerprint:
+            return store
+
+        st_time = datetime.utcnow()
+        if store.fingerprint is not None and store.fingerprint["changed_at"] == fingerprint["changed_at"]:
+            content_ids = pd.read_sql_query(
+                'SELECT content_id FROM "%s"' % self.content_type, con=db.engine)["content_id"].to_numpy(dtype=np.uint32)
+
+            if np.isin(store.content_ids, content_ids).all():
+                counts, vocabulary, new_ids = self._tokenize(
+                    prepare, np.setdiff1d(content_ids, store.content_ids), store.token_index())
+                store.append(counts, vocabulary, new_ids, fingerprint)
+
+                self.logger.info("%s %s features extended with %s content, tokenized in %s (peak RSS %.0f MB)" % (
+                    self.content_type, kind, counts.shape[0], datetime.utcnow()-st_time, peak_rss()))
+                return store
+
+        counts, vocabulary, content_ids = self._tokenize(prepare)
+        store.save(counts, vocabulary, content_ids, fingerprint)
+
+        self.logger.info("%s %s features rebuilt with %s content (%s tokens), tokenized in %s (peak RSS %.0f MB)" % (
+            self.content_type, kind, counts.shape[0], len(vocabulary), datetime.utcnow()-st_time, peak_rss()))
+        return store
@@ -8,6 +8,9 @@ import numpy as np
 class Game(Content):
     content_type = ContentType.GAME
 
+    # NOTE we do not have any rating for game (cold start), so we use 'recommendations' field instead of 'popularity_score' that is computed by 'reco_engine' service
+    __popularity_scorer__ = "recommendations"
+
     # For similarities between different content (different content type)
     cmp_column_name = "name"
     other_content_cmp = [ContentType.MOVIE, ContentType.SERIE]
@@ -20,36 +23,31 @@ class Game(Content):
 
         return self.df
 
-    def calc_popularity_score(self, df):
-        # NOTE we do not have any rating for game (cold start), so we use 'recommendations' field instead of 'popularity_score' that is computed by 'reco_engine' service
-        df = df.assign(popularity_score=df['recommendations']).fillna(0)
-
-        return df
-
-    def get_with_genres(self):
+    def get_with_genres(self, content_ids=None, chunksize=None):
         """Get game
 
         NOTE can add 't.rating' and 't.rating_count' column if we introduce popularity filter to content-based engine
             example: this recommender would take the 30 most similar item, calculate the popularity score and then return the top 10
 
+        Args:
+            content_ids (list, optional): only get these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
         Returns:
-            DataFrame: dataframe of game data
+            DataFrame|iterator: dataframe of game data
         """
-        self.df = pd.read_sql_query(
-            'SELECT g.content_id, g.name, g.short_description, g.developers, g.publishers, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS g ON g.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id GROUP BY g.content_id' % (self.tablename, self.content_type), con=db.engine)
+        return self._read_sql(
+            'SELECT g.content_id, g.name, g.short_description, g.developers, g.publishers, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS g ON g.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id %s GROUP BY g.content_id' % (self.tablename, self.content_type, self._content_filter(content_ids)), chunksize)
 
-        # Reduce memory
-        self.reduce_memory()
-
-        return self.df
-
-    def prepare_sim(self):
+    def _prepare_sim(self, game_df):
         """Prepare game data for content similarity process
 
+        Args:
+            game_df (DataFrame): game data (see `get_with_genres`)
+
         Returns:
             DataFrame: result dataframe
         """
-        game_df = self.get_with_genres()
         game_df["content_type"] = self.content_type
         # Transform genres str to list
         game_df["genres"] = game_df["genres"].apply(
@@ -1,6 +1,8 @@
 from src.utils import db
 from .content import ContentType
 
+from scipy.sparse import csr_matrix
+
 import pandas as pd
 import numpy as np
 
@@ -37,3 +39,116 @@ class Genre:
         genre_df = cls.reduce_memory(genre_df)
 
         return genre_df
+
+    @classmethod
+    def liked_weights(cls, owner_ids, liked_owner_ids, liked_genres, types=[], liked_weight=2, counts=None):
+        """Weight of each genre for some users (or groups, or profiles): 1 by default, `liked_weight` for a liked genre
+
+        Args:
+            owner_ids (np.ndarray): user (or group, or profile) id of each row
+            liked_owner_ids (np.ndarray): owner of each liked genre
+            liked_genres (np.ndarray): liked genre (`content_type || name`)
+            types (list|ContentType, optional): genre content types. Defaults to [] (all).
+            liked_weight (int, optional): Weight of liked genre. Defaults to 2.
+            counts (np.ndarray, optional): number of likes of each liked genre, the weight is multiplied by their sum (ex: group members). Defaults to None.
+
+        Returns:
+            DataFrame: uint8 column of each genre (`content_type || name`, ordered as the genre table), one row per owner
+        """
+        genre_df = cls.get_genres(types)
+        genres = pd.Index(genre_df['content_type'] +
+                          genre_df['name']).drop_duplicates()
+
+        rows = pd.Index(owner_ids).get_indexer(liked_owner_ids)
+        cols = genres.get_indexer(liked_genres)
+        kept = (rows >= 0) & (cols >= 0)
+
+        likes = np.zeros((len(owner_ids), genres.shape[0]), dtype=np.int64)
+        np.add.at(likes, (rows[kept], cols[kept]), 1 if counts is None else np.asarray(
+            counts, dtype=np.int64)[kept])
+
+        weights = np.where(likes > 0, liked_weight if counts is None else liked_weight * likes, 1)
+
+        return pd.DataFrame(weights.astype("uint8"), columns=genres)
+
+
+class GenreMatrix:
+    """Sparse content x genre one-hot matrix
+
+    Columns follow a stable genre vocabulary (`content_type || name`, ordered as the genre table),
+    rows are found from content ids with the dense `id_to_row` array.
+    """
+
+    def __init__(self, matrix, genres, content_ids):
+        """
+        Args:
+            matrix (csr_matrix): float32 one-hot matrix (content x genre)
+            genres (np.ndarray): genre name of each column
+            content_ids (np.ndarray): uint32 content id of each row
+        """
+        self.matrix = matrix
+        self.genres = genres
+        self.content_ids = content_ids
+
+        self.id_to_row = np.full(
+            int(content_ids.max()) + 1 if content_ids.shape[0] > 0 else 0, -1, dtype=np.int32)
+        self.id_to_row[content_ids] = np.arange(
+            content_ids.shape[0], dtype=np.int32)
+
+    @classmethod
+    def from_strings(cls, content_ids, genres, vocabulary=[]):
+        """Parse `string_agg` genre strings once
+
+        Args:
+            content_ids (iterable): content id of each row
+            genres (iterable): comma separated genres of each content (or None)
+            vocabulary (list, optional): known genres, in column order (duplicates are ignored). Unknown genres are added after them. Defaults to [].
+
+        Returns:
+            GenreMatrix: encoded genres
+        """
+        columns = {}
+        for genre in vocabulary:
+            columns.setdefault(genre, len(columns))
+
+        indices, indptr = [], [0]
+        for item in genres:
+            if isinstance(item, str) and len(item) > 0:
+                indices.extend(sorted(set(columns.setdefault(genre, len(columns))
+                                          for genre in item.split(","))))
+            indptr.append(len(indices))
+
+        content_ids = np.asarray(content_ids, dtype=np.uint32)
+        matrix = csr_matrix((np.ones(len(indices), dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                            shape=(content_ids.shape[0], len(columns)))
+
+        return cls(matrix, np.array(list(columns.keys()), dtype=object), content_ids)
+
+    def rows(self, content_ids):
+        """Row of some content ids
+
+        Args:
+            content_ids (np.ndarray): content ids
+
+        Returns:
+            np.ndarray: row of each content id, -1 when it has no row
+        """
+        content_ids = np.asarray(content_ids, dtype=np.int64)
+        rows = np.full(content_ids.shape[0], -1, dtype=np.int32)
+        known = content_ids < self.id_to_row.shape[0]
+        rows[known] = self.id_to_row[content_ids[known]]
+        return rows
+
+    def to_frame(self, id_name):
+        """Dense dataframe (former `prepare_from_user_profile` output)
+
+        Args:
+            id_name (str): name of the content id column
+
+        Returns:
+            DataFrame: content id and uint8 column of each genre
+        """
+        df = pd.DataFrame(self.matrix.toarray().astype(
+            "uint8"), columns=self.genres)
+        df.insert(0, id_name, self.content_ids)
+        return df
@@ -81,39 +81,17 @@ class Group:
         def list_of(c):
             return list(set(c))
 
-        group_df = df.copy().fillna('')
-        group_df = group_df.groupby("group_id").agg(
-            {'user_id': list_of, 'genres': list_of}).reset_index()
-        group_df.rename(columns={0: 'genres'}, inplace=True)
+        group_df = df.groupby("group_id").agg(
+            {'user_id': list_of}).reset_index()
 
         # reduce memory
         group_df = cls.reduce_memory(group_df)
 
-        # get genres list
-        genre_df = Genre.get_genres(types)
-        genre_df['name'] = genre_df['content_type'] + genre_df['name']
-        genre_df.drop(['content_type', 'genre_id'], axis=1, inplace=True)
-
-        result = group_df.copy()
-        result.drop(["genres"], axis=1, inplace=True)
-
-        # For every row in the dataframe, iterate through the list of genres and place a (1 by default or 2) into the corresponding column
-        for index, row in group_df.iterrows():
-            for g_index, g_row in genre_df.iterrows():
-                if g_row['name'] in row['genres']:
-                    result.at[index, g_row['name']] = liked_weight * int(
-                        df[
-                            (df['group_id'] == row["group_id"]) &
-                            (df['genres'] == g_row['name'])
-                        ]['count'].sum()
-                    )
-                else:
-                    result.at[index, g_row['name']] = 1
-
-        # Reduce memory
-        genre_cols = list(set(result.columns) -
-                          set(group_df.columns))
-        for c in genre_cols:
-            result[c] = result[c].astype("uint8")
+        # Weight of every genre in a single pass (multiplied by the number of members who like it)
+        liked = df.dropna(subset=["genres"])
+        weights = Genre.liked_weights(group_df["group_id"].to_numpy(), liked["group_id"].to_numpy(),
+                                      liked["genres"].to_numpy(), types, liked_weight, counts=liked["count"].to_numpy())
+
+        result = pd.concat([group_df, weights], axis=1)
 
         return result
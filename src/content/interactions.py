@@ -0,0 +1,198 @@
+from src.utils import db
+from settings import FEATURES_CHUNK_SIZE
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import pandas as pd
+import numpy as np
+
+
+def gather(indptr, positions):
+    """Entries of several CSR rows at once
+
+    Args:
+        indptr (np.ndarray): row offsets
+        positions (np.ndarray): rows to gather (-1 for none)
+
+    Returns:
+        tuple: (index in `positions`, entry index) of each entry of the gathered rows
+    """
+    found = np.flatnonzero(positions >= 0)
+    starts = indptr[positions[found]]
+    lengths = indptr[positions[found] + 1] - starts
+
+    owners = np.repeat(found, lengths)
+    # Offset of each entry within its row
+    offsets = np.arange(owners.shape[0]) - \
+        np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    return owners, np.repeat(starts, lengths) + offsets
+
+
+class Interactions:
+    """Interactions (`meta_user_content`) of users with the content of a media, grouped by user
+
+    Arrays follow a CSR layout: interactions of the i-th user of `user_ids` (sorted) are at `indptr[i]:indptr[i+1]`
+    of `content_ids`, `ratings` and `review_see_counts`, so getting the interactions of a user only costs a slice.
+
+    Within `Interactions.shared()` (ex: a whole `Recommend` run), interactions of every user are loaded once per media and shared by every engine of the run.
+    The cache is a context variable: other engines of the process (ex: a user run started by a request meanwhile) do not see it.
+    """
+    # Content type -> interactions, in the context of a run (engines capture the context they are created in, see `Engine`)
+    _shared = ContextVar("shared_interactions", default=None)
+
+    def __init__(self, user_ids, indptr, content_ids, ratings, review_see_counts):
+        """
+        Args:
+            user_ids (np.ndarray): uint32 sorted user ids
+            indptr (np.ndarray): int64 offsets of the interactions of each user
+            content_ids (np.ndarray): uint32 content id of each interaction
+            ratings (np.ndarray): uint8 rating of each interaction
+            review_see_counts (np.ndarray): uint16 review_see_count of each interaction
+        """
+        self.user_ids = user_ids
+        self.indptr = indptr
+        self.content_ids = content_ids
+        self.ratings = ratings
+        self.review_see_counts = review_see_counts
+
+    @classmethod
+    @contextmanager
+    def shared(cls):
+        """Share loaded interactions between every engine started inside the context
+        """
+        token = cls._shared.set({})
+        try:
+            yield
+        finally:
+            cls._shared.reset(token)
+
+    @classmethod
+    def load(cls, m, user_ids=None, chunksize=FEATURES_CHUNK_SIZE):
+        """Load interactions with a media in a single streamed query
+
+        Args:
+            m (Content): media
+            user_ids (list, optional): only load interactions of these users (ignored when interactions are shared). Defaults to None (all users).
+            chunksize (int, optional): number of rows streamed at once. Defaults to FEATURES_CHUNK_SIZE.
+
+        Returns:
+            Interactions: interactions grouped by user
+        """
+        key = str(m.content_type)
+        shared = cls._shared.get()
+        if shared is not None:
+            if key in shared:
+                return shared[key]
+            user_ids = None
+
+        st_time = datetime.utcnow()
+
+        user_filt = ''
+        if user_ids is not None:
+            if len(user_ids) == 0:
+                return cls.from_frame(pd.DataFrame(columns=["user_id", m.id, "rating", "review_see_count"]), m.id)
+            user_filt = "WHERE m.user_id IN (%s)" % ", ".join(
+                str(x) for x in user_ids)
+
+        query = 'SELECT m.user_id, m.%s, m.rating, m.review_see_count FROM "%s" AS m INNER JOIN "%s" AS c ON c.content_id = m.content_id INNER JOIN "%s" AS ct ON ct.content_id = c.content_id %s' % (
+            m.id, m.tablename_meta, m.tablename, m.content_type, user_filt)
+
+        chunks = []
+        with db.engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql_query(query, con=connection, chunksize=chunksize):
+                chunks.append(m._reduce_metadata_memory(df))
+
+        interactions = cls.from_frame(pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(
+            columns=["user_id", m.id, "rating", "review_see_count"]), m.id)
+
+        m.logger.debug("%s interactions loading performed in %s (%s users, %s interactions)" % (
+            m.content_type, datetime.utcnow()-st_time, interactions.user_ids.shape[0], interactions.content_ids.shape[0]))
+
+        if shared is not None:
+            shared[key] = interactions
+        return interactions
+
+    @classmethod
+    def from_frame(cls, df, media_id, user_id=0):
+        """Group the rows of a metadata dataframe by user
+
+        Args:
+            df (DataFrame): metadata (user_id, media id, rating, review_see_count)
+            media_id (str): name of the content id column
+            user_id (int, optional): user id of every row when there is no `user_id` column (ex: profile metadata). Defaults to 0.
+
+        Returns:
+            Interactions: interactions grouped by user
+        """
+        users = df["user_id"].to_numpy(dtype=np.uint32) if "user_id" in df.columns else np.full(
+            df.shape[0], user_id, dtype=np.uint32)
+        order = np.argsort(users, kind="stable")
+        user_ids, counts = np.unique(users[order], return_counts=True)
+
+        indptr = np.zeros(user_ids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(user_ids, indptr,
+                   df[media_id].to_numpy(dtype=np.uint32)[order],
+                   df["rating"].fillna(0).to_numpy(dtype=np.uint8)[order],
+                   df["review_see_count"].fillna(0).to_numpy(dtype=np.uint16)[order])
+
+    def rows(self, user_ids):
+        """Position of some users
+
+        Args:
+            user_ids (np.ndarray): user ids
+
+        Returns:
+            np.ndarray: position of each user in `user_ids`, -1 when it has no interaction
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        if self.user_ids.shape[0] == 0:
+            return np.full(user_ids.shape[0], -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(
+            self.user_ids, user_ids), self.user_ids.shape[0] - 1)
+        return np.where(self.user_ids[positions] == user_ids, positions, -1)
+
+    def user(self, user_id):
+        """Interactions of a user
+
+        Returns:
+            tuple: (content ids, ratings, review_see_counts) slices, empty if the user has no interaction
+        """
+        position = self.rows([user_id])[0]
+        if position < 0:
+            return self.content_ids[:0], self.ratings[:0], self.review_see_counts[:0]
+
+        start, end = self.indptr[position], self.indptr[position+1]
+        return self.content_ids[start:end], self.ratings[start:end], self.review_see_counts[start:end]
+
+    def lookup(self, user_ids):
+        """Interactions of several users
+
+        Args:
+            user_ids (np.ndarray): user ids
+
+        Returns:
+            tuple: (position in `user_ids`, interaction index) of each interaction of these users
+        """
+        return gather(self.indptr, self.rows(user_ids))
+
+    def to_frame(self, media_id):
+        """Metadata dataframe (user_id, media id, rating, review_see_count)
+
+        Args:
+            media_id (str): name of the content id column
+
+        Returns:
+            DataFrame: one row per interaction
+        """
+        return pd.DataFrame({
+            "user_id": np.repeat(self.user_ids, np.diff(self.indptr)),
+            media_id: self.content_ids,
+            "rating": self.ratings,
+            "review_see_count": self.review_see_counts,
+        })
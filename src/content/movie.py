@@ -15,30 +15,31 @@ class Movie(Content):
     def request_for_popularity(self):
         return super().request_for_popularity(self.content_type)
 
-    def get_with_genres(self):
+    def get_with_genres(self, content_ids=None, chunksize=None):
         """Get movie
 
         NOTE can add 't.rating' and 't.rating_count' column if we introduce popularity filter to content-based engine
             example: this recommender would take the 30 most similar item, calculate the popularity score and then return the top 10
 
+        Args:
+            content_ids (list, optional): only get these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
         Returns:
-            DataFrame: dataframe of movie data
+            DataFrame|iterator: dataframe of movie data
         """
-        self.df = pd.read_sql_query(
-            'SELECT t.content_id, t.title, t.language, t.actors, t.year, t.producers, t.director, t.writer, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id GROUP BY t.content_id' % (self.tablename, self.content_type), con=db.engine)
-
-        # Reduce memory
-        self.reduce_memory()
+        return self._read_sql(
+            'SELECT t.content_id, t.title, t.language, t.actors, t.year, t.producers, t.director, t.writer, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id %s GROUP BY t.content_id' % (self.tablename, self.content_type, self._content_filter(content_ids)), chunksize)
 
-        return self.df
-
-    def prepare_sim(self):
+    def _prepare_sim(self, movie_df):
         """Prepare movie data for content similarity process
 
+        Args:
+            movie_df (DataFrame): movie data (see `get_with_genres`)
+
         Returns:
             DataFrame: result dataframe
         """
-        movie_df = self.get_with_genres()
         movie_df["content_type"] = self.content_type
         # Remove '0' from year
         movie_df["year"] = movie_df["year"].astype(str)
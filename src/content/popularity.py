@@ -0,0 +1,88 @@
+import numpy as np
+
+# Popularity scorers by name, a media declares the one it uses with `__popularity_scorer__`
+scorers = {}
+
+
+def scorer(name):
+    """Register a popularity scorer
+
+    A scorer takes the dataframe returned by `request_for_popularity` (rated content only)
+    and returns the qualified content with a new 'popularity_score' column.
+
+    Args:
+        name (str): scorer name
+    """
+    def decorator(func):
+        scorers[name] = func
+        return func
+    return decorator
+
+
+def round_score(values, decimals=4):
+    """Columnar equivalent of `float(format(x, ".4f"))`
+
+    Args:
+        values (np.ndarray): scores
+        decimals (int, optional): number of decimals. Defaults to 4.
+
+    Returns:
+        np.ndarray: rounded scores
+    """
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 10**decimals
+    rounded = np.round(scaled) / 10**decimals
+
+    # Near ties depend on the exact binary value of the score, settle them like `format` does
+    tolerance = 1e-6 + np.abs(scaled) * 1e-14
+    ties = np.flatnonzero(
+        np.abs(scaled - np.floor(scaled) - .5) < tolerance)
+    rounded[ties] = [float(format(x, ".%sf" % decimals))
+                     for x in values[ties]]
+
+    return rounded
+
+
+def qualified(df, quantile=.9):
+    """Keep content with enough votes to be in the chart
+
+    Returns:
+        tuple: (qualified content, minimum number of votes)
+    """
+    m = df["rating_count"].quantile(quantile)
+    return df.copy().loc[df['rating_count'] >= m], m
+
+
+@scorer("imdb")
+def imdb_weighted_rating(df):
+    """IMDB measure of popularity: (v/(v+m) * R) + (m/(m+v) * C)
+
+    v is the number of votes, R the average rating, m the minimum number of votes to be in the chart and C the average rating of all content
+    """
+    c = df["rating"].mean()
+    q_df, m = qualified(df)
+
+    v = q_df["rating_count"].to_numpy(dtype=np.float64)
+    r = q_df["rating"].to_numpy(dtype=np.float64)
+    q_df["popularity_score"] = round_score((v/(v+m) * r) + (m/(m+v) * c))
+
+    return q_df
+
+
+@scorer("rating_count")
+def rating_count_plus_rating(df):
+    """Number of votes plus average rating (the IMDB measure does not seem to be relevant for some media)
+    """
+    q_df, _ = qualified(df)
+
+    q_df["popularity_score"] = round_score(q_df["rating_count"].to_numpy(
+        dtype=np.float64) + q_df["rating"].to_numpy(dtype=np.float64))
+
+    return q_df
+
+
+@scorer("recommendations")
+def recommendations(df):
+    """Number of recommendations, for media without any rating (cold start)
+    """
+    return df.assign(popularity_score=df['recommendations']).fillna(0)
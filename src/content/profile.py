@@ -62,42 +62,16 @@ class Profile:
         if profile_df.shape[0] == 0:
             return None
 
-        # Concat liked genre to list
-        def list_of_genre(genre_type):
-            res = list(genre_type["genres"])
-            if len(''.join(res)) == 0:
-                return ""
-            return res
-
-        profile_df = profile_df.fillna('')
-        profile_df = profile_df.groupby(
-            "user_id").apply(list_of_genre).reset_index()
-        profile_df.rename(columns={0: 'genres'}, inplace=True)
+        # One row per profile, and the weight of every genre in a single pass
+        owner_ids = np.unique(profile_df["user_id"].to_numpy())
+        liked = profile_df.dropna(subset=["genres"])
+
+        result = Genre.liked_weights(
+            owner_ids, liked["user_id"].to_numpy(), liked["genres"].to_numpy(), types, liked_weight)
+        result.insert(0, "user_id", owner_ids)
 
         # reduce memory
-        profile_df = cls.reduce_memory(profile_df)
-
-        # get genres list
-        genre_df = Genre.get_genres(types)
-        genre_df['name'] = genre_df['content_type'] + genre_df['name']
-        genre_df.drop(['content_type', 'genre_id'], axis=1, inplace=True)
-
-        result = profile_df.copy()
-        result.drop(["genres"], axis=1, inplace=True)
-
-        # For every row in the dataframe, iterate through the list of genres and place a (1 by default or 2) into the corresponding column
-        for index, row in profile_df.iterrows():
-            for g_index, g_row in genre_df.iterrows():
-                if g_row['name'] in row['genres']:
-                    result.at[index, g_row['name']] = liked_weight
-                else:
-                    result.at[index, g_row['name']] = 1
-
-        # Reduce memory
-        genre_cols = list(set(result.columns) -
-                          set(profile_df.columns))
-        for c in genre_cols:
-            result[c] = result[c].astype("uint8")
+        result = cls.reduce_memory(result)
 
         return result
 
@@ -0,0 +1,187 @@
+from src.utils import db
+from settings import FEATURES_CHUNK_SIZE
+from .interactions import gather
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+import pandas as pd
+import numpy as np
+
+
+class AlreadyRecommended:
+    """Media already recommended to each user (or group), by every engine, loaded from a recommendation table in a single query
+
+    Like `Interactions`, entries are grouped by owner: recommendations of the i-th owner of `owner_ids` (sorted) are at `indptr[i]:indptr[i+1]`
+    of `content_ids` (sorted within each owner) and `engine_codes` (position in `engines`).
+
+    Within `AlreadyRecommended.shared()`, the recommendations of a content type in a table are loaded once (for every owner)
+    and shared by every engine of the run until one of them writes to the table (see `refresh`).
+    Like `Interactions.shared`, the cache is a context variable: other engines of the process do not see it.
+    """
+    # (Table name, content type) -> recommendations, in the context of a run
+    _shared = ContextVar("shared_recommended", default=None)
+
+    def __init__(self, owner_ids, indptr, content_ids, engine_codes, engines):
+        """
+        Args:
+            owner_ids (np.ndarray): uint32 sorted user (or group) ids
+            indptr (np.ndarray): int64 offsets of the recommendations of each owner
+            content_ids (np.ndarray): uint32 recommended content id
+            engine_codes (np.ndarray): uint8 engine (position in `engines`) of each recommendation
+            engines (list): engine names
+        """
+        self.owner_ids = owner_ids
+        self.indptr = indptr
+        self.content_ids = content_ids
+        self.engine_codes = engine_codes
+        self.engines = engines
+
+    @classmethod
+    @contextmanager
+    def shared(cls):
+        """Share loaded tables between every engine started inside the context
+        """
+        token = cls._shared.set({})
+        try:
+            yield
+        finally:
+            cls._shared.reset(token)
+
+    @classmethod
+    def refresh(cls, tablename=None):
+        """Drop a shared table (it has been written), the next `load` reads it again
+
+        Args:
+            tablename (str, optional): recommendation table. Defaults to None (every table).
+        """
+        shared = cls._shared.get()
+        if shared is None:
+            return
+        if tablename is None:
+            shared.clear()
+        else:
+            for key in [key for key in shared if key[0] == tablename]:
+                del shared[key]
+
+    @classmethod
+    def load(cls, tablename, owner_id, media_id, content_type, owner_ids=None, chunksize=FEATURES_CHUNK_SIZE, logger=None):
+        """Load the recommendations of a content type from a recommendation table
+
+        Args:
+            tablename (str): recommendation table (ex: "recommended_content_for_group")
+            owner_id (str): name of the user (or group) id column
+            media_id (str): name of the content id column
+            content_type (ContentType): content type
+            owner_ids (list, optional): only load recommendations of these users (or groups) (ignored when tables are shared). Defaults to None (every owner).
+            chunksize (int, optional): number of rows streamed at once. Defaults to FEATURES_CHUNK_SIZE.
+            logger (Logger, optional): Defaults to None.
+
+        Returns:
+            AlreadyRecommended: recommendations grouped by owner
+        """
+        key = (tablename, str(content_type))
+        shared = cls._shared.get()
+        if shared is not None:
+            if key in shared:
+                return shared[key]
+            owner_ids = None
+
+        st_time = datetime.utcnow()
+
+        owner_filt = ''
+        if owner_ids is not None:
+            if len(owner_ids) == 0:
+                return cls(np.empty(0, dtype=np.uint32), np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint8), [])
+            owner_filt = " AND %s IN (%s)" % (
+                owner_id, ", ".join(str(int(x)) for x in owner_ids))
+
+        query = 'SELECT %s, %s, engine FROM "%s" WHERE content_type = \'%s\'%s' % (
+            owner_id, media_id, tablename, str(content_type).upper(), owner_filt)
+
+        owners, content_ids, engine_codes, engines = [], [], [], []
+        with db.engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql_query(query, con=connection, chunksize=chunksize):
+                owners.append(df[owner_id].to_numpy(dtype=np.uint32))
+                content_ids.append(df[media_id].to_numpy(dtype=np.uint32))
+
+                engines.extend(sorted(set(df["engine"]) - set(engines)))
+                engine_codes.append(pd.Categorical(
+                    df["engine"], categories=engines).codes.astype(np.uint8))
+
+        owners = np.concatenate(owners) if len(owners) > 0 else np.empty(0, dtype=np.uint32)
+        content_ids = np.concatenate(content_ids) if len(content_ids) > 0 else np.empty(0, dtype=np.uint32)
+        engine_codes = np.concatenate(engine_codes) if len(engine_codes) > 0 else np.empty(0, dtype=np.uint8)
+
+        order = np.lexsort((content_ids, owners))
+        owner_ids, counts = np.unique(owners[order], return_counts=True)
+        indptr = np.zeros(owner_ids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        recommended = cls(owner_ids, indptr,
+                          content_ids[order], engine_codes[order], engines)
+
+        if logger is not None:
+            logger.debug("%s %s loading performed in %s (%s owners, %s recommendations)" % (
+                tablename, content_type, datetime.utcnow()-st_time, owner_ids.shape[0], content_ids.shape[0]))
+
+        if shared is not None:
+            shared[key] = recommended
+        return recommended
+
+    def rows(self, owner_ids):
+        """Position of some users (or groups)
+
+        Args:
+            owner_ids (np.ndarray): user (or group) ids
+
+        Returns:
+            np.ndarray: position of each owner in `owner_ids`, -1 when nothing was recommended to it
+        """
+        owner_ids = np.asarray(owner_ids, dtype=np.int64)
+        if self.owner_ids.shape[0] == 0:
+            return np.full(owner_ids.shape[0], -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(
+            self.owner_ids, owner_ids), self.owner_ids.shape[0] - 1)
+        return np.where(self.owner_ids[positions] == owner_ids, positions, -1)
+
+    def _other_engines(self, engine):
+        """Mask of recommendations made by another engine than `engine`
+        """
+        if engine not in self.engines:
+            return np.ones(self.engine_codes.shape[0], dtype=bool)
+        return self.engine_codes != self.engines.index(engine)
+
+    def user(self, owner_id, engine):
+        """Media already recommended to a user (or group) by other engines
+
+        Args:
+            owner_id (int): user (or group) id
+            engine (str): engine name, its own recommendations are not returned
+
+        Returns:
+            np.ndarray: sorted content ids
+        """
+        position = self.rows([owner_id])[0]
+        if position < 0:
+            return self.content_ids[:0]
+
+        start, end = self.indptr[position], self.indptr[position+1]
+        return self.content_ids[start:end][self._other_engines(engine)[start:end]]
+
+    def lookup(self, owner_ids, engine):
+        """Media already recommended to several users (or groups) by other engines
+
+        Args:
+            owner_ids (np.ndarray): user (or group) ids
+            engine (str): engine name, its own recommendations are not returned
+
+        Returns:
+            tuple: (position in `owner_ids`, content id) of each recommendation
+        """
+        owners, index = gather(self.indptr, self.rows(owner_ids))
+
+        kept = self._other_engines(engine)[index]
+        return owners[kept], self.content_ids[index[kept]]
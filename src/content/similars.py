@@ -0,0 +1,175 @@
+from src.utils import db, directory_lock, swap_directory
+from settings import ENGINE_DATA_DIR, FEATURES_CHUNK_SIZE, SIMILARS_INDEX_MMAP
+from .interactions import gather
+
+from datetime import datetime
+
+import pandas as pd
+import numpy as np
+import json
+import uuid
+import os
+
+
+class SimilarsIndex:
+    """Similar content of every content of a media (`similars_content`), as an adjacency list
+
+    Arrays follow a CSR layout: similars of the i-th content of `content_ids` (sorted) are at `indptr[i]:indptr[i+1]`
+    of `targets`, `similarities` and `popularity_scores` (popularity of the similar content).
+
+    With `SIMILARS_INDEX_MMAP`, the index is saved in `<ENGINE_DATA_DIR>/similars/<content type>/` and memory-mapped by the next runs,
+    until similarities or popularity scores of the media are recomputed.
+    """
+    arrays = ["content_ids", "indptr", "targets",
+              "similarities", "popularity_scores"]
+
+    def __init__(self, content_ids, indptr, targets, similarities, popularity_scores):
+        """
+        Args:
+            content_ids (np.ndarray): uint32 sorted content ids
+            indptr (np.ndarray): int64 offsets of the similars of each content
+            targets (np.ndarray): uint32 similar content id
+            similarities (np.ndarray): float32 similarity
+            popularity_scores (np.ndarray): float32 popularity score of the similar content (0 if unknown)
+        """
+        self.content_ids = content_ids
+        self.indptr = indptr
+        self.targets = targets
+        self.similarities = similarities
+        self.popularity_scores = popularity_scores
+
+    @classmethod
+    def load(cls, m, directory=ENGINE_DATA_DIR, mmap=SIMILARS_INDEX_MMAP, chunksize=FEATURES_CHUNK_SIZE):
+        """Load the similars of a media in a single streamed query (or from disk)
+
+        Args:
+            m (Content): media
+            directory (str, optional): root directory of saved indexes. Defaults to ENGINE_DATA_DIR.
+            mmap (bool, optional): save the index and memory-map it. Defaults to SIMILARS_INDEX_MMAP.
+            chunksize (int, optional): number of rows streamed at once. Defaults to FEATURES_CHUNK_SIZE.
+
+        Returns:
+            SimilarsIndex: similars grouped by content
+        """
+        st_time = datetime.utcnow()
+        path = os.path.join(directory, "similars", str(m.content_type))
+
+        if mmap:
+            fingerprint = cls.fingerprint(m)
+            index = cls.open(path, fingerprint)
+            if index is not None:
+                return index
+
+        content_type = str(m.content_type).upper()
+        query = 'SELECT s.content_id0, s.content_id1, s.similarity, c.popularity_score FROM "%s" AS s INNER JOIN "%s" AS c ON c.content_id = s.content_id1 WHERE s.content_type0 = \'%s\' AND s.content_type1 = \'%s\'' % (
+            m.tablename_similars, m.tablename, content_type, content_type)
+
+        sources, targets, similarities, popularity_scores = [], [], [], []
+        with db.engine.connect().execution_options(stream_results=True) as connection:
+            for df in pd.read_sql_query(query, con=connection, chunksize=chunksize):
+                sources.append(df["content_id0"].to_numpy(dtype=np.uint32))
+                targets.append(df["content_id1"].to_numpy(dtype=np.uint32))
+                similarities.append(
+                    df["similarity"].to_numpy(dtype=np.float32))
+                popularity_scores.append(
+                    df["popularity_score"].fillna(0).to_numpy(dtype=np.float32))
+
+        index = cls.from_arrays(*[np.concatenate(x) if len(x) > 0 else np.empty(0, dtype=dtype) for x, dtype in [
+            (sources, np.uint32), (targets, np.uint32), (similarities, np.float32), (popularity_scores, np.float32)]])
+
+        m.logger.debug("%s similars index loading performed in %s (%s content, %s similars)" % (
+            m.content_type, datetime.utcnow()-st_time, index.content_ids.shape[0], index.targets.shape[0]))
+
+        if mmap:
+            index.save(path, fingerprint)
+            index = cls.open(path, fingerprint)
+        return index
+
+    @classmethod
+    def from_arrays(cls, sources, targets, similarities, popularity_scores):
+        """Group similar pairs by source content
+
+        Args:
+            sources (np.ndarray): content id
+            targets (np.ndarray): similar content id
+            similarities (np.ndarray): similarity
+            popularity_scores (np.ndarray): popularity score of the similar content
+
+        Returns:
+            SimilarsIndex: similars grouped by content
+        """
+        order = np.lexsort((targets, sources))
+        sources, targets = sources[order], targets[order]
+        similarities, popularity_scores = similarities[order], popularity_scores[order]
+
+        content_ids, counts = np.unique(sources, return_counts=True)
+        indptr = np.zeros(content_ids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(content_ids.astype(np.uint32), indptr, targets.astype(np.uint32),
+                   similarities.astype(np.float32), popularity_scores.astype(np.float32))
+
+    @staticmethod
+    def fingerprint(m):
+        """Last run of the engines the index is built from (similarities and popularity)
+        """
+        df = pd.read_sql_query(
+            'SELECT engine, last_launch_date FROM "engine" WHERE content_type = \'%s\' AND engine IN (\'ContentSimilarities\', \'Popularity\') ORDER BY engine' % str(m.content_type).upper(), con=db.engine)
+        return {row["engine"]: str(row["last_launch_date"]) for _, row in df.iterrows()}
+
+    @classmethod
+    def open(cls, path, fingerprint):
+        """Memory-map a saved index
+
+        Returns:
+            SimilarsIndex: None if there is no saved index for this fingerprint
+        """
+        with directory_lock(path):
+            if not os.path.isfile(os.path.join(path, "meta.json")):
+                return None
+            with open(os.path.join(path, "meta.json")) as f:
+                if json.load(f)["fingerprint"] != fingerprint:
+                    return None
+
+            return cls(*[np.load(os.path.join(path, "%s.npy" % name), mmap_mode="r") for name in cls.arrays])
+
+    def save(self, path, fingerprint):
+        """Write the index aside and swap it in (processes still reading the previous files keep a valid mapping, see `directory_lock`)
+        """
+        tmp_path = "%s.%s" % (path, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+
+        for name in self.arrays:
+            np.save(os.path.join(tmp_path, "%s.npy" % name), getattr(self, name))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"fingerprint": fingerprint}, f)
+
+        swap_directory(tmp_path, path)
+
+    def rows(self, content_ids):
+        """Position of some content
+
+        Args:
+            content_ids (np.ndarray): content ids
+
+        Returns:
+            np.ndarray: position of each content in `content_ids`, -1 when it has no similar
+        """
+        content_ids = np.asarray(content_ids, dtype=np.int64)
+        if self.content_ids.shape[0] == 0:
+            return np.full(content_ids.shape[0], -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(
+            self.content_ids, content_ids), self.content_ids.shape[0] - 1)
+        return np.where(self.content_ids[positions] == content_ids, positions, -1)
+
+    def neighbours(self, content_ids):
+        """Similars of several content, in a single gather
+
+        Args:
+            content_ids (np.ndarray): content ids
+
+        Returns:
+            tuple: (position in `content_ids`, similar index) of each similar of these content
+        """
+        return gather(self.indptr, self.rows(content_ids))
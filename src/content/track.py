@@ -8,6 +8,9 @@ import numpy as np
 class Track(Content):
     content_type = ContentType.TRACK
 
+    # NOTE IMDB measure of popularity does not seem to be relevant for this media.
+    __popularity_scorer__ = "rating_count"
+
     # For similarities between different content (different content type)
     cmp_column_name = "title"
     other_content_cmp = [ContentType.MOVIE, ContentType.SERIE]
@@ -15,44 +18,31 @@ class Track(Content):
     def request_for_popularity(self):
         return super().request_for_popularity(self.content_type)
 
-    def calc_popularity_score(self, df):
-        # NOTE IMDB measure of popularity does not seem to be relevant for this media.
-
-        # Calculate the minimum number of votes required to be in the chart
-        m = df["rating_count"].quantile(0.90)
-
-        # Filter out all qualified media into a new DataFrame
-        q_df = df.copy().loc[df['rating_count'] >= m]
-
-        q_df['popularity_score'] = q_df.apply(
-            lambda x: float(format(x["rating_count"] + x["rating"], ".4f")), axis=1, result_type="reduce")
-
-        return q_df
-
-    def get_with_genres(self):
+    def get_with_genres(self, content_ids=None, chunksize=None):
         """Get track
 
         NOTE can add 't.rating' and 't.rating_count' column if we introduce popularity filter to content-based engine
             example: this recommender would take the 30 most similar item, calculate the popularity score and then return the top 10
 
+        Args:
+            content_ids (list, optional): only get these content. Defaults to None (all).
+            chunksize (int, optional): stream DataFrames of `chunksize` rows instead of a single one. Defaults to None.
+
         Returns:
-            DataFrame: dataframe of track data
+            DataFrame|iterator: dataframe of track data
         """
-        self.df = pd.read_sql_query(
-            'SELECT t.content_id, t.title, t.year, t.artist_name, t.release, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id GROUP BY t.content_id' % (self.tablename, self.content_type), con=db.engine)
-
-        # Reduce memory
-        self.reduce_memory()
+        return self._read_sql(
+            'SELECT t.content_id, t.title, t.year, t.artist_name, t.release, string_agg(ge.name, \',\') AS genres FROM "%s" AS c INNER JOIN "%s" AS t ON t.content_id = c.content_id LEFT OUTER JOIN "content_genres" AS cg ON cg.content_id = c.content_id LEFT OUTER JOIN "genre" AS ge ON ge.genre_id = cg.genre_id %s GROUP BY t.content_id' % (self.tablename, self.content_type, self._content_filter(content_ids)), chunksize)
 
-        return self.df
-
-    def prepare_sim(self):
+    def _prepare_sim(self, track_df):
         """Prepare track data for content similarity process
 
+        Args:
+            track_df (DataFrame): track data (see `get_with_genres`)
+
         Returns:
             DataFrame: result dataframe
         """
-        track_df = self.get_with_genres()
         track_df["content_type"] = self.content_type
         # Transform genres str to list
         track_df["genres"] = track_df["genres"].apply(
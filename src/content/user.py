@@ -33,7 +33,7 @@ class User:
         if user_uuid is not None:
             usr = "AND uuid = '%s'" % user_uuid
         elif user_id_list != []:
-            usr = "AND u.user_id IN (%s)" % (', '.join(user_id_list))
+            usr = "AND user_id IN (%s)" % (', '.join(str(x) for x in user_id_list))
 
         user_df = pd.read_sql_query(
             'SELECT user_id FROM "user" WHERE password_hash <> \'no_pwd\' %s' % usr, con=db.engine)
@@ -68,7 +68,7 @@ class User:
         if user_uuid is not None:
             usr = "AND u.uuid = '%s'" % user_uuid
         elif user_id_list != []:
-            usr = "AND u.user_id IN (%s)" % (', '.join(user_id_list))
+            usr = "AND u.user_id IN (%s)" % (', '.join(str(x) for x in user_id_list))
 
         user_df = pd.read_sql_query(
             'SELECT u.user_id, g.content_type || g.name AS genres FROM "user" AS u LEFT OUTER JOIN "liked_genres" AS lg ON u.user_id = lg.user_id LEFT OUTER JOIN "genre" AS g ON g.genre_id = lg.genre_id %s WHERE password_hash <> \'no_pwd\' %s' % (filt, usr), con=db.engine)
@@ -76,40 +76,15 @@ class User:
         if user_df.shape[0] == 0:
             return None
 
-        # Concat liked genre to list
-        def list_of_genre(genre_type):
-            res = list(genre_type["genres"])
-            if len(''.join(res)) == 0:
-                return ""
-            return res
+        # One row per user, and the weight of every genre in a single pass
+        owner_ids = np.unique(user_df["user_id"].to_numpy())
+        liked = user_df.dropna(subset=["genres"])
 
-        user_df = user_df.fillna('')
-        user_df = user_df.groupby("user_id").apply(list_of_genre).reset_index()
-        user_df.rename(columns={0: 'genres'}, inplace=True)
+        result = Genre.liked_weights(
+            owner_ids, liked["user_id"].to_numpy(), liked["genres"].to_numpy(), types, liked_weight)
+        result.insert(0, "user_id", owner_ids)
 
         # reduce memory
-        user_df = cls.reduce_memory(user_df)
-
-        # get genres list
-        genre_df = Genre.get_genres(types)
-        genre_df['name'] = genre_df['content_type'] + genre_df['name']
-        genre_df.drop(['content_type', 'genre_id'], axis=1, inplace=True)
-
-        result = user_df.copy()
-        result.drop(["genres"], axis=1, inplace=True)
-
-        # For every row in the dataframe, iterate through the list of genres and place a (1 by default or 2) into the corresponding column
-        for index, row in user_df.iterrows():
-            for g_index, g_row in genre_df.iterrows():
-                if g_row['name'] in row['genres']:
-                    result.at[index, g_row['name']] = liked_weight
-                else:
-                    result.at[index, g_row['name']] = 1
-
-        # Reduce memory
-        genre_cols = list(set(result.columns) -
-                          set(user_df.columns))
-        for c in genre_cols:
-            result[c] = result[c].astype("uint8")
+        result = cls.reduce_memory(result)
 
         return result
@@ -5,3 +5,5 @@ from .link_between_items import LinkBetweenItems
 from .collaborative_filtering import CollaborativeFiltering
 from .from_profile import FromProfile
 from .from_similar_content import FromSimilarContent
+
+from .serving import ProfileServing, UserServing
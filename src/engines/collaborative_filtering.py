@@ -1,5 +1,5 @@
-from src.content import User, ContentType
-from src.utils import db, sc
+from src.content import User, ContentType, Interactions, AlreadyRecommended
+from src.utils import db, spark_context, BulkWriter, batched, recommendations_cache
 from .engine import Engine
 
 from datetime import datetime
@@ -9,62 +9,77 @@ from pyspark.ml.feature import StringIndexer
 from pyspark.ml.recommendation import ALS
 
 import pandas as pd
+import numpy as np
 
 
 class CollaborativeFiltering(Engine):
     __engine_priority__ = 5
+    __reads__ = ["meta_user_content", "recommended_content"]
+    __writes__ = ["recommended_content"]
+    __memory__ = 2048
+    # Media share the SparkContext of the service (it can not be used from a worker process)
+    __media_fan_out__ = "thread"
     max_nb_elem = 10
 
     def train(self):
         if self.check_if_necessary() is False:
             return
 
-        for media in self.__media__:
-            st_time = datetime.utcnow()
-            m = media(logger=self.logger)
+        self.for_each_media(self.train_media, medias=[media for media in self.__media__ if media.content_type not in [
+            ContentType.GAME,  # no ratings
+            ContentType.SERIE,  # too much ratings
+            ContentType.MOVIE  # too much ratings
+        ]])
 
-            if m.content_type in [
-                ContentType.GAME,  # no ratings
-                ContentType.SERIE,  # too much ratings
-                ContentType.MOVIE  # too much ratings
-            ]:
-                continue
+    def train_media(self, media):
+        """Recommend content of a media from an ALS model of its ratings
 
-            sqlContext = SQLContext(sc)
+        Args:
+            media (type): media class
+        """
+        st_time = datetime.utcnow()
+        m = media(logger=self.logger)
 
-            df = m.get_meta(cols=['user_id', m.id, 'rating'])
+        sqlContext = SQLContext(spark_context())
 
-            # Convert Pandas DF to PySpark DF
-            sparkDF = sqlContext.createDataFrame(df)
+        df = Interactions.load(m).to_frame(m.id)[['user_id', m.id, 'rating']]
 
-            als = ALS(userCol="user_id", itemCol=m.id,
-                      ratingCol="rating", coldStartStrategy="drop")
-            model = als.fit(sparkDF)
+        # Convert Pandas DF to PySpark DF
+        sparkDF = sqlContext.createDataFrame(df)
 
-            user_df = User.get()
+        als = ALS(userCol="user_id", itemCol=m.id,
+                  ratingCol="rating", coldStartStrategy="drop")
+        model = als.fit(sparkDF)
 
-            # Check if is empty
-            if user_df.shape[0] == 0:
-                continue
+        user_df = User.get()
 
-            modelGest = model.recommendForUserSubset(
-                sqlContext.createDataFrame(user_df), self.max_nb_elem)
+        # Check if is empty
+        if user_df.shape[0] == 0:
+            return
+
+        modelGest = model.recommendForUserSubset(
+            sqlContext.createDataFrame(user_df), self.max_nb_elem)
+
+        writer = BulkWriter(m.tablename_recommended, ["user_id", m.id, "score", "engine", "engine_priority", "content_type"],
+                            on_conflict="ON CONFLICT ON CONSTRAINT recommended_content_pkey DO NOTHING", logger=self.logger,
+                            reset=lambda session, user_ids: self.reset_recommended(m, user_ids, session))
+
+        len_values = 0
+        owners = []
+        with self.writes("%s %s" % (self.__class__.__name__, m.content_type)) as stage:
 
-            len_values = 0
+            recommended = AlreadyRecommended.load(
+                m.tablename_recommended, "user_id", m.id, m.content_type, logger=self.logger)
 
             for user in modelGest.collect():
                 # Do not recommend already recommended content
-                already_recommended_media = []
-                with db as session:
-                    result = session.execute('SELECT %s FROM "%s" WHERE user_id = \'%s\' AND engine <> \'%s\'' % (
-                        m.id, m.tablename_recommended, user.user_id, self.__class__.__name__))
-                    already_recommended_media = [
-                        dict(row)[m.id] for row in result]
+                ids = [int(rating[m.id]) for rating in user.recommendations]
+                excluded = np.isin(ids, recommended.user(
+                    user.user_id, self.__class__.__name__))
 
                 values = []
-                for rating in user.recommendations:
-                    id = int(rating[m.id])
-                    if id in already_recommended_media:
+                for rating, id, is_excluded in zip(user.recommendations, ids, excluded):
+                    if is_excluded:
                         continue
                     values.append(
                         {
@@ -74,26 +89,36 @@ class CollaborativeFiltering(Engine):
                             "score": float(rating.rating / 5),
                             "engine": self.__class__.__name__,
                             "engine_priority": self.__engine_priority__,
+                            "content_type": str(m.content_type).upper(),
                         }
                     )
 
                 len_values += len(values)
 
-                with db as session:
-                    # Reset list of recommended `media` for this engine
-                    session.execute(text('DELETE FROM "%s" WHERE user_id = %s AND engine = \'%s\' AND content_type = \'%s\'' % (
-                        m.tablename_recommended, user.user_id, self.__class__.__name__, str(m.content_type).upper())))
-
-                    if len(values) > 0:
-                        markers = ':user_id, :%s, :score, :engine, :engine_priority' % m.id
-                        ins = 'INSERT INTO {tablename} VALUES ({markers}) ON CONFLICT ON CONSTRAINT recommended_content_pkey DO NOTHING'
-                        ins = ins.format(
-                            tablename=m.tablename_recommended, markers=markers)
-                        session.execute(ins, values)
-
-            self.logger.info("%s recommendation from collaborative filtering performed in %s (%s lines)" % (
-                m.content_type, datetime.utcnow()-st_time, len_values))
-            self.store_date(m.content_type)
+                # Previous recommendations of the user are replaced in the same transaction
+                stage.submit(writer.write, values, [int(user.user_id)])
+                owners.append(int(user.user_id))
+
+            stage.submit(writer.close)
+        AlreadyRecommended.refresh(m.tablename_recommended)
+        recommendations_cache.invalidate(owners)
+
+        self.add_rows(len_values)
+        self.logger.info("%s recommendation from collaborative filtering performed in %s (%s lines)" % (
+            m.content_type, datetime.utcnow()-st_time, len_values))
+        self.store_date(m.content_type)
+
+    def reset_recommended(self, m, user_ids, session):
+        """Reset list of recommended `media` of some users for this engine
+
+        Args:
+            m (Content): media
+            user_ids (list): user ids
+            session (Session): session of the flush writing their new recommendations (see `BulkWriter`)
+        """
+        for batch in batched(user_ids, 10_000):
+            session.execute(text('DELETE FROM "%s" WHERE user_id IN (%s) AND engine = \'%s\' AND content_type = \'%s\'' % (
+                m.tablename_recommended, ", ".join(str(x) for x in batch), self.__class__.__name__, str(m.content_type).upper())))
 
     def check_if_necessary(self):
         df = pd.read_sql_query(
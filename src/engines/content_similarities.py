@@ -1,10 +1,10 @@
-from src.utils import db, sc, parallelize_matrix, broadcast_matrix, find_matches_in_submatrix
+from src.utils import db, BulkWriter, SparkRecords, tfidf_from_counts, find_matches, batched, top_k_similarities, padded_top_k, merge_top_k, similarity_records, SimilarityState
+from settings import SIMILARITY_VOCABULARY_DRIFT, SIMILARITY_RAM_BUDGET, SIMILARITY_BACKEND, SIMILARITY_BACKEND_BY_TYPE
 from .engine import Engine
 
-from scipy.sparse import csr_matrix
-
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 from sqlalchemy import text
+from contextlib import closing
+from scipy.sparse import vstack
 from datetime import datetime
 import pandas as pd
 import numpy as np
@@ -14,93 +14,251 @@ class ContentSimilarities(Engine):
     """(Re-)Set similarity score between to item (for each media)
 
     The main purpose it to recommend similar items based on a particular item
+
+    When only a few items were added since the last run, the fitted TF-IDF model and top-k similars of the previous run are reused:
+    only new items are vectorized, and only their similars and the similars of the items they enter the top-k of are rewritten.
     """
+    __reads__ = ["content", "genre"]
+    __writes__ = ["similars_content"]
+    __memory__ = SIMILARITY_RAM_BUDGET
+    # The SparkContext of the service can not be used from a worker process
+    __media_fan_out__ = "thread" if "spark" in [
+        SIMILARITY_BACKEND, *SIMILARITY_BACKEND_BY_TYPE.values()] else "process"
+    threshold = .5
+    max_sim = 10
 
     def train(self):
         """(Re)load similarity score between item
         """
-        if self.check_if_necessary() is False:
+        changes = self.check_if_necessary()
+        if changes is False:
             return
+
+        self.changes = changes
+        self.for_each_media(self.train_media, medias=[
+            media for media in self.__media__ if media in changes])
+
+    def train_media(self, media):
+        """Update (or rebuild, see `changes`) the similarity scores of a media
+
+        Args:
+            media (type): media class
+        """
+        m = media(logger=self.logger)
+        state = SimilarityState(self.__class__.__name__, m.content_type)
+
+        if self.changes[media] or not state.load() or not self.update(m, state):
+            self.rebuild(m, state)
+        self.store_date(m.content_type)
+
+    def rebuild(self, m, state):
+        """Compute similarity score between every item of a media
+
+        Args:
+            m (Content): media
+            state (SimilarityState): state of the previous run, replaced by the new one
+        """
+        st_time = datetime.utcnow()
+        state.reset()
+
+        store = m.features("soup")
+
+        self.logger.debug("%s features loading performed in %s" %
+                          (m.content_type, datetime.utcnow()-st_time))
+
+        tfidf, idf = tfidf_from_counts(store.counts)
+
+        self.logger.debug("%s TF-IDF transformation performed in %s" %
+                          (m.content_type, datetime.utcnow()-st_time))
+
+        # Content id and type of each TF-IDF row (indexed by position)
+        content_ids = np.asarray(store.content_ids)
+        content_types = np.full(
+            content_ids.shape[0], m.content_type.code, dtype=np.uint8)
+
+        values = find_matches(
+            tfidf,
+            content_ids=content_ids,
+            content_types=content_types,
+            real_indice_name=m.id,
+            content_type=(m.content_type, m.content_type),
+            threshold=self.threshold,
+            max_sim=self.max_sim,
+            logger=self.logger,
+            state=state)
+
+        # Records not consumed (failed write) hold Spark broadcasts, or blocked similarities files
+        with closing(values), self.writes("%s %s" % (self.__class__.__name__, m.content_type)) as stage:
+            stage.submit(self.delete, m)
+            len_values = self.insert(m, values, stage)
+
+        # The spark backend does not give back raw similars: no incremental update after it
+        if state.has_similars():
+            state.save(store.generation, idf, content_ids)
+
+        self.add_rows(len_values)
+        self.logger.info("%s similarity reloading performed in %s (%s lines)" %
+                         (m.content_type, datetime.utcnow()-st_time, len_values))
+
+    def update(self, m, state):
+        """Add new items to the similarity scores of a media, reusing the state of the previous run
+
+        Args:
+            m (Content): media
+            state (SimilarityState): loaded state of the previous run
+
+        Returns:
+            bool: False if a full rebuild is needed (vocabulary drift)
+        """
+        st_time = datetime.utcnow()
+        store = m.features("soup")
+        if store.generation != state.generation:
+            # Feature store rebuilt (content changed or removed)
+            return False
+
+        old_rows = store.rows(state.content_ids)
+        if (old_rows < 0).any():
+            return False
+        # New items: content ids of the store (first row of each) the previous run did not have
+        store_ids, first_rows = np.unique(store.content_ids, return_index=True)
+        new_rows = np.sort(
+            first_rows[~np.isin(store_ids, state.content_ids)])
+        if new_rows.shape[0] == 0:
+            return True
+
+        n_fitted = state.idf.shape[0]
+        counts = store.counts
+        new_counts = counts[new_rows]
+
+        # Tokens out of the fitted vocabulary
+        oov_ratio = new_counts[:, n_fitted:].sum() / max(1, new_counts.sum())
+        n_old, n_new = old_rows.shape[0], new_rows.shape[0]
+
+        # Items added since the model was fitted (IDF is not updated by incremental runs)
+        growth = (n_old + n_new - state.fitted_rows) / \
+            max(1, state.fitted_rows)
+        if max(oov_ratio, growth) > SIMILARITY_VOCABULARY_DRIFT:
+            self.logger.info("%s vocabulary drift (%.1f%% unknown tokens, +%.1f%% items), full rebuild" %
+                             (m.content_type, 100 * oov_ratio, 100 * growth))
+            return False
+
+        old_tfidf = tfidf_from_counts(counts[old_rows][:, :n_fitted], state.idf)[0]
+        new_tfidf = tfidf_from_counts(new_counts[:, :n_fitted], state.idf)[0]
+        tfidf = vstack([old_tfidf, new_tfidf]).tocsr()
+        content_ids = np.concatenate(
+            [state.content_ids, store.content_ids[new_rows]])
+        content_types = np.full(
+            content_ids.shape[0], m.content_type.code, dtype=np.uint8)
+        k = state.targets.shape[1]
+
+        # Similars of new items, among all items
+        rows, cols, sims = top_k_similarities(
+            new_tfidf, tfidf.T.tocsr(), k=k, threshold=self.threshold)
+        new_targets, new_sims = padded_top_k(rows, cols, sims, n_new, k)
+
+        # Reverse edges: new items entering the top-k of an old item
+        rows, cols, sims = top_k_similarities(
+            old_tfidf, new_tfidf.T.tocsr(), k=k, threshold=self.threshold)
+        targets, similarities = merge_top_k(
+            state.targets, state.similarities, *padded_top_k(rows, cols + n_old, sims, n_old, k))
+        changed = np.flatnonzero((targets >= n_old).any(axis=1))
+
+        targets = np.concatenate([targets, new_targets])
+        similarities = np.concatenate([similarities, new_sims])
+        source_rows = np.concatenate(
+            [changed, np.arange(n_old, n_old + n_new)])
+
+        sources = np.broadcast_to(
+            source_rows[:, None], (source_rows.shape[0], k))
+        valid = targets[source_rows] >= 0
+        values = similarity_records(sources[valid], targets[source_rows][valid], similarities[source_rows][valid],
+                                    content_ids, content_types, m.id, (m.content_type, m.content_type))
+
+        with self.writes("%s %s" % (self.__class__.__name__, m.content_type)) as stage:
+            stage.submit(self.delete, m, content_ids[changed].tolist())
+            len_values = self.insert(m, values, stage)
+
+        state.reset()
+        state.save_similars(targets, similarities)
+        state.save(state.generation, state.idf, content_ids,
+                   fitted_rows=state.fitted_rows)
+
+        self.add_rows(len_values)
+        self.logger.info("%s similarity update performed in %s (%s new items, %s updated items, %s lines)" %
+                         (m.content_type, datetime.utcnow()-st_time, n_new, changed.shape[0], len_values))
+        return True
+
+    def delete(self, m, content_ids=None):
+        """Delete similarity records of a media
+
+        Args:
+            m (Content): media
+            content_ids (list, optional): only delete the similars of these items. Defaults to None (all).
+        """
         with db as session:
-            session.execute(
-                text('DELETE FROM "%s" WHERE content_type0 = content_type1' % (self.__media__[0].tablename_similars)))
+            if content_ids is None:
+                session.execute(
+                    text('DELETE FROM "%s" WHERE content_type0 = \'%s\' AND content_type1 = \'%s\'' % (m.tablename_similars, str(m.content_type).upper(), str(m.content_type).upper())))
+                return
 
-        for media in self.__media__:
-            st_time = datetime.utcnow()
-            m = media(logger=self.logger)
-
-            df = m.prepare_sim()[:100_000]
-            # FIXME limitation of dataframe (Let's go to bigdata...), we juste need a cluster (currently, we use spark standalone)
-
-            # Pre-calculate voc
-            vect = CountVectorizer(stop_words="english")
-            # This can be done with less memory overhead by using generator
-            vocabulary = vect.fit(df["soup"]).vocabulary_
-
-            tfidf = TfidfVectorizer(
-                stop_words="english", vocabulary=vocabulary, dtype=np.float32)
-
-            self.logger.debug("%s data preparation performed in %s" %
-                              (m.content_type, datetime.utcnow()-st_time))
-
-            # Construct the required TF-IDF matrix by fitting and transforming the data
-            tfidf_matrix = tfidf.fit_transform(df['soup'])
-
-            self.logger.debug("%s TF-IDF transformation performed in %s" %
-                              (m.content_type, datetime.utcnow()-st_time))
-
-            # Reset index of your main DataFrame and construct reverse mapping as before
-            df = df.reset_index()
-            indices = pd.Series(
-                df.index,
-                index=zip(df[m.id], df["content_type"])
-            )
-
-            tfidf_mat_para = parallelize_matrix(
-                tfidf_matrix, rows_per_chunk=100)
-            tfidf_mat_dist = broadcast_matrix(tfidf_matrix)
-
-            values = tfidf_mat_para.flatMap(lambda submatrix: find_matches_in_submatrix(
-                sources=csr_matrix(submatrix[1], shape=submatrix[2]),
-                targets=tfidf_mat_dist,
-                inputs_start_index=submatrix[0],
-                indices=indices,
-                real_indice_name=m.id,
-                content_type=(m.content_type, m.content_type))
-            ).collect()
-
-            self.logger.debug("%s cosine sim performed in %s" %
-                              (str(m.content_type), datetime.utcnow()-st_time))
-
-            if len(values) > 0:
-                with db as session:
-                    markers = ':%s0, :%s1, :similarity, :content_type0, :content_type1' % (
-                        m.id, m.id)
-                    ins = 'INSERT INTO {tablename} VALUES ({markers})'
-                    ins = ins.format(
-                        tablename=m.tablename_similars, markers=markers)
-                    session.execute(ins, values)
-
-            self.logger.info("%s similarity reloading performed in %s (%s lines)" %
-                             (m.content_type, datetime.utcnow()-st_time, len(values)))
-            self.store_date(m.content_type)
+            for batch in batched(content_ids, 10_000):
+                session.execute(
+                    text('DELETE FROM "%s" WHERE content_type0 = \'%s\' AND content_type1 = \'%s\' AND %s0 IN (%s)' % (
+                        m.tablename_similars, str(m.content_type).upper(), str(m.content_type).upper(), m.id, ", ".join(str(x) for x in batch))))
+
+    def insert(self, m, values, stage):
+        """Insert similarity records, batches are written by the writer stage while next records are computed
+
+        Args:
+            m (Content): media
+            values (iterable): similarity records
+            stage (WriterStage): writer stage of the engine
+
+        Returns:
+            int: number of inserted lines
+        """
+        columns = ["%s0" % m.id, "%s1" % m.id,
+                   "similarity", "content_type0", "content_type1"]
+        if isinstance(values, SparkRecords) and values.write == "executors":
+            # Partitions are written by the Spark executors, once previous writes are done
+            stage.wait()
+            return values.copy(m.tablename_similars, columns, logger=self.logger)
+
+        writer = BulkWriter(m.tablename_similars, columns, logger=self.logger)
+
+        len_values = 0
+        for batch in batched(values, writer.batch_size):
+            stage.submit(writer.write, batch)
+            len_values += len(batch)
+        stage.submit(writer.close)
+
+        return len_values
 
     def check_if_necessary(self):
+        """Find media with new items since the last run
+
+        New items are found from the feature store (see `update`), events only tell which media changed.
+
+        Returns:
+            dict|bool: media to update, True when a full rebuild is needed, False if there is nothing to do
+        """
+        changes = {}
         for media in self.__media__:
             df = pd.read_sql_query(
                 'SELECT last_launch_date FROM "engine" WHERE engine = \'%s\' AND content_type = \'%s\'' % (self.__class__.__name__, str(media.content_type).upper()), con=db.engine)
 
             if df.shape[0] == 0:
                 # means that this engine has never been launched.
-                return True
+                changes[media] = True
+                continue
 
             last_launch_date = df.iloc[0]["last_launch_date"]
 
             df = pd.read_sql_query(
-                'SELECT COUNT(*) AS c FROM "%s_added_event" WHERE occured_at > \'%s\'' % (media.content_type, last_launch_date), con=db.engine)
+                'SELECT object_id AS content_id FROM "%s_added_event" WHERE occured_at > \'%s\' LIMIT 1' % (media.content_type, last_launch_date), con=db.engine)
 
-            if df.iloc[0]["c"] != 0:
+            if df.shape[0] != 0:
                 # New change occured
-                return True
+                changes[media] = False
 
-        return False
+        return changes if len(changes) > 0 else False
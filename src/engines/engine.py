@@ -1,29 +1,151 @@
-from src.content import Application, Book, Game, Movie, Serie, Track
-from src.utils import db
+from src.content import Application, Book, Game, Movie, Serie, Track, AlreadyRecommended
+from src.utils import db, recommendations_cache, process_pool, run_task
+from settings import ENGINE_WRITER_QUEUE_SIZE, MEDIA_WORKERS
 
-from threading import Thread
+from threading import Thread, Lock
 from datetime import datetime
-from flask import current_app
+from flask import current_app, has_app_context
 from abc import ABCMeta, abstractmethod
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
+import contextvars
 import traceback
+import logging
+import queue
+import uuid
+
+class WriterStage:
+    """Run the database writes of an engine in a dedicated thread, fed through a bounded queue
+
+    Writes are run in submission order, while the engine keeps computing the next results.
+    When `maxsize` writes are pending, `submit` blocks the engine (back-pressure): memory held by pending results stays bounded.
+    A failed write stops the stage, its exception is raised in the engine by the next `submit` (or on exit).
+    """
+
+    def __init__(self, app, logger, name="writer", maxsize=ENGINE_WRITER_QUEUE_SIZE):
+        """
+        Args:
+            app (Flask): application (writes are run in its context)
+            logger (Logger): logger used to report the stage timings
+            name (str, optional): name of the stage in the log. Defaults to "writer".
+            maxsize (int, optional): maximum number of pending writes. Defaults to ENGINE_WRITER_QUEUE_SIZE.
+        """
+        self.app = app
+        self.logger = logger
+        self.name = name
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.error = None
+
+        self.write_time = 0
+        self.wait_time = 0
+
+    def __enter__(self):
+        self.st_time = perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, err, message, traceback):
+        self.queue.put(None)
+        self.thread.join()
+
+        self.logger.debug("%s: writes performed in %.1fs (%.1fs writing, %.1fs waiting for the writer)" % (
+            self.name, perf_counter() - self.st_time, self.write_time, self.wait_time))
+
+        if err is None and self.error is not None:
+            raise self.error
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a write, block while the queue is full
+
+        Args:
+            func (callable): write function, called as `func(*args, **kwargs)` in the writer thread
+        """
+        if self.error is not None:
+            raise self.error
+
+        st_time = perf_counter()
+        self.queue.put((func, args, kwargs))
+        self.wait_time += perf_counter() - st_time
+
+    def wait(self):
+        """Block until every submitted write is done
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        with self.app.app_context():
+            while True:
+                task = self.queue.get()
+                if task is None:
+                    self.queue.task_done()
+                    return
+                if self.error is not None:
+                    # Drain the queue, the engine gets the error on its next submit
+                    self.queue.task_done()
+                    continue
+
+                func, args, kwargs = task
+                st_time = perf_counter()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    traceback.print_exc()
+                    self.error = e
+                self.write_time += perf_counter() - st_time
+                self.queue.task_done()
 
 
 class Engine(Thread, metaclass=ABCMeta):
     __media__ = [Application, Book, Game, Movie, Serie, Track]
+    # Tables read and written by the engine, engines of a pipeline are ordered by them (see `DagScheduler`)
+    __reads__ = []
+    __writes__ = []
+    # Rough peak memory of a run (MB), checked against the memory budget of a pipeline
+    __memory__ = 512
+    # How `for_each_media` runs media concurrently: "thread" (I/O bound engines) or "process" (CPU bound engines, or engines keeping per media state in attributes)
+    __media_fan_out__ = "thread"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.app = current_app._get_current_object()
+        # Context of the caller, the run sees the tables it shares (ex: `Interactions.shared` of a pipeline), and only them
+        self._context = contextvars.copy_context()
         self.logger = current_app.logger
         self.status = None
         self.error = None
+        # Number of written lines (see `add_rows`)
+        self.rows = 0
+        self._rows_lock = Lock()
+        self.duration = None
+        # Media whose run failed, with their error (see `for_each_media`)
+        self.failed_media = {}
+        # Job of the run, notified once it is over (see `Job.finish`)
+        self.job = None
+
+    def __getstate__(self):
+        # Engines are pickled for worker processes (see `process_pool`): only their data, not their thread, application, logger or locks
+        return {name: value for name, value in self.__dict__.items()
+                if not name.startswith("_") and name not in ["app", "logger", "job"]}
+
+    def __setstate__(self, state):
+        Thread.__init__(self)
+        self.__dict__.update(state)
+        self.app = current_app._get_current_object() if has_app_context() else None
+        self.logger = self.app.logger if self.app is not None else logging.getLogger(
+            self.__class__.__name__)
+        self._rows_lock = Lock()
+        self.job = None
 
     def run(self):
         st_time = datetime.utcnow()
         with self.app.app_context():
             try:
-                self.train()
+                self._context.run(self.train)
             except Exception as e:
                 traceback.print_exc()
                 self.logger.error("Exception %s", e)
@@ -31,8 +153,132 @@ class Engine(Thread, metaclass=ABCMeta):
                 self.error = e
             else:
                 self.status = True
+                if len(self.failed_media) > 0:
+                    self.status = False
+                    self.error = Exception("%s failed for %s" % (self.__class__.__name__, ", ".join(
+                        str(media.content_type) for media in self.failed_media)))
+        self.duration = datetime.utcnow()-st_time
         self.logger.info("%s engine performed in %s" %
-                         (self.__class__.__name__, datetime.utcnow()-st_time))
+                         (self.__class__.__name__, self.duration))
+
+        if self.job is not None:
+            self.job.finish()
+
+    @classmethod
+    def tables(cls, **kwargs):
+        """Tables read and written by a run of the engine
+
+        Args:
+            kwargs: engine arguments
+
+        Returns:
+            tuple: (read tables, written tables) sets
+        """
+        return set(cls.__reads__), set(cls.__writes__)
+
+    def add_rows(self, count):
+        """Count written lines (media may run in concurrent threads)
+        """
+        with self._rows_lock:
+            self.rows += count
+
+    def for_each_media(self, func, medias=None, workers=MEDIA_WORKERS, mode=None):
+        """Run `func(media)` for some media, up to `workers` media at once
+
+        A failure only stops its own media: it is logged and recorded in `failed_media` (the run then ends as failed), the other media still run.
+        Engines keeping a date by media store it at the end of `func` (`store_date`), so a failed media is run again next time.
+
+        In "process" mode, each media runs in a worker process (see `process_pool`): `func` must be picklable (a method of the engine),
+        attributes it sets stay in the worker, only its result (must be picklable) and its number of written lines come back.
+        Workers do not see the tables shared by a pipeline run (`Interactions.shared`), they load their own.
+
+        Args:
+            func (callable): function of a media class
+            medias (list, optional): media classes, each one is run once. Defaults to `__media__`.
+            workers (int, optional): number of media run at once, media are run in turn in this thread if 1 or less. Defaults to MEDIA_WORKERS.
+            mode (str, optional): "thread" or "process". Defaults to `__media_fan_out__`.
+
+        Returns:
+            dict: result of `func` for each successful media
+        """
+        # A media given twice would be run twice at once
+        medias = list(dict.fromkeys(
+            self.__media__ if medias is None else medias))
+        mode = mode or self.__media_fan_out__
+        assert mode in ["thread", "process"], "Unknown fan out mode '%s'" % mode
+
+        results = {}
+        if workers <= 1 or len(medias) <= 1:
+            for media in medias:
+                try:
+                    results[media] = func(media)
+                except Exception as e:
+                    self._media_failed(media, e)
+            return results
+
+        if mode == "process":
+            task = uuid.uuid4().hex
+            executor = process_pool(min(workers, len(medias)), task, partial(
+                self._run_media_process, func), with_app=True)
+            futures = {executor.submit(run_task, task, media): media for media in medias}
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            futures = {executor.submit(
+                contextvars.copy_context().run, self._run_media_thread, func, media): media for media in medias}
+
+        with executor:
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self._media_failed(futures[future], e)
+                    continue
+
+                if mode == "process":
+                    result, rows = result
+                    self.add_rows(rows)
+                results[futures[future]] = result
+
+        if mode == "process":
+            self.media_processes_done()
+        return results
+
+    def _run_media_thread(self, func, media):
+        with self.app.app_context():
+            return func(media)
+
+    def _run_media_process(self, func, media):
+        # Run in a worker, by the copy of the engine it got
+        rows = self.rows
+        try:
+            result = func(media)
+        except Exception:
+            # The original exception may not be picklable
+            raise Exception(traceback.format_exc())
+        return result, self.rows - rows
+
+    def _media_failed(self, media, error):
+        # Called while handling the error (the traceback of a media process is in its message)
+        traceback.print_exc()
+        self.logger.error("%s failed for %s: %s" % (
+            self.__class__.__name__, media.content_type, error))
+        self.failed_media[media] = error
+
+    def media_processes_done(self):
+        """Drop what media processes made stale in this process (their writes are not seen by the shared tables of this one)
+        """
+        _, writes = self.tables()
+        if "recommended_content" in writes:
+            AlreadyRecommended.refresh()
+            recommendations_cache.invalidate()
+
+    def writes(self, name=None):
+        """Writer stage of the engine (see `WriterStage`)
+
+        Args:
+            name (str, optional): name of the stage in the log. Defaults to the engine name.
+        """
+        return WriterStage(self.app, self.logger, name=name or self.__class__.__name__)
 
     def store_date(self, content_type):
         content_type = str(content_type).upper()
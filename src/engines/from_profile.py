@@ -1,7 +1,8 @@
-from src.content import User, Group, Profile, ContentType
-from src.utils import db
+from src.content import User, Group, Profile, ContentType, Interactions, AlreadyRecommended
+from src.utils import db, BulkWriter, batched, dense_top_k, map_chunks, recommendations_cache
 from .engine import Engine
 
+from scipy.sparse import csr_matrix
 from datetime import datetime
 from sqlalchemy import text
 import pandas as pd
@@ -13,10 +14,23 @@ class FromProfile(Engine):
     """(Re-)Set top recommended media (per type) for each user (or group)
 
     The main purpose it to recommend items based on the profile of a user or a group (contruction of liked genre + explicit liked genres)
+
+    Every user is handled at once: the user x media interaction matrix (R) is loaded with a single query, profiles are `R . G` (G being the media x genre matrix)
+    weighted by explicit interests, and media scores are `P . G^T`, computed by blocks of users.
+    Blocks are scored in worker processes if `ENGINE_WORKERS` > 1 (see `map_chunks`).
     """
     __engine_priority__ = 4
+    __reads__ = ["meta_user_content", "content", "genre", "liked_genres", "recommended_content"]
+    __writes__ = ["recommended_content"]
+    __memory__ = 1024
+    # Media keep their state in attributes (`obj_df`, `users`, ...): they are run in worker processes
+    __media_fan_out__ = "process"
     user_uuid = None
     group_id = None
+    # Maximum number of recommended media for each user
+    max_recommended = 200
+    # Size of score blocks (users x media), bounds the memory used by scoring
+    scores_per_block = 2**24
 
     def __init__(self, *args, user_uuid=None, group_id=None, is_group=False, profile_uuid=None, event_id=None, **kwargs):
         """
@@ -52,201 +66,282 @@ class FromProfile(Engine):
                 except (ValueError, TypeError):
                     self.user_uuid = None
 
+    @classmethod
+    def tables(cls, is_group=False, **kwargs):
+        reads, writes = super().tables(**kwargs)
+        if is_group:
+            # Recommendations of groups have their own table
+            def rename(table):
+                return table + Group.recommended_ext if table == "recommended_content" else table
+            reads = set(map(rename, reads)) | {"group"}
+            writes = set(map(rename, writes))
+        return reads, writes
+
     def train(self):
         necessary_for, necessary_for_media_id, necessary_for_user_id = self.check_if_necessary()
-        for media in necessary_for:
-            m = media(logger=self.logger)
-            if m.content_type in [
-                ContentType.APPLICATION,  # 1 seul genre par app ...
-                ContentType.BOOK  # Pas de genre pour les livres
-            ]:
-                continue
-            st_time = datetime.utcnow()
+        self.necessary_for_user_id = necessary_for_user_id
+        self.for_each_media(self.train_media, medias=[media for media in necessary_for if media.content_type not in [
+            ContentType.APPLICATION,  # 1 seul genre par app ...
+            ContentType.BOOK  # Pas de genre pour les livres
+        ]])
 
-            if self.is_group:
-                self.obj_df = self.obj.get_with_genres(
-                    types=m.content_type, group_id=self.group_id)
-            elif self.profile_uuid is not None:
-                # Profile
-                self.obj_df = self.obj.get_with_genres(
-                    types=m.content_type, profile_uuid=self.profile_uuid)
-            else:
-                # Get user
-                self.obj_df = self.obj.get_with_genres(
-                    types=m.content_type, user_uuid=self.user_uuid, user_id_list=necessary_for_user_id[str(m.content_type)])
+    def train_media(self, media):
+        """Recommend content of a media to every user (or group, or profile) from their profile (users to update are in `necessary_for_user_id`)
 
-            # Check we have a result for this user uuid
-            if self.obj_df is None:
-                continue
+        Args:
+            media (type): media class
+        """
+        m = media(logger=self.logger)
+        user_id_list = self.necessary_for_user_id[str(m.content_type)]
+
+        st_time = datetime.utcnow()
+
+        if self.is_group:
+            self.obj_df = self.obj.get_with_genres(
+                types=m.content_type, group_id=self.group_id)
+        elif self.profile_uuid is not None:
+            # Profile
+            self.obj_df = self.obj.get_with_genres(
+                types=m.content_type, profile_uuid=self.profile_uuid)
+        else:
+            # Get user
+            self.obj_df = self.obj.get_with_genres(
+                types=m.content_type, user_uuid=self.user_uuid, user_id_list=user_id_list)
+
+        # Check we have a result for this user uuid
+        if self.obj_df is None:
+            return
+        self.user_id_list = user_id_list
+        self.prepare(m)
+
+        self.logger.debug("%s data preparation performed in %s" %
+                          (m.content_type, datetime.utcnow()-st_time))
+
+        if self.profile_uuid is None:
+            writer = BulkWriter(m.tablename_recommended + self.obj.recommended_ext, [self.obj.id, m.id, "score", "engine", "engine_priority", "content_type"],
+                                on_conflict="ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING" % (m.tablename_recommended + self.obj.recommended_ext), logger=self.logger,
+                                reset=lambda session, owner_ids: self.reset_recommended(m, owner_ids, session))
+        else:
+            writer = BulkWriter(self.obj.tablename_recommended, [self.obj.event_id, m.id, "score", "engine"],
+                                on_conflict="ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING" % self.obj.tablename_recommended, logger=self.logger)
+
+        obj_ids = self.obj_df[self.obj.id if self.profile_uuid is None else "user_id"].to_numpy()
+
+        len_values = 0
+        owners = []
+        with self.writes("%s %s" % (self.__class__.__name__, m.content_type)) as stage:
+            for recommendations in map_chunks(self.recommend, self.users.shape[0], logger=self.logger, name="%s %s" % (self.__class__.__name__, m.content_type), unit="users"):
+                values = []
+                written = []
+                for row, content_ids, scores in recommendations:
+                    written.append(int(obj_ids[row]))
+                    for id, score in zip(content_ids.tolist(), scores.tolist()):
+                        if self.profile_uuid is None:
+                            values.append(
+                                {
+                                    self.obj.id: written[-1],
+                                    m.id: id,
+                                    "score": score,
+                                    "engine": self.__class__.__name__,
+                                    "engine_priority": self.__engine_priority__,
+                                    "content_type": str(m.content_type).upper(),
+                                }
+                            )
+                        else:
+                            values.append(
+                                {
+                                    self.obj.event_id: self.event_id,
+                                    m.id: id,
+                                    "score": score,
+                                    "engine": self.__class__.__name__,
+                                }
+                            )
+
+                len_values += len(values)
 
-            # Get media (only rating for now)
-            self.media_df = m.get_for_profile()
-            self.mediaWithGenres_df = m.prepare_from_user_profile(
-                self.media_df)
-
-            self.logger.debug("%s data preparation performed in %s" %
-                              (m.content_type, datetime.utcnow()-st_time))
-
-            # Now let's get the genres of every movie in our original dataframe
-            genre_table = self.mediaWithGenres_df.set_index(
-                self.mediaWithGenres_df[m.id])
-
-            len_values = 0
-            # for each user
-            for index, user in self.obj_df.iterrows():
-                # Get meta
-                meta_cols = [m.id, "rating", "review_see_count"]
-                if self.is_group:
-                    user_input = pd.DataFrame(columns=meta_cols)
-                    for u in user['user_id']:
-                        user_input = user_input.append(
-                            m.get_meta(
-                                meta_cols, u, list_of_content_id=necessary_for_media_id[str(m.content_type)]),
-                            ignore_index=True
-                        )
-                elif self.profile_uuid is not None:
-                    user_input = Profile.get_meta(
-                        m, meta_cols, self.event_id)
+                if self.profile_uuid is None:
+                    # Previous recommendations of these owners are replaced in the same transaction
+                    owners.extend(written)
+                    stage.submit(writer.write, values, written)
                 else:
-                    user_input = m.get_meta(
-                        meta_cols, user["user_id"], list_of_content_id=necessary_for_media_id[str(m.content_type)])
+                    stage.submit(writer.write, values)
 
-                if user_input.shape[0] == 0:
-                    continue
+            stage.submit(writer.close)
+        if self.profile_uuid is None:
+            AlreadyRecommended.refresh(
+                m.tablename_recommended + self.obj.recommended_ext)
+            if self.obj is User:
+                recommendations_cache.invalidate(owners)
 
-                user_profile = self.learning_user_profile(
-                    user, m.id, user_input)
+        self.add_rows(len_values)
+        self.logger.info("%s recommendation from user profile performed in %s (%s users, %s lines)" % (
+            m.content_type, datetime.utcnow()-st_time, self.users.shape[0], len_values))
 
-                user_profile = user_profile.fillna(0)
+    def prepare(self, m, genres=None, interactions=None):
+        """Build the profile of every user (or group, or profile) of `self.obj_df` for a media, and what must not be recommended to them
 
-                # Case if user do not have any preferences for this media (0 rating and 0 interests)
-                if user_profile.sum() == 0:
-                    continue
+        Args:
+            m (Content): media
+            genres (GenreMatrix, optional): genres of every media. Defaults to None (loaded).
+            interactions (Interactions, optional): interactions of the profile, when already loaded. Defaults to None (loaded).
+        """
+        # Get the genres of every media (sparse content x genre matrix)
+        self.genres = m.genre_matrix() if genres is None else genres
 
-                # With the input's profile and the complete list of medias and their genres in hand, we're going to take the weighted average of every media based on the input profile and recommend the top twenty medias that most satisfy it.
+        # Interactions of every user (or group) with every media, then their profile
+        matrix, has_input = self.get_interactions(m, interactions)
+        self.user_profiles = self.learning_user_profile(matrix, self.obj_df.reindex(
+            columns=self.genres.genres).to_numpy(dtype=np.float32))
 
-                # Multiply the genres by the weights and then take the weighted average
-                recommendationTable_df = (
-                    (genre_table*user_profile).sum(axis=1))/(user_profile.sum())
+        # Case if user do not have any input or any preferences for this media (0 rating and 0 interests)
+        self.profile_sums = self.user_profiles.sum(axis=1)
+        self.users = np.flatnonzero(has_input & (self.profile_sums != 0))
 
-                # Do not recommend already recommended content
-                already_recommended_media = []
-                if self.profile_uuid is None:
-                    with db as session:
-                        result = session.execute('SELECT %s FROM "%s" WHERE %s = \'%s\' AND engine <> \'%s\'' % (
-                            m.id, m.tablename_recommended + self.obj.recommended_ext, self.obj.id, user[self.obj.id], self.__class__.__name__))
-                        already_recommended_media = [
-                            dict(row)[m.id] for row in result]
+        # Do not recommend already recommended content
+        self.excluded = self.get_already_recommended(m)
 
-                recommendationTable_df = recommendationTable_df[~recommendationTable_df.index.isin(
-                    already_recommended_media)]
+    def recommend(self, start, end):
+        """Recommend media to the users `self.users[start:end]` (run in worker processes, see `map_chunks`)
 
-                # Sort our recommendations in descending order
-                recommendationTable_df = recommendationTable_df.sort_values(
-                    ascending=False)
+        Args:
+            start (int): first user
+            end (int): last user (excluded)
 
-                maxi = recommendationTable_df.iloc[0]
-                mini = maxi - 0.2
+        Returns:
+            list: (row of `self.obj_df`, recommended content ids, scores) of each user with recommendations
+        """
+        recommendations = []
+        users_per_block = max(
+            1, self.scores_per_block // max(1, self.genres.content_ids.shape[0]))
 
-                # Get first 200 (if filter give too much data)
-                recommendationTable_df = recommendationTable_df[recommendationTable_df >= mini][:200]
+        for block_start in range(start, end, users_per_block):
+            block = self.users[block_start:min(block_start+users_per_block, end)]
 
-                values = []
-                for id, score in recommendationTable_df.items():
-                    if self.profile_uuid is None:
-                        values.append(
-                            {
-                                self.obj.id: int(user[self.obj.id]),
-                                m.id: int(id),
-                                "score": float(score),
-                                "engine": self.__class__.__name__,
-                                "engine_priority": self.__engine_priority__,
-                                "content_type": str(m.content_type).upper(),
-                            }
-                        )
-                    else:
-                        values.append(
-                            {
-                                self.obj.event_id: self.event_id,
-                                m.id: int(id),
-                                "score": float(score),
-                                "engine": self.__class__.__name__,
-                            }
-                        )
+            # With the users' profiles and the complete list of medias and their genres in hand, we're going to take the weighted average of every media based on each profile and recommend the medias that most satisfy it.
+            scores = self.genres.matrix.dot(
+                self.user_profiles[block].T).T / self.profile_sums[block, None]
 
-                len_values += len(values)
+            excluded_rows, excluded_cols = self.excluded[block].nonzero()
+            scores[excluded_rows, excluded_cols] = -np.inf
+
+            # Get first 200, and only those close to the best one (if filter give too much data)
+            cols, top = dense_top_k(scores, self.max_recommended)
+            kept = np.isfinite(top) & (top >= top[:, :1] - 0.2)
+
+            for position, row in enumerate(block.tolist()):
+                if kept[position, 0]:
+                    recommendations.append(
+                        (row, self.genres.content_ids[cols[position, kept[position]]], top[position, kept[position]]))
 
-                with db as session:
-                    if self.profile_uuid is None:
-                        # Reset list of recommended `media`
-                        session.execute(
-                            text('DELETE FROM "%s" WHERE %s = \'%s\' AND engine = \'%s\' AND content_type = \'%s\'' % (m.tablename_recommended + self.obj.recommended_ext, self.obj.id, user[self.obj.id], self.__class__.__name__, str(m.content_type).upper())))
-
-                        if len(values) > 0:
-                            markers = ':%s, :%s, :score, :engine, :engine_priority, :content_type' % (
-                                self.obj.id, m.id)
-                            ins = 'INSERT INTO {tablename} VALUES ({markers}) ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING' % (m.tablename_recommended + self.obj.recommended_ext)
-                            ins = ins.format(
-                                tablename=m.tablename_recommended + self.obj.recommended_ext, markers=markers)
-                            session.execute(ins, values)
-                    else:
-                        if len(values) > 0:
-                            markers = ':%s, :%s, :score, :engine' % (
-                                self.obj.event_id, m.id)
-                            ins = 'INSERT INTO {tablename} VALUES ({markers}) ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING' % self.obj.tablename_recommended
-                            ins = ins.format(
-                                tablename=self.obj.tablename_recommended, markers=markers)
-                            session.execute(ins, values)
-
-            self.logger.info("%s recommendation from user profile performed in %s (%s lines)" % (
-                m.content_type, datetime.utcnow()-st_time, len_values))
-
-    def learning_user_profile(self, user, media_id, user_input):
-        """Learning user profile from rating and interests
+        return recommendations
+
+    def get_interactions(self, m, interactions=None):
+        """Get the interactions of every user (or group) of `self.obj_df` with media of `self.genres` (see `Interactions`)
+
+        Interactions of group members are summed.
 
         Args:
-            user (Series): user interests and id
-            media_id (str): media id in db
+            m (Content): media
+            interactions (Interactions, optional): interactions of the profile, when already loaded. Defaults to None (loaded).
 
         Returns:
-            Serie: user profile
+            tuple: (csr_matrix of rating + review_see_count (user x media row), bool array: user has any interaction)
         """
-        user_input = user_input.groupby([media_id]).sum().reset_index()
+        if self.profile_uuid is not None:
+            if interactions is None:
+                interactions = Interactions.from_frame(Profile.get_meta(
+                    m, [m.id, "rating", "review_see_count"], self.event_id), m.id)
+            user_ids = pd.Index([0])
+            members = None
+        else:
+            if self.is_group:
+                member_ids = self.obj_df["user_id"].explode().astype("uint32")
+                user_ids = pd.Index(member_ids.unique())
+                # Group x member matrix
+                members = csr_matrix((np.ones(member_ids.shape[0], dtype=np.float32), (member_ids.index.to_numpy(), user_ids.get_indexer(member_ids))),
+                                     shape=(self.obj_df.shape[0], user_ids.shape[0]))
+            else:
+                user_ids = pd.Index(self.obj_df["user_id"])
+                members = None
+
+            interactions = Interactions.load(m, user_ids=None if self.user_uuid is None and self.group_id is None and len(
+                self.user_id_list) == 0 else user_ids.tolist())
 
-        # Filtering out the medias from the input
-        users_medias = self.mediaWithGenres_df[self.mediaWithGenres_df[media_id].isin(
-            user_input[media_id].tolist())]
+        owners, index = interactions.lookup(user_ids.to_numpy())
+        has_input = np.bincount(owners, minlength=user_ids.shape[0]) > 0
 
         # Filtering input if not in media
-        user_input = user_input[user_input[media_id].isin(
-            users_medias[media_id].tolist())]
+        rows = self.genres.rows(interactions.content_ids[index])
+        kept = rows >= 0
+
+        # Duplicated (user, media) pairs are summed
+        matrix = csr_matrix(((interactions.ratings[index].astype(np.float32) + interactions.review_see_counts[index])[kept], (owners[kept], rows[kept])),
+                            shape=(user_ids.shape[0], self.genres.content_ids.shape[0]))
+
+        if members is not None:
+            matrix = members.dot(matrix).tocsr()
+            has_input = members.dot(has_input.astype(np.float32)) > 0
+
+        return matrix, has_input
+
+    def get_already_recommended(self, m):
+        """Get media already recommended to each user (or group) of `self.obj_df` by other engines (see `AlreadyRecommended`)
+
+        Args:
+            m (Content): media
+
+        Returns:
+            csr_matrix: boolean user x media row matrix
+        """
+        shape = (self.obj_df.shape[0], self.genres.content_ids.shape[0])
+        if self.profile_uuid is not None:
+            return csr_matrix(shape, dtype=bool)
+
+        # Only the loaded users (or groups), unless the run is for every one of them
+        owner_ids = None if self.user_uuid is None and self.group_id is None and len(
+            self.user_id_list) == 0 else self.obj_df[self.obj.id].tolist()
+        owners, content_ids = AlreadyRecommended.load(m.tablename_recommended + self.obj.recommended_ext, self.obj.id, m.id, m.content_type,
+                                                      owner_ids=owner_ids, logger=self.logger).lookup(self.obj_df[self.obj.id].to_numpy(), self.__class__.__name__)
+        rows = self.genres.rows(content_ids)
+        kept = rows >= 0
 
-        # Resetting the index to avoid future issues
-        users_medias = users_medias.reset_index(drop=True)
-        user_input = user_input.reset_index(drop=True)
+        return csr_matrix((np.ones(kept.sum(), dtype=bool), (owners[kept], rows[kept])), shape=shape)
 
-        # Dropping unnecessary issues due to save memory and to avoid issues
-        user_genre_table = users_medias.drop([media_id], axis=1)
+    def learning_user_profile(self, interactions, user_interests):
+        """Learning user profiles from rating and interests
 
+        Args:
+            interactions (csr_matrix): rating + review_see_count of each user (or group) for each media row of `self.genres`
+            user_interests (np.ndarray): explicit interest of each user for each genre of `self.genres` (NaN if unknown)
+
+        Returns:
+            np.ndarray: user profiles (weight of each genre of `self.genres`, for each user)
+        """
         # we're going to turn each genre into weights. We can do this by using the input's reviews and multiplying them into the input's genre table and then summing up the resulting table by column.
 
         # Dot produt to get weights
-        user_profile = user_genre_table.transpose()\
-            .dot(user_input['rating'] + user_input['review_see_count'])
-        user_profile = user_profile.astype("float32")
-
-        # Take into account explicit user interests
-        user_interests = user.copy()
-        user_interests.drop(["user_id"], inplace=True)
+        user_profiles = np.asarray(interactions.dot(
+            self.genres.matrix).todense(), dtype=np.float32)
 
-        user_profile = user_profile.apply(lambda x: 1.0 if x == 0 else x)
-        user_profile = user_profile.mul(
-            user_interests, level=list(user_interests.keys()))
-        user_profile = user_profile.apply(lambda x: 0.0 if x == 1 else x)
-        user_profile = user_profile.astype("float32")
+        # Take into account explicit user interests (genres without explicit interest weigh 0)
+        user_profiles[user_profiles == 0] = 1
+        user_profiles = user_profiles * user_interests
+        user_profiles[user_profiles == 1] = 0
 
         # Now, we have the weights for every of the user's preferences.
-        return user_profile
+        return np.nan_to_num(user_profiles)
+
+    def reset_recommended(self, m, owner_ids, session):
+        """Reset the list of recommended `media` of some users (or groups) for this engine
+
+        Args:
+            m (Content): media
+            owner_ids (list): user (or group) ids
+            session (Session): session of the flush writing their new recommendations (see `BulkWriter`)
+        """
+        for batch in batched(owner_ids, 10_000):
+            session.execute(
+                text('DELETE FROM "%s" WHERE %s IN (%s) AND engine = \'%s\' AND content_type = \'%s\'' % (m.tablename_recommended + self.obj.recommended_ext, self.obj.id, ", ".join(str(x) for x in batch), self.__class__.__name__, str(m.content_type).upper())))
 
     def check_if_necessary(self):
         necessary_for = []
@@ -301,10 +396,10 @@ class FromProfile(Engine):
                 df = pd.read_sql_query(
                     'SELECT object_id as content_id FROM "%s_added_event" WHERE occured_at > \'%s\'' % (media.content_type, last_launch_date), con=db.engine)
 
+                # The media is already run for the group
                 if df.shape[0] != 0:
                     necessary_for_media_id[str(
                         media.content_type)] = df['content_id'].to_list()
-                    necessary_for.append(media)
             else:
                 # is for all
                 # if new media, launch for all user
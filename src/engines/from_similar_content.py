@@ -1,5 +1,5 @@
-from src.content import User, Group, Profile
-from src.utils import db
+from src.content import User, Group, Profile, Interactions, AlreadyRecommended, SimilarsIndex
+from src.utils import db, BulkWriter, batched, map_chunks, recommendations_cache
 from .engine import Engine
 
 from datetime import datetime
@@ -13,8 +13,15 @@ class FromSimilarContent(Engine):
     """(Re-)Set top similars content per user
 
     The main purpose it to recommend similar items based on the user liked content
+
+    Users are handled by chunks, in worker processes if `ENGINE_WORKERS` > 1 (see `map_chunks`).
     """
     __engine_priority__ = 2
+    __reads__ = ["meta_user_content", "similars_content", "content.popularity_score", "recommended_content"]
+    __writes__ = ["recommended_content"]
+    __memory__ = 512
+    # Media keep their state in attributes (`obj_df`, `users`, ...): they are run in worker processes
+    __media_fan_out__ = "process"
     user_uuid = None
     group_id = None
 
@@ -46,149 +53,219 @@ class FromSimilarContent(Engine):
                 except (ValueError, TypeError):
                     self.user_uuid = None
 
+    @classmethod
+    def tables(cls, is_group=False, **kwargs):
+        reads, writes = super().tables(**kwargs)
+        if is_group:
+            # Recommendations of groups have their own table
+            def rename(table):
+                return table + Group.recommended_ext if table == "recommended_content" else table
+            reads = set(map(rename, reads)) | {"group"}
+            writes = set(map(rename, writes))
+        return reads, writes
+
     def train(self):
         necessary_for, necessary_for_media_id, necessary_for_user_id = self.check_if_necessary()
-        for media in necessary_for:
-            st_time = datetime.utcnow()
-
-            m = media(logger=self.logger)
-
-            if self.is_group:
-                self.obj_df = self.obj.get(group_id=self.group_id)
-            elif self.profile_uuid is not None:
-                # Profile
-                self.obj_df = self.obj.get(profile_uuid=self.profile_uuid)
-            else:
-                # Get user
-                self.obj_df = self.obj.get(
-                    user_uuid=self.user_uuid, user_id_list=necessary_for_user_id[str(m.content_type)])
-
-            # Check we have a result for this user uuid
-            if self.obj_df.shape[0] == 0:
-                continue
-
-            len_values = 0
-            # for each user (or group, or profile)
-            for index, user in self.obj_df.iterrows():
-                # Get meta
-                meta_cols = [m.id, "rating", "review_see_count"]
-                if self.is_group:
-                    self.media_df = pd.DataFrame(columns=meta_cols)
-                    for u in user['user_id'].split(","):
-                        self.media_df = self.media_df.append(
-                            m.get_meta(
-                                meta_cols, u, list_of_content_id=necessary_for_media_id[str(m.content_type)]),
-                            ignore_index=True
-                        )
-                elif self.profile_uuid is not None:
-                    self.media_df = Profile.get_meta(
-                        m, meta_cols, self.event_id)
-                else:
-                    self.media_df = m.get_meta(
-                        meta_cols, user["user_id"], list_of_content_id=necessary_for_media_id[str(m.content_type)])
-
-                # Do not taking bad content that user do not like
-                self.media_df = self.media_df[(self.media_df["rating"] >= 3) | (
-                    self.media_df["rating"] == 0)]
-
-                # Do not recommend already recommended content
-                already_recommended_media = []
-                if self.profile_uuid is None:
-                    with db as session:
-                        result = session.execute('SELECT %s FROM "%s" WHERE %s = \'%s\' AND engine <> \'%s\'' % (
-                            m.id, m.tablename_recommended + self.obj.recommended_ext, self.obj.id, user[self.obj.id], self.__class__.__name__))
-                        already_recommended_media = [
-                            dict(row)[m.id] for row in result]
-
-                # Get list of similars content from already rate content
-                similars_df = pd.DataFrame(
-                    columns=[m.id, "similar_"+m.id, "similarity", "popularity_score", "rating", "review_see_count"])
-                for index, content in self.media_df.iterrows():
-                    d = m.get_similars(content[m.id])
-                    d = d[~d[m.id].isin(already_recommended_media)]
-                    if d.shape[0] > 0:
-                        d["rating"] = content["rating"]
-                        d["review_see_count"] = content["review_see_count"]
-                        similars_df = similars_df.append(
-                            d,
-                            ignore_index=True,
-                        )
-
-                if similars_df.shape[0] > 0:
-                    similars_df = similars_df.groupby([m.id, "similar_"+m.id]).agg(
-                        {"similarity": "max", "popularity_score": "max", "rating": "sum", "review_see_count": "sum"}).reset_index()
-
-                # Order this list by most popular and make a selection (max popularity_score is 5 (also = max rate), see popularity engine (IMDB formula))
-                similars_df["popularity_score"] = similars_df["popularity_score"].fillna(
-                    0)
+        self.necessary_for_user_id = necessary_for_user_id
+        self.for_each_media(self.train_media, medias=necessary_for)
 
-                similars_df["score"] = similars_df["popularity_score"] + \
-                    similars_df["similarity"] * similars_df["rating"] + \
-                    similars_df["similarity"] * similars_df["review_see_count"]
+    def train_media(self, media):
+        """Recommend content of a media similar to the content liked by every user (or group, or profile) (users to update are in `necessary_for_user_id`)
 
-                # To be between 0 and 1
-                similars_df["score"] = similars_df["score"] / \
-                    (5 + similars_df["popularity_score"].max())
+        Args:
+            media (type): media class
+        """
+        st_time = datetime.utcnow()
 
-                similars_df.drop(
-                    columns=[m.id, "similarity", "popularity_score", "rating"], axis=1, inplace=True)
+        m = media(logger=self.logger)
+        user_id_list = self.necessary_for_user_id[str(m.content_type)]
 
-                similars_df = similars_df.groupby(
-                    ["similar_"+m.id]).sum().reset_index()
-
-                similars_df["score"] = similars_df["score"].apply(
-                    lambda x: 1 if x > 1 else x)
+        if self.is_group:
+            self.obj_df = self.obj.get(group_id=self.group_id)
+        elif self.profile_uuid is not None:
+            # Profile
+            self.obj_df = self.obj.get(profile_uuid=self.profile_uuid)
+        else:
+            # Get user
+            self.obj_df = self.obj.get(
+                user_uuid=self.user_uuid, user_id_list=user_id_list)
+
+        # Check we have a result for this user uuid
+        if self.obj_df.shape[0] == 0:
+            return
+
+        if self.profile_uuid is None:
+            writer = BulkWriter(m.tablename_recommended + self.obj.recommended_ext, [self.obj.id, m.id, "score", "engine", "engine_priority", "content_type"],
+                                on_conflict="ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING" % (m.tablename_recommended + self.obj.recommended_ext), logger=self.logger,
+                                reset=lambda session, owner_ids: self.reset_recommended(m, owner_ids, session))
+        else:
+            writer = BulkWriter(self.obj.tablename_recommended, [self.obj.event_id, m.id, "score", "engine"],
+                                on_conflict="ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING" % self.obj.tablename_recommended, logger=self.logger)
 
+        # Interactions of every user, loaded at once
+        if self.profile_uuid is not None:
+            self.interactions = Interactions.from_frame(Profile.get_meta(
+                m, [m.id, "rating", "review_see_count"], self.event_id), m.id)
+        elif self.is_group:
+            self.interactions = Interactions.load(m, user_ids=None if self.group_id is None else [
+                int(u) for u in self.obj_df.iloc[0]["user_id"].split(",")])
+        else:
+            self.interactions = Interactions.load(m, user_ids=None if self.user_uuid is None and len(
+                user_id_list) == 0 else self.obj_df["user_id"].tolist())
+
+        self.recommended = None
+        if self.profile_uuid is None:
+            # Only the loaded users (or groups), unless the run is for every one of them
+            self.recommended = AlreadyRecommended.load(m.tablename_recommended + self.obj.recommended_ext, self.obj.id, m.id, m.content_type,
+                                                       owner_ids=None if self.user_uuid is None and self.group_id is None and len(user_id_list) == 0 else self.obj_df[self.obj.id].tolist(), logger=self.logger)
+
+        # Similars of every content of the media
+        self.similars = SimilarsIndex.load(m)
+
+        len_values = 0
+        owners = []
+        with self.writes("%s %s" % (self.__class__.__name__, m.content_type)) as stage:
+            # for each chunk of users (or groups, or profile)
+            for recommendations in map_chunks(self.recommend, self.obj_df.shape[0], logger=self.logger, name="%s %s" % (self.__class__.__name__, m.content_type), unit="users"):
                 # Store result
                 values = []
-                for index, item in similars_df.iterrows():
-                    if self.profile_uuid is None:
-                        values.append(
-                            {
-                                self.obj.id: int(user[self.obj.id]),
-                                m.id: int(item["similar_"+m.id]),
-                                "score": float(item["score"]),
-                                "engine": self.__class__.__name__,
-                                "engine_priority": self.__engine_priority__,
-                                "content_type": str(m.content_type).upper(),
-                            }
-                        )
-                    else:
-                        values.append(
-                            {
-                                self.obj.event_id: self.event_id,
-                                m.id: int(item["similar_"+m.id]),
-                                "score": float(item["score"]),
-                                "engine": self.__class__.__name__,
-                            }
-                        )
+                for owner_id, similar_ids, scores in recommendations:
+                    for id, score in zip(similar_ids.tolist(), scores.tolist()):
+                        if self.profile_uuid is None:
+                            values.append(
+                                {
+                                    self.obj.id: owner_id,
+                                    m.id: id,
+                                    "score": score,
+                                    "engine": self.__class__.__name__,
+                                    "engine_priority": self.__engine_priority__,
+                                    "content_type": str(m.content_type).upper(),
+                                }
+                            )
+                        else:
+                            values.append(
+                                {
+                                    self.obj.event_id: self.event_id,
+                                    m.id: id,
+                                    "score": score,
+                                    "engine": self.__class__.__name__,
+                                }
+                            )
 
                 len_values += len(values)
 
-                with db as session:
-                    if self.profile_uuid is None:
-                        # Reset list of recommended `media`
-                        session.execute(
-                            text('DELETE FROM "%s" WHERE %s = \'%s\' AND engine = \'%s\' AND content_type = \'%s\'' % (m.tablename_recommended + self.obj.recommended_ext, self.obj.id, user[self.obj.id], self.__class__.__name__, str(m.content_type).upper())))
-
-                        if len(values) > 0:
-                            markers = ':%s, :%s, :score, :engine, :engine_priority' % (
-                                self.obj.id, m.id)
-                            ins = 'INSERT INTO {tablename} VALUES ({markers}) ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING' % (m.tablename_recommended + self.obj.recommended_ext)
-                            ins = ins.format(
-                                tablename=m.tablename_recommended + self.obj.recommended_ext, markers=markers)
-                            session.execute(ins, values)
-                    else:
-                        if len(values) > 0:
-                            markers = ':%s, :%s, :score, :engine' % (
-                                self.obj.event_id, m.id)
-                            ins = 'INSERT INTO {tablename} VALUES ({markers}) ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING' % self.obj.tablename_recommended
-                            ins = ins.format(
-                                tablename=self.obj.tablename_recommended, markers=markers)
-                            session.execute(ins, values)
-
-            self.logger.info("%s recommendation from similar content in %s (%s lines)" % (
-                m.content_type, datetime.utcnow()-st_time, len_values))
+                written = []
+                if self.profile_uuid is None:
+                    # Previous recommendations of these owners are replaced in the same transaction
+                    written = [owner_id for owner_id, _, _ in recommendations]
+                    owners.extend(written)
+                stage.submit(writer.write, values, written)
+
+            stage.submit(writer.close)
+        if self.profile_uuid is None:
+            AlreadyRecommended.refresh(
+                m.tablename_recommended + self.obj.recommended_ext)
+            if self.obj is User:
+                recommendations_cache.invalidate(owners)
+
+        self.add_rows(len_values)
+        self.logger.info("%s recommendation from similar content in %s (%s lines)" % (
+            m.content_type, datetime.utcnow()-st_time, len_values))
+
+    def recommend(self, start, end):
+        """Recommend similar content to the users (or groups, or profile) `self.obj_df[start:end]` (run in worker processes, see `map_chunks`)
+
+        Args:
+            start (int): first row
+            end (int): last row (excluded)
+
+        Returns:
+            list: (user (or group) id (None for a profile), recommended content ids, scores) of each row
+        """
+        recommendations = []
+        for index, user in self.obj_df.iloc[start:end].iterrows():
+            # Get meta
+            if self.is_group:
+                owners, meta_index = self.interactions.lookup(
+                    [int(u) for u in user['user_id'].split(",")])
+                content_ids, ratings, review_see_counts = self.interactions.content_ids[meta_index], self.interactions.ratings[
+                    meta_index], self.interactions.review_see_counts[meta_index]
+            elif self.profile_uuid is not None:
+                content_ids, ratings, review_see_counts = self.interactions.user(
+                    0)
+            else:
+                content_ids, ratings, review_see_counts = self.interactions.user(
+                    user["user_id"])
+
+            # Do not taking bad content that user do not like
+            liked = (ratings >= 3) | (ratings == 0)
+
+            # Do not recommend already recommended content
+            already_recommended_media = []
+            owner_id = None
+            if self.profile_uuid is None:
+                owner_id = int(user[self.obj.id])
+                already_recommended_media = self.recommended.user(
+                    owner_id, self.__class__.__name__)
+
+            recommendations.append((owner_id, *self.score_similars(
+                content_ids[liked], ratings[liked], review_see_counts[liked], already_recommended_media)))
+
+        return recommendations
+
+    def score_similars(self, content_ids, ratings, review_see_counts, excluded=[]):
+        """Score the similars of the content rated by a user (or group)
+
+        Args:
+            content_ids (np.ndarray): rated content ids (may be repeated for groups)
+            ratings (np.ndarray): rating of each rated content
+            review_see_counts (np.ndarray): review_see_count of each rated content
+            excluded (np.ndarray, optional): content ids that must not be recommended. Defaults to [].
+
+        Returns:
+            tuple: (similar content ids, scores between 0 and 1)
+        """
+        # Ratings of the same content (group members) are summed
+        content_ids, inverse = np.unique(content_ids, return_inverse=True)
+        ratings = np.bincount(inverse, weights=ratings,
+                              minlength=content_ids.shape[0])
+        review_see_counts = np.bincount(
+            inverse, weights=review_see_counts, minlength=content_ids.shape[0])
+
+        # Get list of similars content from already rate content
+        sources, index = self.similars.neighbours(content_ids)
+        kept = ~np.isin(self.similars.targets[index], excluded)
+        sources, index = sources[kept], index[kept]
+        if index.shape[0] == 0:
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.float64)
+
+        # Order this list by most popular and make a selection (max popularity_score is 5 (also = max rate), see popularity engine (IMDB formula))
+        popularity_scores = self.similars.popularity_scores[index].astype(
+            np.float64)
+        scores = popularity_scores + self.similars.similarities[index] * \
+            (ratings[sources] + review_see_counts[sources])
+
+        # To be between 0 and 1
+        scores = scores / (5 + popularity_scores.max())
+
+        similar_ids, inverse = np.unique(
+            self.similars.targets[index], return_inverse=True)
+        scores = np.bincount(inverse, weights=scores,
+                             minlength=similar_ids.shape[0])
+
+        return similar_ids, np.minimum(scores, 1)
+
+    def reset_recommended(self, m, owner_ids, session):
+        """Reset the list of recommended `media` of some users (or groups) for this engine
+
+        Args:
+            m (Content): media
+            owner_ids (list): user (or group) ids
+            session (Session): session of the flush writing their new recommendations (see `BulkWriter`)
+        """
+        for batch in batched(owner_ids, 10_000):
+            session.execute(
+                text('DELETE FROM "%s" WHERE %s IN (%s) AND engine = \'%s\' AND content_type = \'%s\'' % (m.tablename_recommended + self.obj.recommended_ext, self.obj.id, ", ".join(str(x) for x in batch), self.__class__.__name__, str(m.content_type).upper())))
 
     def check_if_necessary(self):
         necessary_for = []
@@ -243,10 +320,10 @@ class FromSimilarContent(Engine):
                 df = pd.read_sql_query(
                     'SELECT object_id as content_id FROM "%s_added_event" WHERE occured_at > \'%s\'' % (media.content_type, last_launch_date), con=db.engine)
 
+                # The media is already run for the group
                 if df.shape[0] != 0:
                     necessary_for_media_id[str(
                         media.content_type)] = df['content_id'].to_list()
-                    necessary_for.append(media)
             else:
                 # is for all
                 # if new media, launch for all user
@@ -1,17 +1,24 @@
-from src.utils import db, sc, parallelize_matrix, broadcast_matrix, find_matches_in_submatrix
+from src.utils import db, BulkWriter, SparkRecords, tfidf_from_counts, stack_features, find_matches, batched
 from src.content import ContentType, Book, Game, Movie, Serie, Track
+from settings import SIMILARITY_RAM_BUDGET, SIMILARITY_BACKEND, SIMILARITY_BACKEND_BY_TYPE
 from .engine import Engine
 
-from scipy.sparse import csr_matrix
-
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 from sqlalchemy import text
+from contextlib import closing
 from datetime import datetime
 import pandas as pd
 import numpy as np
+import importlib
 
 
 class LinkBetweenItems(Engine):
+    # Only similarities between content of different types are written (not read by other engines)
+    __reads__ = ["content"]
+    __writes__ = ["similars_content.between_types"]
+    __memory__ = SIMILARITY_RAM_BUDGET
+    # The SparkContext of the service can not be used from a worker process
+    __media_fan_out__ = "thread" if "spark" in [
+        SIMILARITY_BACKEND, *SIMILARITY_BACKEND_BY_TYPE.values()] else "process"
 
     def train(self):
         if self.check_if_necessary() is False:
@@ -20,77 +27,79 @@ class LinkBetweenItems(Engine):
             session.execute(
                 text('DELETE FROM "%s" WHERE content_type0 <> content_type1' % (self.__media__[0].tablename_similars)))
 
-        for media in self.__media__:
-            m = media(logger=self.logger)
-
-            if m.content_type in [
-                ContentType.APPLICATION,
-                ContentType.BOOK
-            ]:
-                continue
-
-            df_base, o_dfs = m.prepare_sim_between_content()
-
-            # Pre-calculate voc
-            vect = CountVectorizer(stop_words="english")
-
-            for i in range(len(o_dfs)):
-                st_time = datetime.utcnow()
-                df = pd.concat([df_base, o_dfs[i]])[:100_000]
-                # FIXME limitation of dataframe (Let's go to bigdata...), we juste need a cluster (currently, we use spark standalone)
-
-                # This can be done with less memory overhead by using generator
-                vocabulary = vect.fit(df["soup"]).vocabulary_
-
-                tfidf = TfidfVectorizer(
-                    stop_words="english", vocabulary=vocabulary, dtype=np.float32)
-
-                self.logger.debug("%s + %s data preparation performed in %s" %
-                                  (m.content_type, m.other_content_cmp[i], datetime.utcnow()-st_time))
-
-                # Construct the required TF-IDF matrix by fitting and transforming the data
-                tfidf_matrix = tfidf.fit_transform(df['soup'])
-
-                self.logger.debug("%s + %s TF-IDF transformation performed in %s" %
-                                  (m.content_type, m.other_content_cmp[i], datetime.utcnow()-st_time))
-
-                # Reset index of your main DataFrame and construct reverse mapping as before
-                df = df.reset_index()
-                indices = pd.Series(
-                    df.index,
-                    index=zip(df[m.id], df["content_type"])
-                )
-
-                tfidf_mat_para = parallelize_matrix(
-                    tfidf_matrix, rows_per_chunk=100)
-                tfidf_mat_dist = broadcast_matrix(tfidf_matrix)
-
-                values = tfidf_mat_para.flatMap(lambda submatrix: find_matches_in_submatrix(
-                    sources=csr_matrix(submatrix[1], shape=submatrix[2]),
-                    targets=tfidf_mat_dist,
-                    inputs_start_index=submatrix[0],
-                    indices=indices,
-                    real_indice_name=m.id,
-                    content_type=(m.content_type, m.other_content_cmp[i]),
-                    threshold=.8,
-                    max_sim=25)
-                ).collect()
-
-                self.logger.debug("%s + %s cosine sim performed in %s" %
-                                  (m.content_type, m.other_content_cmp[i], datetime.utcnow()-st_time))
-
-                if len(values) > 0:
-                    with db as session:
-                        markers = ':%s0, :%s1, :similarity, :content_type0, :content_type1' % (
-                            m.id, m.id)
-                        ins = 'INSERT INTO {tablename} VALUES ({markers})'
-                        ins = ins.format(
-                            tablename=m.tablename_similars, markers=markers)
-                        session.execute(ins, values)
-
+        self.for_each_media(self.train_media, medias=[media for media in self.__media__ if media.content_type not in [
+            ContentType.APPLICATION,
+            ContentType.BOOK
+        ]])
+
+    def train_media(self, media):
+        """Reload the similarities between a media and the other content types
+
+        Args:
+            media (type): media class
+        """
+        m = media(logger=self.logger)
+
+        store = m.features("name")
+        content_module = importlib.import_module("src.content")
+
+        for other in m.other_content_cmp:
+            st_time = datetime.utcnow()
+            o_store = getattr(content_module, str(other).capitalize())(
+                logger=self.logger).features("name")
+
+            self.logger.debug("%s + %s features loading performed in %s" %
+                              (m.content_type, other, datetime.utcnow()-st_time))
+
+            # Construct the required TF-IDF matrix from token counts of both content types
+            counts, content_ids, positions = stack_features(
+                [store, o_store])
+            tfidf = tfidf_from_counts(counts)[0]
+
+            self.logger.debug("%s + %s TF-IDF transformation performed in %s" %
+                              (m.content_type, other, datetime.utcnow()-st_time))
+
+            # Content type of each TF-IDF row (indexed by position)
+            content_types = np.array(
+                [m.content_type.code, other.code], dtype=np.uint8)[positions]
+
+            values = find_matches(
+                tfidf,
+                content_ids=content_ids,
+                content_types=content_types,
+                real_indice_name=m.id,
+                content_type=(m.content_type, other),
+                threshold=.8,
+                max_sim=25,
+                logger=self.logger)
+
+            # Records not consumed (failed write) hold Spark broadcasts, or blocked similarities files
+            with closing(values):
+                columns = ["%s0" % m.id, "%s1" % m.id,
+                           "similarity", "content_type0", "content_type1"]
+                if isinstance(values, SparkRecords) and values.write == "executors":
+                    # Partitions are written by the Spark executors
+                    len_values = values.copy(
+                        m.tablename_similars, columns, logger=self.logger)
+                    self.add_rows(len_values)
+                    self.logger.info("%s + %s similarity reloading performed in %s (%s lines)" %
+                                     (m.content_type, other, datetime.utcnow()-st_time, len_values))
+                    continue
+
+                # Records are written while the next ones are computed
+                writer = BulkWriter(m.tablename_similars,
+                                    columns, logger=self.logger)
+                len_values = 0
+                with self.writes("%s %s + %s" % (self.__class__.__name__, m.content_type, other)) as stage:
+                    for batch in batched(values, writer.batch_size):
+                        stage.submit(writer.write, batch)
+                        len_values += len(batch)
+                    stage.submit(writer.close)
+
+                self.add_rows(len_values)
                 self.logger.info("%s + %s similarity reloading performed in %s (%s lines)" %
-                                 (m.content_type, m.other_content_cmp[i], datetime.utcnow()-st_time, len(values)))
-            self.store_date(m.content_type)
+                                 (m.content_type, other, datetime.utcnow()-st_time, len_values))
+        self.store_date(m.content_type)
 
     def check_if_necessary(self):
         for media in self.__media__:
@@ -1,4 +1,4 @@
-from src.utils import db
+from src.utils import db, recommendations_cache
 from src.content import ContentType, Content
 from .engine import Engine
 
@@ -14,34 +14,72 @@ class Popularity(Engine):
 
     The main purpose it to recommend the top items based on popularity score
     """
+    # Weight of popular content in merged recommendation lists (see `UserServing`)
+    __engine_priority__ = 1
+    __reads__ = ["content"]
+    __writes__ = ["content.popularity_score"]
+    __memory__ = 256
 
     def train(self):
         """(Re)load popularity score of each media
         """
         if self.check_if_necessary() is False:
             return
-        # open a transaction
+
+        # Scores of each media are computed concurrently (queries), then published at once
+        scores = self.for_each_media(self.compute)
+        if len(scores) == 0:
+            return
+
+        st_time = datetime.utcnow()
+        published = pd.concat([scores[media] for media in self.__media__ if media in scores]).drop_duplicates(
+            subset=[Content.id], keep="first")
+        tablename = self.__media__[0].tablename
+
+        # Scores of failed media are kept as they are
+        failed_filt = "".join(' AND NOT EXISTS (SELECT 1 FROM "%s" AS f WHERE f.content_id = c.content_id)' % media.content_type
+                              for media in self.failed_media)
+
+        # open a transaction: scores are published at once, the table stays readable (no DDL, only row locks)
         with db as session:
-            # Reset popularity score (delete and re-add column for score)
-            session.execute(
-                text('ALTER TABLE "%s" DROP COLUMN popularity_score' % self.__media__[0].tablename))
             session.execute(
-                text('ALTER TABLE "%s" ADD COLUMN popularity_score DOUBLE PRECISION' % self.__media__[0].tablename))
-        for media in self.__media__:
-            st_time = datetime.utcnow()
-
-            m = media(logger=self.logger)
-            q_df = m.get_populars(size=1000)
-
-            # open a transaction
-            with db as session:
-                # Set new popularity score
-                for index, row in q_df.iterrows():
-                    session.execute(
-                        text("UPDATE %s SET popularity_score = %s WHERE %s = %s" % (m.tablename, row["popularity_score"], m.id, row[m.id])))
-            self.logger.debug("%s popularity reloading performed in %s (%s lines)" %
-                              (str(m.content_type) or "ALL CONTENT", datetime.utcnow()-st_time, q_df.shape[0]))
-            self.store_date(m.content_type)
+                text('CREATE TEMP TABLE "popularity_scores" (content_id INTEGER PRIMARY KEY, popularity_score DOUBLE PRECISION) ON COMMIT DROP'))
+            db.copy_from(session, "popularity_scores", [Content.id, "popularity_score"], (
+                {Content.id: int(content_id), "popularity_score": float(score)}
+                for content_id, score in zip(published[Content.id], published["popularity_score"])
+            ))
+
+            # Set new popularity scores and reset others, only changed rows are written
+            result = session.execute(
+                text('UPDATE "%s" AS c SET popularity_score = s.popularity_score FROM "%s" AS cc LEFT OUTER JOIN "popularity_scores" AS s ON s.content_id = cc.content_id ' % (tablename, tablename) +
+                     'WHERE c.content_id = cc.content_id AND c.popularity_score IS DISTINCT FROM s.popularity_score' + failed_filt))
+
+        self.add_rows(result.rowcount)
+        self.logger.info("popularity publishing performed in %s (%s scores, %s updated lines)" %
+                         (datetime.utcnow()-st_time, published.shape[0], result.rowcount))
+
+        for media in scores:
+            self.store_date(media.content_type)
+        # Popular content is part of every merged recommendation list
+        recommendations_cache.invalidate()
+
+    def compute(self, media):
+        """Popularity scores of a media
+
+        Args:
+            media (type): media class
+
+        Returns:
+            DataFrame: content id and popularity score of the most popular content
+        """
+        st_time = datetime.utcnow()
+
+        m = media(logger=self.logger)
+        q_df = m.get_populars(size=1000)
+
+        self.logger.debug("%s popularity computation performed in %s (%s lines)" %
+                          (str(m.content_type) or "ALL CONTENT", datetime.utcnow()-st_time, q_df.shape[0]))
+        return q_df[[m.id, "popularity_score"]]
 
     def check_if_necessary(self):
         for media in self.__media__:
@@ -0,0 +1,234 @@
+from src.content import ContentType, User, Profile, Interactions, SimilarsIndex
+from src.utils import db, recommendations_cache
+from .engine import Engine
+from .from_profile import FromProfile
+from .from_similar_content import FromSimilarContent
+from .collaborative_filtering import CollaborativeFiltering
+from .popularity import Popularity
+
+from threading import Lock
+from datetime import datetime
+from time import perf_counter
+import pandas as pd
+import numpy as np
+
+
+class ProfileServing:
+    """Warm in-process scoring of profiles (`RecommendProfile`), instead of a run of every engine per request
+
+    The genre matrix and similars index of every media are kept in memory (loaded at startup, then after each training run, see `warm`).
+    A profile request only loads the liked genres of the profile and its `recommendation_launched_meta`, and scores them
+    against these structures with the code of `FromSimilarContent` and `FromProfile`.
+    """
+    _lock = Lock()
+    # Content type -> (media, genre matrix (None if the media has no genre), similars index)
+    _catalog = None
+
+    @classmethod
+    def warm(cls, logger):
+        """(Re)load the structures of every media, requests keep using the previous ones meanwhile
+
+        Args:
+            logger (Logger): logger
+        """
+        st_time = datetime.utcnow()
+
+        catalog = {}
+        for media in Engine.__media__:
+            m = media(logger=logger)
+            genres = None
+            if m.content_type not in [
+                ContentType.APPLICATION,  # 1 seul genre par app ...
+                ContentType.BOOK  # Pas de genre pour les livres
+            ]:
+                genres = m.genre_matrix()
+            catalog[str(m.content_type)] = (m, genres, SimilarsIndex.load(m))
+
+        with cls._lock:
+            cls._catalog = catalog
+
+        logger.info("Profile serving warmed up in %s" %
+                    (datetime.utcnow()-st_time))
+
+    @classmethod
+    def is_warm(cls):
+        return cls._catalog is not None
+
+    @classmethod
+    def recommend(cls, profile_uuid, event_id, logger):
+        """Recommend media to a profile (same results as `FromSimilarContent` then `FromProfile` for this profile)
+
+        Args:
+            profile_uuid (str): profile uuid
+            event_id (int): recommendation event
+            logger (Logger): logger
+
+        Returns:
+            int: number of written lines
+        """
+        st_time = datetime.utcnow()
+        catalog = cls._catalog
+        assert catalog is not None, "Profile serving is not warmed up"
+
+        # Liked genres of every media, and interactions with every media (content ids are unique across media)
+        profile_df = Profile.get_with_genres(profile_uuid=profile_uuid)
+        interactions = Interactions.from_frame(Profile._reduce_metadata_memory(pd.read_sql_query(
+            'SELECT content_id, rating, review_see_count FROM "%s" WHERE event_id = \'%s\'' % (Profile.tablename_meta, event_id), con=db.engine)), "content_id")
+
+        similar_values, profile_values = cls.score(
+            catalog, profile_uuid, event_id, profile_df, interactions)
+
+        # Similar content first: like consecutive engine runs, the first written line of a content wins
+        columns = [Profile.event_id, "content_id", "score", "engine"]
+        on_conflict = "ON CONFLICT ON CONSTRAINT %s_pkey DO NOTHING" % Profile.tablename_recommended
+        with db as session:
+            for values in [similar_values, profile_values]:
+                if len(values) > 0:
+                    db.copy_rows(session, Profile.tablename_recommended,
+                                 columns, values, on_conflict)
+
+        len_values = len(similar_values) + len(profile_values)
+        logger.debug("Profile %s recommendation served in %s (%s lines)" % (
+            profile_uuid, datetime.utcnow()-st_time, len_values))
+        return len_values
+
+    @classmethod
+    def score(cls, catalog, profile_uuid, event_id, profile_df, interactions):
+        """Score a profile against the structures of every media (no database access)
+
+        Args:
+            catalog (dict): content type -> (media, genre matrix, similars index), see `warm`
+            profile_uuid (str): profile uuid
+            event_id (int): recommendation event
+            profile_df (DataFrame): liked genres of the profile (see `Profile.get_with_genres`), None if it has none
+            interactions (Interactions): interactions of the profile with every media
+
+        Returns:
+            tuple: (`FromSimilarContent` records, `FromProfile` records)
+        """
+        fsc = FromSimilarContent(profile_uuid=profile_uuid, event_id=event_id)
+        fsc.obj_df = profile_df
+        fsc.interactions = interactions
+        fsc.recommended = None
+
+        fp = FromProfile(profile_uuid=profile_uuid, event_id=event_id)
+        fp.obj_df = profile_df
+
+        similar_values, profile_values = [], []
+        for m, genres, similars in catalog.values():
+            if profile_df is None:
+                break
+
+            fsc.similars = similars
+            for _, content_ids, scores in fsc.recommend(0, 1):
+                similar_values.extend(cls.records(
+                    fsc, m, event_id, content_ids, scores))
+
+            if genres is None:
+                continue
+            fp.prepare(m, genres, interactions)
+            for _, content_ids, scores in fp.recommend(0, fp.users.shape[0]):
+                profile_values.extend(cls.records(
+                    fp, m, event_id, content_ids, scores))
+
+        return similar_values, profile_values
+
+    @staticmethod
+    def records(engine, m, event_id, content_ids, scores):
+        """`recommendation_launched_result` records of an engine
+        """
+        for id, score in zip(content_ids.tolist(), scores.tolist()):
+            yield {
+                Profile.event_id: event_id,
+                m.id: id,
+                "score": score,
+                "engine": engine.__class__.__name__,
+            }
+
+
+class UserServing:
+    """Read path of user recommendations: candidates of every engine merged in a single ranked list
+
+    Each candidate score (between 0 and 1, popularity scores are divided by the best one) is weighted by the `__engine_priority__` of its engine,
+    scores of a content recommended by several engines are summed.
+    Lists are cached (see `recommendations_cache`) until the engines write new recommendations for the user.
+    """
+    engines = [FromProfile, FromSimilarContent,
+               CollaborativeFiltering, Popularity]
+
+    @classmethod
+    def recommend(cls, user_uuid, content_type, k=20):
+        """Top-k recommended content of a type for a user
+
+        Args:
+            user_uuid (str): user uuid
+            content_type (ContentType): content type
+            k (int, optional): number of recommended content. Defaults to 20.
+
+        Returns:
+            list: recommended content (content_id, score, engines), None if the user does not exist
+        """
+        st_time = perf_counter()
+        key = (str(user_uuid), str(content_type), k)
+
+        result = recommendations_cache.get(key)
+        if result is not None:
+            recommendations_cache.observe("hit", perf_counter() - st_time)
+            return result
+
+        user_df = User.get(user_uuid=user_uuid)
+        if user_df.shape[0] == 0:
+            recommendations_cache.observe("miss", perf_counter() - st_time)
+            return None
+        user_id = int(user_df.iloc[0]["user_id"])
+
+        # Not cached if an engine rewrites the recommendations of the user meanwhile (the list may be partial)
+        generation = recommendations_cache.generation(user_id)
+        result = cls.merge(cls.candidates(user_id, content_type, k), k)
+
+        recommendations_cache.set(
+            key, result, owner=user_id, generation=generation)
+        recommendations_cache.observe("miss", perf_counter() - st_time)
+        return result
+
+    @classmethod
+    def candidates(cls, user_id, content_type, k):
+        """Recommendations of every engine for a user, and the `k` most popular content
+
+        Returns:
+            DataFrame: content_id, score and engine of each candidate
+        """
+        recommended = pd.read_sql_query('SELECT content_id, score, engine FROM "recommended_content" WHERE user_id = %s AND content_type = \'%s\'' % (
+            user_id, str(content_type).upper()), con=db.engine)
+
+        popular = pd.read_sql_query('SELECT c.content_id, c.popularity_score AS score FROM "content" AS c INNER JOIN "%s" AS ct ON ct.content_id = c.content_id WHERE c.popularity_score IS NOT NULL ORDER BY c.popularity_score DESC LIMIT %s' % (
+            content_type, k), con=db.engine)
+        if popular.shape[0] > 0 and popular["score"].iloc[0] > 0:
+            popular["score"] = popular["score"] / popular["score"].iloc[0]
+        popular["engine"] = Popularity.__name__
+
+        return pd.concat([recommended, popular], ignore_index=True)
+
+    @classmethod
+    def merge(cls, candidates, k):
+        """Weight candidates by engine priority, sum the scores of each content and keep the `k` best
+
+        Args:
+            candidates (DataFrame): content_id, score and engine of each candidate
+            k (int): number of recommended content
+
+        Returns:
+            list: recommended content (content_id, score, engines), best first
+        """
+        priorities = {engine.__name__: engine.__engine_priority__
+                      for engine in cls.engines}
+        candidates = candidates[candidates["engine"].isin(priorities)]
+
+        weighted = candidates["score"].to_numpy(
+            dtype=np.float64) * candidates["engine"].map(priorities).to_numpy(dtype=np.float64)
+        merged = candidates.assign(score=weighted).groupby("content_id").agg(
+            score=("score", "sum"), engines=("engine", lambda x: sorted(set(x))))
+        merged = merged.sort_values("score", ascending=False, kind="stable").head(k)
+
+        return [{"content_id": int(content_id), "score": float(row["score"]), "engines": row["engines"]}
+                for content_id, row in merged.iterrows()]
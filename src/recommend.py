@@ -1,24 +1,184 @@
-from src.engines import Popularity, ContentSimilarities, CollaborativeFiltering, FromProfile, FromSimilarContent, LinkBetweenItems
+from src.engines import Popularity, ContentSimilarities, CollaborativeFiltering, FromProfile, FromSimilarContent, LinkBetweenItems, ProfileServing
 from src.engines.engine import Engine
+from src.content import Interactions, AlreadyRecommended
+from src.scheduler import Stage, DagScheduler
+from settings import PROFILE_SERVING, JOBS_HISTORY
 
-from threading import Thread
+from threading import Thread, Lock, Event
+from collections import OrderedDict
 from datetime import datetime
 from flask import current_app
 import uuid
 
 
-class Recommend(Engine):
-    def train(self):
-        start_popularity_engine(wait=True)
-        start_similarities_engine(wait=True)
-        start_similarities_between_items_engine(wait=True)
+class Job:
+    """Run of an engine started by the service
+    """
+
+    def __init__(self, registry, engine, key):
+        """
+        Args:
+            registry (JobRegistry): registry notified once the run is over
+            engine (Engine): engine (not started)
+            key (tuple): engine name and arguments, runs with the same key are coalesced
+        """
+        self.registry = registry
+        self.engine = engine
+        self.key = key
+        self.id = uuid.uuid4().hex
+        self.status = "running"
+        self.submitted_at = datetime.utcnow()
+        self.finished_at = None
+        # Number of submissions coalesced into this run
+        self.duplicates = 0
+        # Set once the run is over (the engine thread may not be started yet when a submission waits for it)
+        self._finished = Event()
+
+        engine.job = self
+
+    @property
+    def rows(self):
+        return self.engine.rows
+
+    def finish(self):
+        """Record the outcome of the run (called by `Engine.run`)
+        """
+        self.finished_at = datetime.utcnow()
+        self.status = "succeeded" if self.engine.status is True else "failed"
+        self.registry.finished(self)
+        self._finished.set()
+
+    def wait(self):
+        self._finished.wait()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "engine": self.key[0],
+            "args": dict(self.key[1]),
+            "status": self.status,
+            "submitted_at": self.submitted_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at is not None else None,
+            "duration": self.engine.duration.total_seconds() if self.engine.duration is not None else None,
+            "rows": self.rows,
+            "error": repr(self.engine.error) if self.engine.error is not None else None,
+            "duplicates": self.duplicates,
+        }
+
+
+class JobRegistry:
+    """Engine runs of the service, with a bounded history
+
+    A submission of an engine already running with the same arguments does not start a new run,
+    it is coalesced into the running one (two identical engines would race on the same rows).
+    """
+
+    def __init__(self, history=JOBS_HISTORY):
+        """
+        Args:
+            history (int, optional): maximum number of finished jobs kept. Defaults to JOBS_HISTORY.
+        """
+        self.history = history
+        self._lock = Lock()
+        # Every kept job, by id (oldest first)
+        self._jobs = OrderedDict()
+        # Running jobs, by key
+        self._running = {}
+
+    def submit(self, engine_class, coalesce=True, **kwargs):
+        """Start an engine, unless it is already running with the same arguments
+
+        Args:
+            engine_class (type): engine class
+            coalesce (bool, optional): join a running job with the same arguments. If False, wait for its end and start a new run
+                (a run must see what was written before it was submitted, ex: a pipeline stage). Defaults to True.
+            kwargs: engine arguments
+
+        Returns:
+            tuple: (job, True if the submission was coalesced into a running job)
+        """
+        key = (engine_class.__name__, tuple(sorted(
+            (name, str(value)) for name, value in kwargs.items() if value is not None)))
+
+        while True:
+            with self._lock:
+                job = self._running.get(key)
+                if job is None:
+                    job = Job(self, engine_class(**kwargs), key)
+                    self._running[key] = job
+                    self._jobs[job.id] = job
+                    self._prune()
+                    break
+                if coalesce:
+                    job.duplicates += 1
+                    return job, True
+            # Two identical engines would race on the same rows
+            job.wait()
+
+        job.engine.start()
+        return job, False
+
+    def run(self, engine_class, wait=True, coalesce=True, **kwargs):
+        """Submit an engine, and wait for the end of its run
+
+        Returns:
+            Job: job
+        """
+        job, _ = self.submit(engine_class, coalesce=coalesce, **kwargs)
+        if wait:
+            job.wait()
+        return job
+
+    def finished(self, job):
+        with self._lock:
+            if self._running.get(job.key) is job:
+                del self._running[job.key]
+            self._prune()
+
+    def _prune(self):
+        finished = [id for id, job in self._jobs.items()
+                    if job.status != "running"]
+        for id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[id]
+
+    def get(self, id):
+        """Job by id, None if unknown (or out of the history)
+        """
+        with self._lock:
+            return self._jobs.get(id)
+
+    def list(self):
+        """Kept jobs, most recent first
+        """
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+
+jobs = JobRegistry()
 
-        start_from_similar_content_engine(wait=True)
-        start_from_profile_engine(wait=True)
-        start_collaborative_engine(wait=True)
 
-        start_from_similar_content_engine_for_group(wait=True)
-        start_from_profile_engine_for_group(wait=True)
+class Recommend(Engine):
+    def train(self):
+        # In the order of a sequential run, independent engines are run concurrently (see `DagScheduler`)
+        stages = [
+            pipeline_stage(Popularity),
+            pipeline_stage(ContentSimilarities),
+            pipeline_stage(LinkBetweenItems),
+            pipeline_stage(FromSimilarContent),
+            pipeline_stage(FromProfile),
+            pipeline_stage(CollaborativeFiltering),
+            pipeline_stage(FromSimilarContent, is_group=True),
+            pipeline_stage(FromProfile, is_group=True),
+        ]
+
+        # User interactions are loaded once for every engine, already recommended media once until an engine writes them
+        with Interactions.shared(), AlreadyRecommended.shared():
+            DagScheduler(stages, self.app, self.logger).run()
+        self.rows += sum(stage.job.rows for stage in stages if stage.job is not None)
+
+        # Profiles are served with the new similarities and popularity scores
+        if PROFILE_SERVING:
+            ProfileServing.warm(self.logger)
 
 
 class RecommendUser(Engine):
@@ -28,8 +188,10 @@ class RecommendUser(Engine):
         self.user_uuid = str(user_uuid)
 
     def train(self):
-        start_from_similar_content_engine(wait=True, user_uuid=self.user_uuid)
-        start_from_profile_engine(wait=True, user_uuid=self.user_uuid)
+        self.rows += start_from_similar_content_engine(
+            wait=True, user_uuid=self.user_uuid).rows
+        self.rows += start_from_profile_engine(
+            wait=True, user_uuid=self.user_uuid).rows
 
 
 class RecommendProfile(Engine):
@@ -40,66 +202,69 @@ class RecommendProfile(Engine):
         self.event_id = event_id
 
     def train(self):
+        if ProfileServing.is_warm():
+            ProfileServing.recommend(
+                self.profile_uuid, self.event_id, self.logger)
+            return
+
         start_from_similar_content_engine_for_profile(
             wait=True, profile_uuid=self.profile_uuid, event_id=self.event_id)
         start_from_profile_engine_for_profile(
             wait=True, profile_uuid=self.profile_uuid, event_id=self.event_id)
 
 
+class WarmProfileServing(Engine):
+    def train(self):
+        ProfileServing.warm(self.logger)
+
+
+def pipeline_stage(engine_class, **kwargs):
+    """Stage of a `DagScheduler` pipeline running an engine through the job registry
+
+    Args:
+        engine_class (type): engine class
+        kwargs: engine arguments
+
+    Returns:
+        Stage: stage
+    """
+    reads, writes = engine_class.tables(**kwargs)
+    name = engine_class.__name__ + \
+        "".join(" (%s)" % key for key, value in kwargs.items() if value is True)
+    # A running job with the same arguments may have started before the stages this one depends on wrote their tables: not joined
+    return Stage(name, lambda: jobs.run(engine_class, wait=True, coalesce=False, **kwargs), reads, writes, engine_class.__memory__)
+
+
 def start_popularity_engine(wait=True):
-    p = Popularity()
-    p.start()
-    if wait:
-        p.join()
+    return jobs.run(Popularity, wait=wait)
 
 
 def start_similarities_engine(wait=True):
-    c = ContentSimilarities()
-    c.start()
-    if wait:
-        c.join()
+    return jobs.run(ContentSimilarities, wait=wait)
 
 
 def start_similarities_between_items_engine(wait=True):
-    c = LinkBetweenItems()
-    c.start()
-    if wait:
-        c.join()
+    return jobs.run(LinkBetweenItems, wait=wait)
 
 
 def start_collaborative_engine(wait=True):
-    c = CollaborativeFiltering()
-    c.start()
-    if wait:
-        c.join()
+    return jobs.run(CollaborativeFiltering, wait=wait)
 
 
 def start_from_profile_engine(wait=True, user_uuid=None):
-    fup = FromProfile(user_uuid=user_uuid)
-    fup.start()
-    if wait:
-        fup.join()
+    return jobs.run(FromProfile, wait=wait, user_uuid=user_uuid)
 
 
 def start_from_similar_content_engine(wait=True, user_uuid=None):
-    fsc = FromSimilarContent(user_uuid=user_uuid)
-    fsc.start()
-    if wait:
-        fsc.join()
+    return jobs.run(FromSimilarContent, wait=wait, user_uuid=user_uuid)
 
 
 def start_from_profile_engine_for_group(wait=True, group_id=None):
-    fup = FromProfile(group_id=group_id, is_group=True)
-    fup.start()
-    if wait:
-        fup.join()
+    return jobs.run(FromProfile, wait=wait, group_id=group_id, is_group=True)
 
 
 def start_from_similar_content_engine_for_group(wait=True, group_id=None):
-    fsc = FromSimilarContent(group_id=group_id, is_group=True)
-    fsc.start()
-    if wait:
-        fsc.join()
+    return jobs.run(FromSimilarContent, wait=wait, group_id=group_id, is_group=True)
 
 
 def start_from_profile_engine_for_profile(profile_uuid, event_id, wait=True):
@@ -107,6 +272,7 @@ def start_from_profile_engine_for_profile(profile_uuid, event_id, wait=True):
     fup.start()
     if wait:
         fup.join()
+    return fup
 
 
 def start_from_similar_content_engine_for_profile(profile_uuid, event_id, wait=True):
@@ -114,3 +280,8 @@ def start_from_similar_content_engine_for_profile(profile_uuid, event_id, wait=T
     fsc.start()
     if wait:
         fsc.join()
+    return fsc
+
+
+def start_profile_serving_warmup(wait=True):
+    return jobs.run(WarmProfileServing, wait=wait)
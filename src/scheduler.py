@@ -0,0 +1,142 @@
+from settings import PIPELINE_CONCURRENCY, PIPELINE_MEMORY_BUDGET
+
+from threading import Thread, Condition
+from time import perf_counter
+
+import contextvars
+
+
+class Stage:
+    """Engine run of a pipeline
+    """
+
+    def __init__(self, name, start, reads, writes, memory):
+        """
+        Args:
+            name (str): name of the stage in the report
+            start (callable): run the engine and wait for its end, returns its job (see `JobRegistry.run`)
+            reads (set): tables read by the engine
+            writes (set): tables written by the engine
+            memory (int): rough peak memory of the engine (MB)
+        """
+        self.name = name
+        self.start = start
+        self.reads = reads
+        self.writes = writes
+        self.memory = memory
+
+        self.job = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        return self.finished - self.started
+
+
+class DagScheduler:
+    """Run the stages of a pipeline concurrently, in an order given by the tables they read and write
+
+    A stage depends on a stage declared before it when it reads a table that stage writes, writes a table that stage reads (its input would change
+    during its run), or writes the same table (the declaration order of writes is kept). Ready stages are started in declaration order,
+    as long as less than `concurrency` stages are running and the memory of running stages stays within `memory_budget`
+    (a stage is always started if nothing else runs).
+
+    A failed engine does not stop its dependents: like consecutive runs, they use what is in the database.
+    """
+
+    def __init__(self, stages, app, logger, concurrency=PIPELINE_CONCURRENCY, memory_budget=PIPELINE_MEMORY_BUDGET):
+        """
+        Args:
+            stages (list): stages, in the order of a sequential run
+            app (Flask): application (stages are run in its context)
+            logger (Logger): logger
+            concurrency (int, optional): maximum number of running stages. Defaults to PIPELINE_CONCURRENCY.
+            memory_budget (int, optional): maximum memory of running stages (MB). Defaults to PIPELINE_MEMORY_BUDGET.
+        """
+        self.stages = stages
+        self.app = app
+        self.logger = logger
+        self.concurrency = max(1, concurrency)
+        self.memory_budget = memory_budget
+
+        self.dependencies = {stage.name: [
+            previous.name for previous in stages[:i] if stage.reads & previous.writes or stage.writes & (previous.reads | previous.writes)]
+            for i, stage in enumerate(stages)}
+
+    def run(self):
+        """Run every stage, then report the wall-clock time and the critical path
+
+        Returns:
+            list: stages of the critical path
+        """
+        st_time = perf_counter()
+        self._condition = Condition()
+        pending = list(self.stages)
+        running = []
+        done = set()
+
+        with self._condition:
+            while len(pending) > 0 or len(running) > 0:
+                for stage in list(pending):
+                    if len(running) >= self.concurrency:
+                        break
+                    if not all(name in done for name in self.dependencies[stage.name]):
+                        continue
+                    if len(running) > 0 and sum(s.memory for s in running) + stage.memory > self.memory_budget:
+                        continue
+
+                    pending.remove(stage)
+                    running.append(stage)
+                    stage.started = perf_counter() - st_time
+                    # Stages see the tables shared by the pipeline (see `Interactions.shared`)
+                    Thread(target=contextvars.copy_context().run, args=(
+                        self._run_stage, stage, st_time), daemon=True).start()
+
+                self._condition.wait()
+                for stage in [s for s in running if s.finished is not None]:
+                    running.remove(stage)
+                    done.add(stage.name)
+
+        wall_clock = perf_counter() - st_time
+        path = self.critical_path()
+
+        for stage in self.stages:
+            self.logger.info("pipeline: %s ran from %.1fs to %.1fs (%s, after %s)" % (
+                stage.name, stage.started, stage.finished, stage.job.status if stage.job is not None else "failed", ", ".join(self.dependencies[stage.name]) or "-"))
+        self.logger.info("pipeline performed in %.1fs (%.1fs if run sequentially), critical path %.1fs: %s" % (
+            wall_clock, sum(s.duration for s in self.stages), sum(s.duration for s in path), " -> ".join("%s (%.1fs)" % (s.name, s.duration) for s in path)))
+
+        return path
+
+    def _run_stage(self, stage, st_time):
+        try:
+            with self.app.app_context():
+                stage.job = stage.start()
+        except Exception as e:
+            self.logger.error("pipeline: %s failed to start: %s" %
+                              (stage.name, e))
+        finally:
+            with self._condition:
+                stage.finished = perf_counter() - st_time
+                self._condition.notify()
+
+    def critical_path(self):
+        """Chain of dependent stages that determined the end of the run (each stage waited for the previous one)
+
+        Returns:
+            list: stages, first to last
+        """
+        if len(self.stages) == 0:
+            return []
+        by_name = {stage.name: stage for stage in self.stages}
+
+        stage = max(self.stages, key=lambda s: s.finished)
+        path = [stage]
+        while len(self.dependencies[stage.name]) > 0:
+            # The dependency that finished last is the one the stage waited for
+            stage = max((by_name[name] for name in self.dependencies[stage.name]),
+                        key=lambda s: s.finished)
+            path.append(stage)
+
+        return path[::-1]
@@ -1,4 +1,12 @@
-from .db import db
-from .spark import sc, broadcast_matrix, parallelize_matrix, find_matches_in_submatrix
-from .sim import clean_data, create_soup
+from .db import db, BulkWriter
+from .spark import spark_context, broadcast_matrix, broadcast_value, parallelize_matrix, find_matches_in_submatrix, SparkRecords
+from .topk import top_k_similarities, padded_top_k, merge_top_k, dense_top_k, similarity_records
+from .blocked import BlockedSimilarities, peak_rss
+from .ann import MinHashSimilarities, evaluate_recall
+from .matches import find_matches, batched
+from .parallel import map_chunks, process_pool, run_task
+from .cache import LRUCache, recommendations_cache
+from .state import SimilarityState
+from .features import FeatureStore, stack_features, directory_lock, swap_directory
+from .sim import clean_data, create_soup, tfidf_matrix, count_tokens, tfidf_from_counts
 from .singleton import Singleton
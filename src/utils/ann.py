@@ -0,0 +1,217 @@
+from .blocked import BlockedSimilarities
+from .topk import top_k_similarities, select_top_k, padded_top_k
+
+from time import perf_counter
+
+import numpy as np
+
+# Odd 64 bits constant used to mix the minhashes of a band into a single bucket key
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+class MinHashSimilarities(BlockedSimilarities):
+    """Approximate top-k similarities with MinHash LSH (banded bucketing)
+
+    Candidates of a source are the items sharing the same bucket in at least one band; they are re-ranked with the exact cosine similarity.
+    Two items without any common token never collide, so candidate generation stays far below the quadratic brute force.
+    Tokens present in more than `max_df` of the documents are left out of the signatures: they weigh little in TF-IDF but would put nearly every item in the same buckets.
+    Rows without any signature token fall back to the exact path.
+    """
+
+    def __init__(self, matrix, source_rows, k, threshold=.5, n_bands=20, band_size=2, max_df=.05, max_bucket_size=1000, seed=0, **kwargs):
+        """
+        Args:
+            n_bands (int, optional): number of bands (more bands, better recall). Defaults to 20.
+            band_size (int, optional): number of minhashes in a band (larger bands, less candidates). Defaults to 2.
+            max_df (float, optional): maximum document frequency of a signature token. Defaults to .05.
+            max_bucket_size (int, optional): larger buckets are ignored for candidate generation. Defaults to 1000.
+            seed (int, optional): random seed of hash functions. Defaults to 0.
+
+        See `BlockedSimilarities` for other arguments.
+        """
+        super().__init__(matrix, source_rows, k, threshold=threshold, **kwargs)
+        self.n_bands = n_bands
+        self.band_size = band_size
+        self.max_df = max_df
+        self.max_bucket_size = max_bucket_size
+        self.seed = seed
+
+        self.has_signature = None
+        self.band_keys = None
+        self.band_orders = None
+        self.band_sorted_keys = None
+        self.mean_candidates = None
+
+    def build_index(self):
+        """Compute MinHash signatures of every row and sort them into buckets, band by band
+        """
+        n_rows, n_features = self.matrix.shape
+        row_of_entry = np.repeat(
+            np.arange(n_rows), np.diff(self.matrix.indptr))
+
+        # Leave out too frequent tokens
+        doc_freq = np.bincount(self.matrix.indices, minlength=n_features)
+        kept = (doc_freq <= max(1, self.max_df * n_rows))[self.matrix.indices]
+        indices = self.matrix.indices[kept]
+        counts = np.bincount(row_of_entry[kept], minlength=n_rows)
+
+        self.has_signature = counts > 0
+        # `reduceat` over non empty rows only (contiguous segments)
+        starts = (np.cumsum(counts) - counts)[self.has_signature]
+
+        rng = np.random.default_rng(self.seed)
+        self.band_keys = np.zeros(
+            (self.n_bands, n_rows), dtype=np.uint64)
+        for band in range(self.n_bands):
+            keys = np.zeros(int(self.has_signature.sum()), dtype=np.uint64)
+            for _ in range(self.band_size):
+                # A random permutation of the vocabulary is a hash function
+                permutation = rng.permutation(
+                    n_features).astype(np.uint64)
+                if starts.shape[0] > 0:
+                    keys = keys * _MIX + \
+                        np.minimum.reduceat(permutation[indices], starts)
+            self.band_keys[band, self.has_signature] = keys
+
+        self.band_orders = np.argsort(self.band_keys, axis=1, kind="stable")
+        self.band_sorted_keys = np.take_along_axis(
+            self.band_keys, self.band_orders, axis=1)
+
+        # Expected number of candidates of a source (each member of a bucket gets the whole bucket)
+        pairs = 0
+        for band in range(self.n_bands):
+            sorted_keys = self.band_sorted_keys[band, self.has_signature[self.band_orders[band]]]
+            bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+            sizes = np.diff(np.concatenate(
+                [[0], bounds, [sorted_keys.shape[0]]]))
+            sizes = sizes[sizes <= self.max_bucket_size]
+            pairs += int((sizes.astype(np.int64) ** 2).sum())
+        self.mean_candidates = pairs / max(1, n_rows)
+
+    def candidates(self, rows):
+        """Candidate pairs of some source rows
+
+        Args:
+            rows (np.ndarray): source row positions
+
+        Returns:
+            tuple: (position in `rows`, candidate row position) ordered by source
+        """
+        n_rows = self.matrix.shape[0]
+        owners = np.flatnonzero(self.has_signature[rows])
+
+        pairs = []
+        for band in range(self.n_bands):
+            keys = self.band_keys[band, rows[owners]]
+            lo = np.searchsorted(self.band_sorted_keys[band], keys, "left")
+            size = np.searchsorted(
+                self.band_sorted_keys[band], keys, "right") - lo
+
+            ok = size <= self.max_bucket_size
+            src, lo, size = owners[ok], lo[ok], size[ok]
+
+            # Expand each bucket [lo, lo+size) to its members
+            offsets = np.arange(size.sum()) - np.repeat(np.cumsum(size) - size, size)
+            members = self.band_orders[band, np.repeat(lo, size) + offsets]
+            pairs.append(np.repeat(src, size).astype(np.int64)
+                         * n_rows + members)
+
+        pairs = np.unique(np.concatenate(pairs)) if len(
+            pairs) > 0 else np.zeros(0, dtype=np.int64)
+        return pairs // n_rows, pairs % n_rows
+
+    def block_size(self):
+        """Number of sources handled at once, derived from the RAM budget and the expected number of candidates
+
+        Returns:
+            int: number of sources in a block
+        """
+        nnz_per_row = max(1, self.matrix.nnz /
+                          max(1, self.matrix.shape[0]))
+        # Each pair needs its key and both rows for re-ranking, keep a x4 margin for skewed buckets
+        bytes_per_source = 4 * max(1, self.mean_candidates) * \
+            (8 + 2 * nnz_per_row * 8)
+        return int(max(1, min(self.source_rows.shape[0], self.ram_budget / 2 / bytes_per_source)))
+
+    def compute(self):
+        """Compute the approximate top-k similars of every source row, results are stored in `targets` and `similarities` memmaps
+        """
+        self.allocate()
+        self.build_index()
+
+        row_block = self.block_size()
+        for row_start in range(0, self.source_rows.shape[0], row_block):
+            block = slice(row_start, row_start+row_block)
+            rows = self.source_rows[block]
+
+            owners, members = self.candidates(rows)
+            sims = np.asarray(self.matrix[rows[owners]].multiply(
+                self.matrix[members]).sum(axis=1)).ravel()
+
+            kept = sims >= self.threshold
+            owners, members, sims = select_top_k(
+                owners[kept], members[kept], sims[kept], rows.shape[0], self.k)
+            self.targets[block], self.similarities[block] = padded_top_k(
+                owners, members, sims, rows.shape[0], self.k)
+
+        # Exact path for rows without signature
+        fallback = np.flatnonzero(~self.has_signature[self.source_rows])
+        if fallback.shape[0] > 0:
+            targets_t = self.matrix.T.tocsr()
+            for start in range(0, fallback.shape[0], 100):
+                positions = fallback[start:start+100]
+                rows, cols, sims = top_k_similarities(
+                    self.matrix[self.source_rows[positions]], targets_t, k=self.k, threshold=self.threshold)
+                self.targets[positions], self.similarities[positions] = padded_top_k(
+                    rows, cols, sims, positions.shape[0], self.k)
+
+        self.targets.flush()
+        self.similarities.flush()
+
+
+def evaluate_recall(matrix, sample=1000, k=10, threshold=.5, seed=0, **params):
+    """Measure recall@k of `MinHashSimilarities` against the exact top-k, on a sample of rows
+
+    Args:
+        matrix (csr_matrix): L2-normalized TF-IDF matrix
+        sample (int, optional): number of source rows evaluated. Defaults to 1000.
+        k (int, optional): number of similars of a source. Defaults to 10.
+        threshold (float, optional): minimum similarity. Defaults to .5.
+        seed (int, optional): random seed of the sample. Defaults to 0.
+        params: `MinHashSimilarities` parameters
+
+    Returns:
+        dict: recall, number of exact pairs, exact and approximate durations (seconds)
+    """
+    rng = np.random.default_rng(seed)
+    source_rows = np.sort(rng.choice(
+        matrix.shape[0], size=min(sample, matrix.shape[0]), replace=False))
+
+    def pairs(targets):
+        return set(
+            (int(source_rows[i]), int(target))
+            for i, row in enumerate(targets)
+            for target in row
+            if target >= 0 and target != source_rows[i]
+        )
+
+    # Keep `k+1` best matches because the source itself is among them
+    st_time = perf_counter()
+    rows, cols, sims = top_k_similarities(
+        matrix[source_rows], matrix.T.tocsr(), k=k+1, threshold=threshold)
+    exact, _ = padded_top_k(rows, cols, sims, source_rows.shape[0], k+1)
+    exact_duration = perf_counter() - st_time
+
+    st_time = perf_counter()
+    with MinHashSimilarities(matrix, source_rows, k=k+1, threshold=threshold, **params) as ann:
+        ann.compute()
+        approximate = np.asarray(ann.targets)
+    ann_duration = perf_counter() - st_time
+
+    exact, approximate = pairs(exact), pairs(approximate)
+    return {
+        "recall": len(exact & approximate) / max(1, len(exact)),
+        "exact_pairs": len(exact),
+        "exact_duration": exact_duration,
+        "ann_duration": ann_duration,
+    }
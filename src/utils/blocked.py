@@ -0,0 +1,140 @@
+from settings import ENGINE_DATA_DIR, SIMILARITY_RAM_BUDGET
+from .topk import top_k_similarities, padded_top_k, merge_top_k, similarity_records
+
+import numpy as np
+import tempfile
+import resource
+import shutil
+import os
+
+
+def peak_rss():
+    """Peak resident set size of the current process
+
+    Returns:
+        float: peak RSS in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BlockedSimilarities:
+    """Out-of-core top-k similarities of a whole TF-IDF matrix
+
+    Targets are processed by column blocks (transposed once per block), sources by row blocks.
+    The running top-k of every source is spilled to memory-mapped files and merged with the top-k of each new block,
+    so the process only holds one block product at a time, whatever the catalog size.
+    """
+
+    def __init__(self, matrix, source_rows, k, threshold=.5, ram_budget=SIMILARITY_RAM_BUDGET, directory=ENGINE_DATA_DIR):
+        """
+        Args:
+            matrix (csr_matrix): L2-normalized TF-IDF matrix
+            source_rows (np.ndarray): positions of the rows we want the similars of
+            k (int): number of similars kept for each source
+            threshold (float, optional): minimum similarity. Defaults to .5.
+            ram_budget (int, optional): RAM budget in MB. Defaults to SIMILARITY_RAM_BUDGET.
+            directory (str, optional): where memory-mapped files are created. Defaults to ENGINE_DATA_DIR.
+        """
+        self.matrix = matrix
+        self.source_rows = source_rows
+        self.k = k
+        self.threshold = threshold
+        self.ram_budget = ram_budget * 2**20
+        self.directory = directory
+
+        self.tmp_directory = None
+        self.targets = None
+        self.similarities = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err, message, traceback):
+        self.close()
+
+    def block_sizes(self):
+        """Derive block sizes from the RAM budget
+
+        Returns:
+            tuple: (source rows, target rows) per block
+        """
+        n_rows = self.matrix.shape[0]
+        bytes_per_row = max(1, self.matrix.nnz / max(1, n_rows)) * 8
+
+        # A quarter of the budget for the transposed targets (value + index of each entry)
+        cols = int(min(n_rows, max(1, self.ram_budget / 4 / bytes_per_row)))
+        # Half of the budget for a block product, in the worst (dense) case
+        rows = int(min(self.source_rows.shape[0],
+                       max(1, self.ram_budget / 2 / (cols * 8))))
+
+        return max(1, rows), max(1, cols)
+
+    def allocate(self):
+        """Create the memory-mapped `targets` and `similarities` arrays (one row of `k` slots per source)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.tmp_directory = tempfile.mkdtemp(
+            prefix="similarities_", dir=self.directory)
+
+        shape = (self.source_rows.shape[0], self.k)
+        self.targets = np.memmap(os.path.join(
+            self.tmp_directory, "targets.dat"), dtype=np.int64, mode="w+", shape=shape)
+        self.similarities = np.memmap(os.path.join(
+            self.tmp_directory, "similarities.dat"), dtype=np.float32, mode="w+", shape=shape)
+        self.targets[:] = -1
+        self.similarities[:] = -1
+
+    def compute(self):
+        """Compute the top-k similars of every source row, results are stored in `targets` and `similarities` memmaps
+        """
+        self.allocate()
+
+        row_block, col_block = self.block_sizes()
+        for col_start in range(0, self.matrix.shape[0], col_block):
+            targets_t = self.matrix[col_start:col_start+col_block].T.tocsr()
+
+            for row_start in range(0, self.source_rows.shape[0], row_block):
+                block = slice(row_start, row_start+row_block)
+                sources = self.matrix[self.source_rows[block]]
+
+                rows, cols, sims = top_k_similarities(
+                    sources, targets_t, k=self.k, threshold=self.threshold)
+                block_targets, block_sims = padded_top_k(
+                    rows, cols + col_start, sims, sources.shape[0], self.k)
+
+                self.targets[block], self.similarities[block] = merge_top_k(
+                    self.targets[block], self.similarities[block], block_targets, block_sims)
+
+        self.targets.flush()
+        self.similarities.flush()
+
+    def records(self, content_ids, content_types, real_indice_name, content_type, rows_per_block=10_000):
+        """Read back computed similarities as `similars_content` records, one block at a time
+
+        Args:
+            content_ids (np.ndarray): uint32 content id of each TF-IDF row
+            content_types (np.ndarray): uint8 content type code of each TF-IDF row
+            real_indice_name (str): name of the content id column
+            content_type (tuple): (source, target) `ContentType`
+            rows_per_block (int, optional): number of sources read at once. Defaults to 10_000.
+
+        Yields:
+            dict: similarity record
+        """
+        for start in range(0, self.source_rows.shape[0], rows_per_block):
+            targets = np.asarray(self.targets[start:start+rows_per_block])
+            sims = np.asarray(self.similarities[start:start+rows_per_block])
+            sources = np.broadcast_to(
+                self.source_rows[start:start+rows_per_block, None], targets.shape)
+
+            valid = targets >= 0
+            yield from similarity_records(sources[valid], targets[valid], sims[valid], content_ids, content_types, real_indice_name, content_type)
+
+    def close(self):
+        """Drop memory-mapped files
+        """
+        self.targets = None
+        self.similarities = None
+        if self.tmp_directory is not None:
+            shutil.rmtree(self.tmp_directory, ignore_errors=True)
+            self.tmp_directory = None
@@ -0,0 +1,159 @@
+from settings import RECOMMEND_CACHE_SIZE, RECOMMEND_CACHE_TTL
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+import bisect
+
+
+class LRUCache:
+    """Bounded, thread-safe LRU cache whose entries expire after `ttl` seconds
+
+    Each entry has an owner (ex: the user id of a recommendation list), entries of some owners can be dropped at once with `invalidate`.
+    A value computed while its owner is invalidated must not be cached: read the `generation` of the owner before computing it,
+    and give it to `set`, which drops the value if the owner has been invalidated since.
+    Lookups are counted, and their latency is recorded in a histogram (see `observe` and `metrics`).
+    """
+    # Upper bounds (ms) of the latency histogram buckets, the last bucket is unbounded
+    buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
+    def __init__(self, maxsize=RECOMMEND_CACHE_SIZE, ttl=RECOMMEND_CACHE_TTL):
+        """
+        Args:
+            maxsize (int, optional): maximum number of entries. Defaults to RECOMMEND_CACHE_SIZE.
+            ttl (float, optional): lifetime of an entry (in seconds). Defaults to RECOMMEND_CACHE_TTL.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._lock = Lock()
+        # key -> (expiry, owner, value), least recently used first
+        self._entries = OrderedDict()
+        # owner -> keys
+        self._owners = {}
+        # Bumped by each invalidation of every entry, and by each invalidation of an owner since (see `generation`)
+        self._epoch = 0
+        self._generations = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.latencies = {"hit": [0] * (len(self.buckets) + 1),
+                          "miss": [0] * (len(self.buckets) + 1)}
+
+    def get(self, key):
+        """Get a value, None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def generation(self, owner):
+        """Invalidation count of an owner, read it before computing a value of this owner (see `set`)
+
+        Returns:
+            tuple: generation
+        """
+        with self._lock:
+            return self._epoch, self._generations.get(owner, 0)
+
+    def set(self, key, value, owner=None, generation=None):
+        """Add (or replace) a value, the least recently used entry is dropped if the cache is full
+
+        Args:
+            key (tuple): key
+            value (object): value
+            owner (object, optional): owner of the entry (see `invalidate`). Defaults to None.
+            generation (tuple, optional): generation of the owner when the value was computed, the value is dropped if it changed. Defaults to None.
+
+        Returns:
+            bool: False if the value was dropped
+        """
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(owner, 0)):
+                return False
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (monotonic() + self.ttl, owner, value)
+            self._owners.setdefault(owner, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+            return True
+
+    def invalidate(self, owners=None):
+        """Drop the entries of some owners
+
+        Args:
+            owners (iterable, optional): owners. Defaults to None (every entry).
+        """
+        with self._lock:
+            if owners is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._owners.clear()
+                self._epoch += 1
+                self._generations.clear()
+                return
+
+            for owner in owners:
+                self._generations[owner] = self._generations.get(owner, 0) + 1
+                for key in self._owners.pop(owner, ()):
+                    del self._entries[key]
+                    self.invalidations += 1
+
+    def _remove(self, key):
+        _, owner, _ = self._entries.pop(key)
+        keys = self._owners[owner]
+        keys.discard(key)
+        if len(keys) == 0:
+            del self._owners[owner]
+
+    def observe(self, outcome, seconds):
+        """Record the latency of a request
+
+        Args:
+            outcome (str): "hit" or "miss"
+            seconds (float): latency
+        """
+        with self._lock:
+            self.latencies[outcome][bisect.bisect_left(
+                self.buckets, seconds * 1000)] += 1
+
+    def metrics(self):
+        """Size, hit ratio and latency histograms (count of requests per bucket, by upper bound in ms)
+
+        Returns:
+            dict: metrics
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else None,
+                "invalidations": self.invalidations,
+                "latency_ms": {
+                    outcome: dict(zip([str(b) for b in self.buckets] + ["+inf"], counts))
+                    for outcome, counts in self.latencies.items()
+                },
+            }
+
+
+# Merged recommendation lists served by `GET /recommend/<user_uuid>`, by (user uuid, content type, k), owned by the user id
+recommendations_cache = LRUCache()
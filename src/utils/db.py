@@ -1,6 +1,11 @@
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from itertools import islice
+from time import perf_counter
 import os
+import io
+import threading
+import csv
 import sys
 from flask import current_app
 
@@ -12,28 +17,202 @@ class Database(Singleton):
     engine = create_engine(DB_URI)
     Session = sessionmaker(bind=engine)
 
-    __current = None
+    # Current session of each thread (engines and their writer threads use the database at the same time)
+    __local = threading.local()
 
     def get_new_session(self):
         return self.Session()
 
     def __enter__(self):
         # close session if for any reason, it is not
-        if self.__current is not None and self.__current.is_active:
-            self.__current.close()
+        current = getattr(self.__local, "current", None)
+        if current is not None and current.is_active:
+            current.close()
 
-        self.__current = self.get_new_session()
-        return self.__current
+        self.__local.current = self.get_new_session()
+        return self.__local.current
 
     def __exit__(self, err, message, traceback):
+        current = self.__local.current
         if err is None and message is None and traceback is None:
-            self.__current.commit()
+            current.commit()
         else:
-            self.__current.rollback()
+            current.rollback()
             current_app._get_current_object().logger.error(
                 "Error occured during db session process")
 
-        self.__current.close()
+        current.close()
+        self.__local.current = None
+
+    def copy_from(self, session, tablename, columns, rows):
+        """Stream rows into a table with `COPY FROM STDIN` (CSV)
+
+        Args:
+            session (Session): current session
+            tablename (str): target table
+            columns (list): column name of each row value
+            rows (iterable): rows as dict (column name -> value)
+
+        Returns:
+            int: number of copied rows
+        """
+        stream = CsvStream(rows, columns)
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH (FORMAT csv)' % (
+            tablename, ", ".join('"%s"' % c for c in columns)), stream)
+
+        return stream.count
+
+    def copy_rows(self, session, tablename, columns, rows, on_conflict=""):
+        """Bulk insert rows with `COPY FROM STDIN`
+
+        Rows are streamed (CSV) into a temporary staging table, then merged into `tablename` with a single `INSERT ... SELECT`,
+        so the `ON CONFLICT` clause of a regular insert still applies.
+
+        Args:
+            session (Session): current session (the merge is part of its transaction)
+            tablename (str): target table
+            columns (list): column name of each row value
+            rows (iterable): rows as dict (column name -> value)
+            on_conflict (str, optional): ON CONFLICT clause of the merge. Defaults to "".
+
+        Returns:
+            int: number of copied rows
+        """
+        staging = "staging_%s" % tablename
+        cols = ", ".join('"%s"' % c for c in columns)
+
+        session.execute('CREATE TEMP TABLE "%s" (LIKE "%s" INCLUDING DEFAULTS) ON COMMIT DROP' % (
+            staging, tablename))
+
+        count = self.copy_from(session, staging, columns, rows)
+
+        session.execute('INSERT INTO "%s" (%s) SELECT %s FROM "%s" %s' % (
+            tablename, cols, cols, staging, on_conflict))
+        session.execute('DROP TABLE "%s"' % staging)
+
+        return count
+
+
+class CsvStream:
+    """Read-only file-like object turning rows into CSV lines on demand (see `cursor.copy_expert`)
+    """
+
+    def __init__(self, rows, columns, rows_per_read=10_000):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.rows_per_read = rows_per_read
+        self.count = 0
+
+    def read(self, size=-1):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        for row in islice(self.rows, self.rows_per_read):
+            writer.writerow([row[c] for c in self.columns])
+            self.count += 1
+        return buffer.getvalue()
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class BulkWriter:
+    """Buffer rows of a table and write them with `COPY FROM STDIN` (see `Database.copy_rows`)
+
+    Use it as a context manager, remaining rows are written on exit and the write rate is reported in the log.
+    Do not write inside a `with db as session` block: a flush opens its own session.
+
+    With `reset`, written rows replace the previous rows of some keys (ex: recommendations of some users):
+    keys given to `write` are reset in the transaction of the flush that writes their rows, readers never see them without rows.
+    """
+
+    def __init__(self, tablename, columns, on_conflict="", logger=None, batch_size=100_000, reset=None):
+        """
+        Args:
+            tablename (str): target table
+            columns (list): column name of each row value
+            on_conflict (str, optional): ON CONFLICT clause of the merge. Defaults to "".
+            logger (Logger, optional): logger used to report the write rate. Defaults to the current app logger.
+            batch_size (int, optional): number of buffered rows before a flush. Defaults to 100_000.
+            reset (callable, optional): `reset(session, keys)` deletes the previous rows of some keys. Defaults to None.
+        """
+        self.tablename = tablename
+        self.columns = columns
+        self.on_conflict = on_conflict
+        self.logger = logger or current_app._get_current_object().logger
+        self.batch_size = batch_size
+        self.reset = reset
+
+        self.buffer = []
+        # Keys to reset with the buffered rows
+        self.keys = []
+        self.count = 0
+        self.duration = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err, message, traceback):
+        if err is None:
+            self.close()
+
+    def write(self, rows, keys=()):
+        """Add rows (dict) to the buffer, flush it if it is full
+
+        Rows of a call are flushed together (a key is never reset in a flush and written in the next one).
+
+        Args:
+            rows (iterable): rows to write
+            keys (iterable, optional): keys whose previous rows are replaced by these rows (see `reset`). Defaults to ().
+        """
+        self.buffer.extend(rows)
+        self.keys.extend(keys)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Reset buffered keys and write buffered rows, in a single transaction
+        """
+        if len(self.buffer) == 0 and len(self.keys) == 0:
+            return
+
+        st_time = perf_counter()
+        with db as session:
+            if self.reset is not None and len(self.keys) > 0:
+                self.reset(session, self.keys)
+            if len(self.buffer) > 0:
+                self.count += db.copy_rows(session, self.tablename,
+                                           self.columns, self.buffer, self.on_conflict)
+        self.duration += perf_counter() - st_time
+        self.buffer = []
+        self.keys = []
+
+    def close(self):
+        """Write remaining rows and report the write rate
+
+        Returns:
+            int: number of written rows
+        """
+        self.flush()
+        if self.count > 0:
+            self.logger.info("%s: %s rows written in %.1fs (%.0f rows/s)" % (
+                self.tablename, self.count, self.duration, self.count / max(self.duration, 1e-6)))
+        return self.count
+
+
+# Pooled connections are not shared with forked processes (workers of `process_pool`, forked by its fork server):
+# a connection opened by another process is discarded on checkout, and the pool opens a new one
+@event.listens_for(Database.engine, "connect")
+def _connect(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+
+@event.listens_for(Database.engine, "checkout")
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info["pid"] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid %s, attempting to check out in pid %s" % (connection_record.info["pid"], os.getpid()))
 
 
 db = Database()
@@ -0,0 +1,196 @@
+from settings import ENGINE_DATA_DIR
+
+from scipy.sparse import csr_matrix, vstack
+from contextlib import contextmanager
+
+import numpy as np
+import shutil
+import fcntl
+import json
+import uuid
+import os
+
+
+@contextmanager
+def directory_lock(path, exclusive=False):
+    """Lock a saved directory (`<path>.lock` file) against concurrent swaps, across threads and processes
+
+    Readers hold a shared lock while they open every file of the directory (meta and arrays must come from the same save),
+    writers an exclusive one while they swap a new directory in. Once opened, memory-mapped arrays stay valid after a swap.
+
+    Args:
+        path (str): directory
+        exclusive (bool, optional): exclusive (writer) lock. Defaults to False.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open("%s.lock" % path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def swap_directory(tmp_path, path):
+    """Replace a directory by a fully written one (see `directory_lock`)
+    """
+    with directory_lock(path, exclusive=True):
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+
+
+class FeatureStore:
+    """Token counts of a catalog, persisted in `<ENGINE_DATA_DIR>/features/<name>/`
+
+    The CSR arrays (`data.npy`, `indices.npy`, `indptr.npy`), the vocabulary (`vocabulary.npy`, token of each column)
+    and the id <-> row mapping (`content_ids.npy`, `id_order.npy`) are opened with `mmap_mode`, so a warm start only costs file opens.
+    The vocabulary is append-only while the store is only extended with new rows: columns keep their meaning until the next full rebuild,
+    which gets a new `generation`.
+    """
+    arrays = ["data", "indices", "indptr", "vocabulary", "content_ids", "id_order"]
+
+    def __init__(self, name, directory=ENGINE_DATA_DIR):
+        """
+        Args:
+            name (str): store name (ex: "movie_soup")
+            directory (str, optional): root directory. Defaults to ENGINE_DATA_DIR.
+        """
+        self.path = os.path.join(directory, "features", name)
+
+        self.fingerprint = None
+        self.generation = None
+        self.data = None
+        self.indices = None
+        self.indptr = None
+        self.vocabulary = None
+        self.content_ids = None
+        self.id_order = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        """Open the store files
+
+        Returns:
+            bool: False if the store has never been built
+        """
+        with directory_lock(self.path):
+            if not os.path.isfile(self.file("meta.json")):
+                return False
+
+            with open(self.file("meta.json")) as f:
+                meta = json.load(f)
+            self.fingerprint = meta["fingerprint"]
+            self.generation = meta["generation"]
+
+            for name in self.arrays:
+                setattr(self, name, np.load(self.file("%s.npy" % name), mmap_mode="r"))
+        return True
+
+    @property
+    def counts(self):
+        """Token count matrix (backed by memory-mapped arrays)
+        """
+        return csr_matrix((self.data, self.indices, self.indptr), shape=(self.content_ids.shape[0], self.vocabulary.shape[0]), copy=False)
+
+    def token_index(self):
+        """Vocabulary as a dict (token -> column)
+        """
+        return {token: i for i, token in enumerate(self.vocabulary.tolist())}
+
+    def rows(self, content_ids):
+        """Row of some content ids
+
+        Args:
+            content_ids (np.ndarray): content ids
+
+        Returns:
+            np.ndarray: row of each content id, -1 when it is not in the store
+        """
+        content_ids = np.asarray(content_ids)
+        if self.content_ids.shape[0] == 0:
+            return np.full(content_ids.shape[0], -1, dtype=np.int64)
+
+        sorted_ids = self.content_ids[self.id_order]
+        positions = np.minimum(np.searchsorted(
+            sorted_ids, content_ids), sorted_ids.shape[0] - 1)
+        return np.where(sorted_ids[positions] == content_ids, self.id_order[positions], -1)
+
+    def save(self, counts, vocabulary, content_ids, fingerprint, generation=None):
+        """(Re)write the whole store
+
+        Files are written aside and swapped in, processes still reading the previous files keep a valid mapping.
+
+        Args:
+            counts (csr_matrix): token counts
+            vocabulary (dict): token -> column
+            content_ids (np.ndarray): content id of each row
+            fingerprint (dict): catalog state the store was built from
+            generation (str, optional): keep a generation (store extended with new rows), a new one is created if None. Defaults to None.
+        """
+        tmp_path = "%s.%s" % (self.path, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+
+        tokens = np.empty(len(vocabulary), dtype=object)
+        for token, i in vocabulary.items():
+            tokens[i] = token
+
+        content_ids = np.asarray(content_ids, dtype=np.uint32)
+        values = {
+            "data": counts.data.astype(np.float32),
+            "indices": counts.indices.astype(np.int32),
+            "indptr": counts.indptr.astype(np.int64),
+            "vocabulary": tokens.astype(str),
+            "content_ids": content_ids,
+            "id_order": np.argsort(content_ids, kind="stable"),
+        }
+        for name in self.arrays:
+            np.save(os.path.join(tmp_path, "%s.npy" % name), values[name])
+
+        self.generation = generation or uuid.uuid4().hex
+        self.fingerprint = fingerprint
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"fingerprint": fingerprint,
+                       "generation": self.generation}, f)
+
+        swap_directory(tmp_path, self.path)
+        self.load()
+
+    def append(self, counts, vocabulary, content_ids, fingerprint):
+        """Add new rows to the store (same generation)
+
+        Args:
+            counts (csr_matrix): token counts of new rows, with columns of `vocabulary`
+            vocabulary (dict): store vocabulary extended with the tokens of new rows
+            content_ids (np.ndarray): content id of each new row
+            fingerprint (dict): catalog state the store was built from
+        """
+        old = csr_matrix((self.data, self.indices, self.indptr), shape=(
+            self.content_ids.shape[0], len(vocabulary)))
+        counts = csr_matrix((counts.data, counts.indices, counts.indptr), shape=(
+            counts.shape[0], len(vocabulary)))
+
+        self.save(vstack([old, counts]).tocsr(), vocabulary, np.concatenate(
+            [self.content_ids, content_ids]), fingerprint, generation=self.generation)
+
+
+def stack_features(stores):
+    """Stack the token counts of several stores over a common vocabulary
+
+    Args:
+        stores (list): FeatureStore
+
+    Returns:
+        tuple: (count matrix, content ids of each row, store position of each row)
+    """
+    vocabulary = stores[0].token_index()
+    # Column of each store token in the common vocabulary
+    columns = [np.array([vocabulary.setdefault(token, len(vocabulary)) for token in store.vocabulary.tolist()], dtype=np.int32)
+               for store in stores]
+
+    counts = [csr_matrix((store.data, column[store.indices], store.indptr), shape=(store.content_ids.shape[0], len(vocabulary)))
+              for store, column in zip(stores, columns)]
+
+    return vstack(counts).tocsr(), np.concatenate([store.content_ids for store in stores]), \
+        np.repeat(np.arange(len(stores)), [store.content_ids.shape[0] for store in stores])
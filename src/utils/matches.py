@@ -0,0 +1,100 @@
+from settings import SIMILARITY_BACKEND, SIMILARITY_BACKEND_BY_TYPE, SIMILARITY_ANN_BANDS, SIMILARITY_ANN_BAND_SIZE
+from .spark import spark_context, parallelize_matrix, broadcast_matrix, broadcast_value, find_matches_in_submatrix, SparkRecords
+from .blocked import BlockedSimilarities, peak_rss
+from .ann import MinHashSimilarities
+
+from pyspark import cloudpickle
+from scipy.sparse import csr_matrix
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
+
+
+def batched(iterable, size):
+    """Split an iterable into lists of `size` elements (the last one can be shorter)
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while len(batch) > 0:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def find_matches(matrix, content_ids, content_types, real_indice_name, content_type, threshold=.5, max_sim=10, backend=None, logger=None, state=None):
+    """Find the most similar items of each item of type `content_type[0]` among the items of type `content_type[1]`
+
+    Args:
+        matrix (csr_matrix): L2-normalized TF-IDF matrix
+        content_ids (np.ndarray): uint32 content id of each TF-IDF row
+        content_types (np.ndarray): uint8 content type code (see `ContentType.code`) of each TF-IDF row
+        real_indice_name (str): name of the content id column
+        content_type (tuple): (source, target) `ContentType`
+        threshold (float, optional): minimum similarity. Defaults to .5.
+        max_sim (int, optional): maximum number of similar items for each item. Defaults to 10.
+        backend (str, optional): "blocked", "ann" or "spark". Defaults to the backend configured for the source content type.
+        logger (Logger, optional): logger used to report throughput. Defaults to None.
+        state (SimilarityState, optional): where raw top-k similars are saved for later incremental updates ("blocked" and "ann" backends only). Defaults to None.
+
+    Returns:
+        iterable: similarity records (dict)
+    """
+    if backend is None:
+        backend = SIMILARITY_BACKEND_BY_TYPE.get(
+            str(content_type[0]), SIMILARITY_BACKEND)
+
+    if backend == "blocked":
+        return _blocked_matches(BlockedSimilarities, matrix, content_ids, content_types, real_indice_name, content_type, threshold, max_sim, logger, state)
+    if backend == "ann":
+        return _blocked_matches(MinHashSimilarities, matrix, content_ids, content_types, real_indice_name, content_type, threshold, max_sim, logger, state,
+                                n_bands=SIMILARITY_ANN_BANDS, band_size=SIMILARITY_ANN_BAND_SIZE)
+    if backend == "spark":
+        return _spark_matches(matrix, content_ids, content_types, real_indice_name, content_type, threshold, max_sim, logger)
+    raise Exception("Unknown similarity backend '%s'" % backend)
+
+
+def _spark_matches(matrix, content_ids, content_types, real_indice_name, content_type, threshold, max_sim, logger):
+    mat_para = parallelize_matrix(matrix)
+    # Targets are shipped transposed, so that each chunk is a single sparse product
+    targets_t = broadcast_matrix(matrix.T.tocsr())
+    ids = spark_context().broadcast((content_ids, content_types))
+
+    # Only the broadcasts are captured by the tasks, they are dereferenced by the executors
+    def find_matches_in_chunk(submatrix):
+        return find_matches_in_submatrix(
+            sources=csr_matrix(submatrix[1], shape=submatrix[2]),
+            targets_t=broadcast_value(targets_t),
+            inputs_start_index=submatrix[0],
+            content_ids=ids.value[0],
+            content_types=ids.value[1],
+            real_indice_name=real_indice_name,
+            content_type=content_type,
+            threshold=threshold,
+            max_sim=max_sim)
+
+    if logger is not None:
+        logger.info("%s + %s spark stage: %s chunks, task closure %.1f KB, broadcasts %.1f MB" % (
+            content_type[0], content_type[1], mat_para.getNumPartitions(), len(cloudpickle.dumps(find_matches_in_chunk)) / 2**10,
+            (matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + content_ids.nbytes + content_types.nbytes) / 2**20))
+
+    # Records are never collected at once: streamed to the driver, or written by the executors (see `SparkRecords`)
+    return SparkRecords(mat_para.flatMap(find_matches_in_chunk), broadcasts=[targets_t, ids],
+                        logger=logger, name="%s + %s spark" % (content_type[0], content_type[1]))
+
+
+def _blocked_matches(similarities_class, matrix, content_ids, content_types, real_indice_name, content_type, threshold, max_sim, logger, state, **params):
+    st_time = datetime.utcnow()
+    source_rows = np.flatnonzero(content_types == content_type[0].code)
+
+    # Keep `max_sim+1` best matches because the source itself is among them
+    with similarities_class(matrix, source_rows, k=max_sim+1, threshold=threshold, **params) as blocked:
+        blocked.compute()
+        if state is not None:
+            state.save_similars(blocked.targets, blocked.similarities)
+
+        if logger is not None:
+            duration = (datetime.utcnow()-st_time).total_seconds()
+            logger.info("%s + %s %s of %s rows performed in %.1fs (%.0f rows/s, peak RSS %.0f MB)" % (
+                content_type[0], content_type[1], similarities_class.__name__, source_rows.shape[0], duration, source_rows.shape[0] / max(duration, 1e-6), peak_rss()))
+
+        yield from blocked.records(content_ids, content_types, real_indice_name, content_type)
@@ -0,0 +1,198 @@
+from settings import ENGINE_WORKERS, ENGINE_CHUNK_SIZE, ENGINE_SHARED_ARRAY_SIZE
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from datetime import datetime
+
+import multiprocessing
+import numpy as np
+import pickle
+import mmap
+import uuid
+import io
+import os
+
+# Functions of running `map_chunks` (and `Engine.for_each_media`) calls, by task, in the calling process and in its workers
+_tasks = {}
+# Shared memory blocks attached by a worker, by task (arrays of the task function are views on them)
+_blocks = {}
+
+
+class _SharedArrayPickler(pickle.Pickler):
+    """Pickle large numeric arrays by reference, so they are not copied in each worker
+
+    Memory-mapped files (ex: `np.load(..., mmap_mode="r")`) are referenced by path, other arrays are copied once in a shared memory block.
+    """
+
+    def __init__(self, file, min_size):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.min_size = min_size
+        # Blocks created for the pickled arrays, released by the caller once the workers are done
+        self.blocks = []
+        # Reference of each array already pickled (with the array: its id must not be reused by another one)
+        self._references = {}
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.nbytes < self.min_size or obj.dtype.hasobject or obj.dtype.fields is not None:
+            return None
+        if id(obj) not in self._references:
+            self._references[id(obj)] = (self._reference(obj), obj)
+        return self._references[id(obj)][0]
+
+    def _reference(self, array):
+        order = "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+        if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename is not None:
+            # Saved directories are swapped, not rewritten (see `swap_directory`): the worker checks it maps the same file
+            stat = os.stat(array.filename)
+            return ("file", array.filename, (stat.st_dev, stat.st_ino), array.offset, array.dtype.str, array.shape, order)
+
+        block = SharedMemory(create=True, size=array.nbytes)
+        self.blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf,
+                   order=order)[...] = array
+        return ("shared", block.name, array.dtype.str, array.shape, order)
+
+
+class _SharedArrayUnpickler(pickle.Unpickler):
+    def __init__(self, file, blocks):
+        super().__init__(file)
+        self.blocks = blocks
+
+    def persistent_load(self, reference):
+        if reference[0] == "file":
+            _, filename, inode, offset, dtype, shape, order = reference
+            stat = os.stat(filename)
+            if (stat.st_dev, stat.st_ino) != inode:
+                raise Exception(
+                    "%s was replaced since the task started" % filename)
+            return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape, order=order)
+
+        _, name, dtype, shape, order = reference
+        block = SharedMemory(name=name)
+        self.blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf, order=order)
+        # Every worker sees the same memory
+        array.flags.writeable = False
+        return array
+
+
+def _init_worker(task, payload, with_app):
+    if with_app:
+        # Workers using the database run in an application of their own
+        from src import create_app
+        create_app().app_context().push()
+    _blocks[task] = []
+    _tasks[task] = _SharedArrayUnpickler(
+        io.BytesIO(payload), _blocks[task]).load()
+
+
+class _SharedArrayPool(ProcessPoolExecutor):
+    def __init__(self, blocks, **kwargs):
+        super().__init__(**kwargs)
+        self._shared_blocks = blocks
+
+    def shutdown(self, *args, **kwargs):
+        super().shutdown(*args, **kwargs)
+        for block in self._shared_blocks:
+            block.close()
+            block.unlink()
+        self._shared_blocks = []
+
+
+def process_pool(workers, task, func, with_app=False, shared_size=ENGINE_SHARED_ARRAY_SIZE):
+    """Pool of worker processes running `func`, found in `_tasks` by the tasks of the pool
+
+    Workers are not forked from the calling process: it runs other threads (requests, pipeline stages, writer stages),
+    and a lock they hold at fork time (database pool, logging handlers, ...) would stay locked forever in the worker.
+    They are forked by a single-threaded fork server, which preloads the service modules, and get `func` pickled once, when they start
+    (for a method of an engine: the data attributes of the engine, see `Engine.__getstate__`).
+    Numeric arrays of `func` from `shared_size` bytes (including those of sparse matrices and data frames) are not copied in each worker:
+    memory-mapped files are mapped again by the workers, other arrays are put once in shared memory, released with the pool.
+    They are read-only in the workers.
+
+    Args:
+        workers (int): number of worker processes
+        task (str): task id
+        func (callable): picklable function
+        with_app (bool, optional): run the workers in an application context (`func` uses the database). Defaults to False.
+        shared_size (int, optional): minimum size (bytes) of shared arrays. Defaults to ENGINE_SHARED_ARRAY_SIZE.
+
+    Returns:
+        ProcessPoolExecutor: pool
+    """
+    payload = io.BytesIO()
+    pickler = _SharedArrayPickler(payload, shared_size)
+    try:
+        pickler.dump(func)
+    except BaseException:
+        for block in pickler.blocks:
+            block.close()
+            block.unlink()
+        raise
+
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["src"])
+    return _SharedArrayPool(pickler.blocks, max_workers=workers, mp_context=context, initializer=_init_worker,
+                            initargs=(task, payload.getvalue(), with_app))
+
+
+def run_task(task, *args):
+    """Run the function of a pool (see `process_pool`) in a worker
+    """
+    return _tasks[task](*args)
+
+
+def _run_chunk(task, start, end):
+    st_time = datetime.utcnow()
+    result = _tasks[task](start, end)
+    return os.getpid(), end - start, (datetime.utcnow()-st_time).total_seconds(), result
+
+
+def map_chunks(func, n, chunk_size=ENGINE_CHUNK_SIZE, workers=ENGINE_WORKERS, logger=None, name="chunks", unit="items"):
+    """Run `func(start, end)` over chunks of `range(n)` in a pool of worker processes
+
+    Call it once the caller has loaded its read-only structures (catalog matrices, indexes, ...): `func` is sent once to each worker,
+    its large arrays are shared with the workers, not copied (see `process_pool`). Only chunk bounds and results are sent per chunk.
+    `func` must not use the database, results are written by the caller.
+
+    Args:
+        func (callable): function of a chunk (start, end), picklable (ex: a method of an engine), its result must be picklable
+        n (int): number of items
+        chunk_size (int, optional): number of items per chunk. Defaults to ENGINE_CHUNK_SIZE.
+        workers (int, optional): number of worker processes, chunks are run in the calling process if 1 or less. Defaults to ENGINE_WORKERS.
+        logger (Logger, optional): logger used to report the throughput of each worker. Defaults to None.
+        name (str, optional): name of the work in the log. Defaults to "chunks".
+        unit (str, optional): name of the items in the log. Defaults to "items".
+
+    Yields:
+        object: result of each chunk, in chunk order
+    """
+    bounds = [(start, min(start + chunk_size, n))
+              for start in range(0, n, chunk_size)]
+    task = uuid.uuid4().hex
+
+    stats = {}
+    if workers <= 1 or len(bounds) <= 1:
+        _tasks[task] = func
+        try:
+            results = (_run_chunk(task, start, end) for start, end in bounds)
+            yield from _collect(results, stats)
+        finally:
+            del _tasks[task]
+    else:
+        with process_pool(min(workers, len(bounds)), task, func) as executor:
+            results = executor.map(
+                _run_chunk, *zip(*[(task, start, end) for start, end in bounds]))
+            yield from _collect(results, stats)
+
+    if logger is not None:
+        for pid, (count, duration) in sorted(stats.items()):
+            logger.info("%s: worker %s performed %s %s in %.1fs (%.0f %s/s)" % (
+                name, pid, count, unit, duration, count / max(duration, 1e-6), unit))
+
+
+def _collect(results, stats):
+    for pid, count, duration, result in results:
+        total = stats.get(pid, (0, 0))
+        stats[pid] = (total[0] + count, total[1] + duration)
+        yield result
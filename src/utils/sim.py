@@ -1,3 +1,11 @@
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+from scipy.sparse import csr_matrix
+from array import array
+
+import numpy as np
+
+
 def clean_data(x):
     """Function to convert all strings to lower case and strip names of spaces
 
@@ -19,3 +27,65 @@ def clean_data(x):
 
 def create_soup(x, features):
     return ' '.join([x[col] for col in features])
+
+
+def tfidf_matrix(soups):
+    """Build the TF-IDF matrix of content soups
+
+    Args:
+        soups (Series): soup of each content
+
+    Returns:
+        csr_matrix: float32 TF-IDF matrix (L2-normalized rows)
+    """
+    return tfidf_from_counts(count_tokens(soups)[0], copy=False)[0]
+
+
+def count_tokens(soups, vocabulary=None):
+    """Tokenize soups (same analyzer as `CountVectorizer(stop_words="english")`) and count tokens
+
+    Args:
+        soups (iterable): soup of each content (tokenized once, in a single pass)
+        vocabulary (dict, optional): known tokens (token -> column), new tokens are appended to it. Defaults to None.
+
+    Returns:
+        tuple: (float32 count matrix, vocabulary)
+    """
+    vocabulary = {} if vocabulary is None else vocabulary
+    analyzer = CountVectorizer(stop_words="english").build_analyzer()
+
+    # Compact typed buffers, soups are only read once and can come from a generator
+    indices, indptr = array("i"), array("q", [0])
+    for soup in soups:
+        indices.extend(vocabulary.setdefault(token, len(vocabulary))
+                       for token in analyzer(soup))
+        indptr.append(len(indices))
+
+    indices = np.frombuffer(indices, dtype=np.int32)
+    counts = csr_matrix((np.ones(indices.shape[0], dtype=np.float32), indices, np.frombuffer(indptr, dtype=np.int64)),
+                        shape=(len(indptr) - 1, len(vocabulary)))
+    counts.sum_duplicates()
+    return counts, vocabulary
+
+
+def tfidf_from_counts(counts, idf=None, copy=True):
+    """Turn token counts to TF-IDF (same weighting as `TfidfVectorizer` defaults)
+
+    Args:
+        counts (csr_matrix): token counts
+        idf (np.ndarray, optional): already fitted idf, fitted on `counts` if None. Defaults to None.
+        copy (bool, optional): if False, `counts` is turned to TF-IDF in place. Defaults to True.
+
+    Returns:
+        tuple: (float32 TF-IDF matrix with L2-normalized rows, float32 idf)
+    """
+    if idf is None:
+        n_rows = counts.shape[0]
+        doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = (np.log((1 + n_rows) / (1 + doc_freq)) + 1).astype(np.float32)
+
+    if copy:
+        counts = csr_matrix((counts.data.astype(np.float32), counts.indices, counts.indptr),
+                            shape=counts.shape)
+    counts.data *= idf[counts.indices]
+    return normalize(counts, norm="l2", copy=False), idf
@@ -1,8 +1,15 @@
+from settings import SIMILARITY_SPARK_WRITE, SIMILARITY_SPARK_DB_URI
 from pyspark import SparkConf, SparkContext
 from scipy.sparse import csr_matrix
-from sklearn.metrics.pairwise import cosine_similarity
+from sqlalchemy import create_engine
+from datetime import datetime
+from threading import Lock
 
 from .singleton import Singleton
+from .topk import top_k_similarities, similarity_records
+from .db import CsvStream
+
+import numpy as np
 
 
 class Spark(SparkContext, Singleton):
@@ -11,61 +18,244 @@ class Spark(SparkContext, Singleton):
         super().__init__(*args, conf=conf, **kwargs)
 
 
+_sc = None
+_sc_lock = Lock()
+
+
+def spark_context():
+    """SparkContext of the service, started on first use (worker processes importing `src.utils` do not start a JVM)
+
+    Returns:
+        Spark: SparkContext
+    """
+    global _sc
+    with _sc_lock:
+        if _sc is None:
+            _sc = Spark()
+    return _sc
+
+
 def broadcast_matrix(mat):
-    bcast = sc.broadcast((mat.data, mat.indices, mat.indptr))
-    (data, indices, indptr) = bcast.value
-    bcast_mat = csr_matrix((data, indices, indptr), shape=mat.shape)
-    return bcast_mat
+    """Ship a sparse matrix to the executors once, as a `Broadcast` of its arrays
+
+    Tasks must only capture the returned `Broadcast` and get the matrix with `broadcast_value`:
+    capturing the matrix itself pickles it in every task.
+
+    Args:
+        mat (csr_matrix): matrix
+
+    Returns:
+        Broadcast: (data, indices, indptr, shape)
+    """
+    return spark_context().broadcast((mat.data, mat.indices, mat.indptr, mat.shape))
+
 
+# Matrix rebuilt from a broadcast in the executor process, by broadcast id
+_broadcast_matrices = {}
 
-def parallelize_matrix(scipy_mat, rows_per_chunk=100):
+
+def broadcast_value(bcast):
+    """Matrix of a `broadcast_matrix` broadcast, rebuilt once per executor process (call it inside tasks)
+
+    Args:
+        bcast (Broadcast): broadcast returned by `broadcast_matrix`
+
+    Returns:
+        csr_matrix: matrix
+    """
+    if bcast.id not in _broadcast_matrices:
+        # Python workers are reused by the next stages: only keep the matrix of the current one
+        _broadcast_matrices.clear()
+        data, indices, indptr, shape = bcast.value
+        _broadcast_matrices[bcast.id] = csr_matrix(
+            (data, indices, indptr), shape=shape)
+    return _broadcast_matrices[bcast.id]
+
+
+def parallelize_matrix(scipy_mat, rows_per_chunk=None, tasks_per_core=4, max_nnz_per_chunk=5_000_000):
+    """Split a matrix into row chunks, one partition each
+
+    Unless `rows_per_chunk` is given, chunks hold about the same number of non-zero values (not of rows):
+    at least `tasks_per_core` chunks per core, and no more than `max_nnz_per_chunk` non-zero values per chunk.
+
+    Args:
+        scipy_mat (csr_matrix): matrix
+        rows_per_chunk (int, optional): fixed number of rows per chunk. Defaults to None.
+        tasks_per_core (int, optional): minimum number of chunks per core. Defaults to 4.
+        max_nnz_per_chunk (int, optional): maximum number of non-zero values per chunk. Defaults to 5_000_000.
+
+    Returns:
+        RDD: (position of the first chunk row, (data, indices, indptr), shape) of each chunk
+    """
     (rows, cols) = scipy_mat.shape
-    i = 0
+    if rows_per_chunk is not None:
+        bounds = np.arange(0, rows + rows_per_chunk, rows_per_chunk)
+    else:
+        n_chunks = max(spark_context().defaultParallelism * tasks_per_core,
+                       int(np.ceil(scipy_mat.nnz / max_nnz_per_chunk)))
+        bounds = np.searchsorted(scipy_mat.indptr, np.linspace(
+            0, scipy_mat.nnz, n_chunks + 1), side="left")
+    bounds = np.unique(np.clip(np.append(bounds, [0, rows]), 0, rows))
+
     submatrices = []
-    while i < rows:
-        current_chunk_size = min(rows_per_chunk, rows-i)
-        submat = scipy_mat[i:i+current_chunk_size]
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        submat = scipy_mat[start:end]
         submatrices.append(
-            (i, (submat.data, submat.indices, submat.indptr), (current_chunk_size, cols)))
-        i += current_chunk_size
+            (start, (submat.data, submat.indices, submat.indptr), (end - start, cols)))
+
+    return spark_context().parallelize(submatrices, numSlices=max(1, len(submatrices)))
+
+
+def find_matches_in_submatrix(sources, targets_t, inputs_start_index, content_ids, content_types, real_indice_name, content_type, threshold=.5, max_sim=10):
+    """Find the most similar items of each item of a chunk
+
+    Args:
+        sources (csr_matrix): chunk of the TF-IDF matrix
+        targets_t (csr_matrix): transposed TF-IDF matrix
+        inputs_start_index (int): position of the first chunk row in the TF-IDF matrix
+        content_ids (np.ndarray): uint32 content id of each TF-IDF row
+        content_types (np.ndarray): uint8 content type code (see `ContentType.code`) of each TF-IDF row
+        real_indice_name (str): name of the content id column
+        content_type (tuple): (source, target) `ContentType`
+        threshold (float, optional): minimum similarity. Defaults to .5.
+        max_sim (int, optional): maximum number of similar items for each item. Defaults to 10.
+
+    Returns:
+        iterable: similarity records (dict)
+    """
+    source_rows = inputs_start_index + np.arange(sources.shape[0])
+    source_rows = source_rows[content_types[source_rows]
+                              == content_type[0].code]
+    if source_rows.shape[0] == 0:
+        return []
+
+    # Keep `max_sim+1` best matches because the source itself is among them
+    rows, target_rows, similarities = top_k_similarities(
+        sources[source_rows - inputs_start_index], targets_t, k=max_sim+1, threshold=threshold)
+
+    return similarity_records(source_rows[rows], target_rows, similarities, content_ids, content_types, real_indice_name, content_type)
+
+
+class SparkRecords:
+    """Similarity records computed by Spark, never collected as a whole on the driver
+
+    Iterating them streams the records to the driver one partition at a time (`toLocalIterator`).
+    With the "executors" write path, `copy` lets each executor write its partitions instead (see `copy_partition`).
+    Broadcasts are released once records are consumed or written, whatever the outcome. Records not consumed (ex: the writer failed)
+    must be closed: use them as a context manager (or with `contextlib.closing`).
+    """
+
+    def __init__(self, rdd, write=SIMILARITY_SPARK_WRITE, broadcasts=[], logger=None, name="spark"):
+        """
+        Args:
+            rdd (RDD): similarity records (dict)
+            write (str, optional): "driver" or "executors". Defaults to SIMILARITY_SPARK_WRITE.
+            broadcasts (list, optional): broadcasts used by the RDD, released once records are consumed (or closed). Defaults to [].
+            logger (Logger, optional): logger used to report the stage time. Defaults to None.
+            name (str, optional): name of the stage in the log. Defaults to "spark".
+        """
+        assert write in ["driver", "executors"], "Unknown spark write path '%s'" % write
+        self.rdd = rdd
+        self.write = write
+        self.broadcasts = broadcasts
+        self.logger = logger
+        self.name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, err, message, traceback):
+        self.close()
+
+    def __iter__(self):
+        st_time = datetime.utcnow()
+        count = 0
+        try:
+            for record in self.rdd.toLocalIterator():
+                count += 1
+                yield record
+        finally:
+            # Also when the consumer stops early
+            self.release()
+
+        if self.logger is not None:
+            self.logger.info("%s: stage performed in %s (%s records streamed to the driver)" % (
+                self.name, datetime.utcnow()-st_time, count))
+
+    def release(self):
+        """Remove the broadcasts from the executors
+        """
+        broadcasts, self.broadcasts = self.broadcasts, []
+        for bcast in broadcasts:
+            bcast.unpersist()
+
+    def close(self):
+        self.release()
+
+    def copy(self, tablename, columns, uri=SIMILARITY_SPARK_DB_URI, logger=None):
+        """Write every partition to a table from the executors (`foreachPartition`)
+
+        Args:
+            tablename (str): target table
+            columns (list): column name of each record value
+            uri (str, optional): database seen from the executors. Defaults to SIMILARITY_SPARK_DB_URI.
+            logger (Logger, optional): Defaults to None.
+
+        Returns:
+            int: number of written records
+        """
+        st_time = datetime.utcnow()
+        try:
+            count = spark_context().accumulator(0)
+
+            def write_partition(records):
+                count.add(copy_partition(records, tablename, columns, uri))
+            self.rdd.foreachPartition(write_partition)
+        finally:
+            self.release()
 
-    return sc.parallelize(submatrices)
+        logger = logger or self.logger
+        if logger is not None:
+            duration = (datetime.utcnow()-st_time).total_seconds()
+            logger.info("%s: %s rows written by the executors in %.1fs (%.0f rows/s)" % (
+                tablename, count.value, duration, count.value / max(duration, 1e-6)))
+        return count.value
 
 
-def find_matches_in_submatrix(sources, targets, inputs_start_index, indices, real_indice_name, content_type, threshold=.5, max_sim=10):
-    cosimilarities = cosine_similarity(sources, targets)
-    for i, cosimilarity in enumerate(cosimilarities):
-        cosimilarity = cosimilarity.flatten()
+# Database engine of each executor process, its connections are reused by the next partitions
+_executor_engines = {}
 
-        # Find real id
-        source_indice = indices[indices == inputs_start_index + i].index[0]
-        source_index = int(source_indice[0])
-        source_type = source_indice[1]
 
-        if str(source_type) != str(content_type[0]):
-            continue
+def copy_partition(records, tablename, columns, uri):
+    """Stream the records of a partition into a table with `COPY FROM STDIN`, in a single transaction
 
-        # Sort by best match using argsort(), and take 10 first
-        targets = cosimilarity.argsort()[-(max_sim+1):]
+    Records are turned into CSV in batches (see `CsvStream`): executor memory does not depend on the partition size.
+    A failed task rolls its partition back, so a retried task does not write it twice.
 
-        for target_i in targets:
-            similarity = cosimilarity[target_i]
-            # Find real id
-            target_indice = indices[indices == target_i].index[0]
-            target_index = int(target_indice[0])
-            target_type = target_indice[1]
+    Args:
+        records (iterable): similarity records (dict)
+        tablename (str): target table
+        columns (list): column name of each record value
+        uri (str): database URI
 
-            if str(target_type) != str(content_type[1]):
-                continue
+    Returns:
+        int: number of written records
+    """
+    if uri not in _executor_engines:
+        _executor_engines[uri] = create_engine(uri, pool_size=1)
 
-            if similarity >= threshold and target_index != source_index:
-                yield {
-                    "%s0" % real_indice_name: source_index,
-                    "%s1" % real_indice_name: target_index,
-                    "similarity": float(similarity),
-                    "content_type0": str(content_type[0]).upper(),
-                    "content_type1": str(content_type[1]).upper(),
-                }
+    connection = _executor_engines[uri].raw_connection()
+    try:
+        stream = CsvStream(records, columns)
+        cursor = connection.cursor()
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH (FORMAT csv)' % (
+            tablename, ", ".join('"%s"' % c for c in columns)), stream)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
 
+    return stream.count
 
-sc = Spark()
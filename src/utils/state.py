@@ -0,0 +1,91 @@
+from settings import ENGINE_DATA_DIR
+
+import numpy as np
+import shutil
+import json
+import os
+
+
+class SimilarityState:
+    """Fitted TF-IDF weights and top-k similars of a content type, kept between two runs of a similarity engine
+
+    Idf values are indexed by the columns of a `FeatureStore` generation, the state is only valid with this generation.
+
+    Files are stored in `<ENGINE_DATA_DIR>/<name>/<content type>/`. `meta.json` is written last and acts as a commit marker:
+    a state without it (interrupted run) is ignored.
+    """
+
+    def __init__(self, name, content_type, directory=ENGINE_DATA_DIR):
+        """
+        Args:
+            name (str): engine name
+            content_type (ContentType): content type
+            directory (str, optional): root directory. Defaults to ENGINE_DATA_DIR.
+        """
+        self.path = os.path.join(directory, name, str(content_type))
+
+        self.generation = None
+        self.idf = None
+        self.fitted_rows = None
+        self.content_ids = None
+        self.targets = None
+        self.similarities = None
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.isfile(self.file("meta.json"))
+
+    def has_similars(self):
+        return os.path.isfile(self.file("targets.npy"))
+
+    def load(self):
+        """Load a previously saved state
+
+        Returns:
+            bool: False if there is no (complete) state
+        """
+        if not self.exists():
+            return False
+
+        with open(self.file("meta.json")) as f:
+            meta = json.load(f)
+        self.generation = meta["generation"]
+        self.fitted_rows = meta["fitted_rows"]
+        self.idf = np.load(self.file("idf.npy"))
+        self.content_ids = np.load(self.file("content_ids.npy"))
+        self.targets = np.load(self.file("targets.npy"))
+        self.similarities = np.load(self.file("similarities.npy"))
+        return True
+
+    def reset(self):
+        """Drop the saved state, the next run will be a full rebuild
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path, exist_ok=True)
+
+    def save_similars(self, targets, similarities):
+        """Save top-k similars (row positions, see `padded_top_k`)
+        """
+        os.makedirs(self.path, exist_ok=True)
+        np.save(self.file("targets.npy"), targets)
+        np.save(self.file("similarities.npy"), similarities)
+
+    def save(self, generation, idf, content_ids, fitted_rows=None):
+        """Save the fitted model and commit the state (similars must have been saved before)
+
+        Args:
+            generation (str): generation of the feature store the model was fitted on
+            idf (np.ndarray): fitted idf (one value per fitted feature store column)
+            content_ids (np.ndarray): content id of each row of similars
+            fitted_rows (int, optional): number of rows the model was fitted on. Defaults to all rows.
+        """
+        np.save(self.file("idf.npy"), idf)
+        np.save(self.file("content_ids.npy"), content_ids)
+
+        with open(self.file("meta.json"), "w") as f:
+            json.dump({
+                "generation": generation,
+                "fitted_rows": int(content_ids.shape[0] if fitted_rows is None else fitted_rows),
+            }, f)
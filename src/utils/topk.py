@@ -0,0 +1,148 @@
+import numpy as np
+
+
+def top_k_similarities(sources, targets_t, k=10, threshold=.5):
+    """Find the `k` most similar targets of each source row
+
+    Rows must be L2-normalized (default output of `TfidfVectorizer`), so the cosine similarity is a plain dot product.
+    The product stays sparse: entries under `threshold` are dropped before any selection, and only rows with more than `k` remaining entries are reduced with `argpartition`.
+
+    Args:
+        sources (csr_matrix): source rows (items x features)
+        targets_t (csr_matrix): transposed target rows (features x items), compute it once with `targets.T.tocsr()`
+        k (int, optional): maximum number of targets kept for each source. Defaults to 10.
+        threshold (float, optional): minimum similarity to keep a pair. Defaults to .5.
+
+    Returns:
+        tuple: (source positions, target positions, similarities) as numpy arrays, ordered by source then by descending similarity
+    """
+    sims = sources.dot(targets_t)
+
+    kept = np.flatnonzero(sims.data >= threshold)
+    rows = np.searchsorted(sims.indptr, kept, side="right") - 1
+
+    return select_top_k(rows, sims.indices[kept], sims.data[kept], sims.shape[0], k)
+
+
+def select_top_k(rows, cols, data, n_rows, k):
+    """Keep the `k` best pairs of each row
+
+    Args:
+        rows (np.ndarray): source positions (ordered)
+        cols (np.ndarray): target positions
+        data (np.ndarray): similarities
+        n_rows (int): number of sources
+        k (int): maximum number of pairs kept for each source
+
+    Returns:
+        tuple: (source positions, target positions, similarities) as numpy arrays, ordered by source then by descending similarity
+    """
+    # Only rows with too much candidates need a selection
+    indptr = np.searchsorted(rows, np.arange(n_rows + 1))
+    selected = np.ones(data.shape[0], dtype=bool)
+    for row in np.flatnonzero(np.diff(indptr) > k):
+        start, end = indptr[row], indptr[row+1]
+        dropped = np.argpartition(-data[start:end], k)[k:]
+        selected[start + dropped] = False
+
+    rows, cols, data = rows[selected], cols[selected], data[selected]
+    order = np.lexsort((-data, rows))
+
+    return rows[order], cols[order], data[order]
+
+
+def padded_top_k(rows, cols, similarities, n_rows, k):
+    """Convert the output of `top_k_similarities` to fixed size arrays
+
+    Args:
+        rows (np.ndarray): source positions (ordered)
+        cols (np.ndarray): target positions
+        similarities (np.ndarray): similarities
+        n_rows (int): number of sources
+        k (int): number of slots for each source
+
+    Returns:
+        tuple: (targets, similarities) arrays of shape (n_rows, k), empty slots are set to -1
+    """
+    targets = np.full((n_rows, k), -1, dtype=np.int64)
+    sims = np.full((n_rows, k), -1, dtype=np.float32)
+
+    # Rank of each pair within its source row
+    starts = np.searchsorted(rows, rows)
+    ranks = np.arange(rows.shape[0]) - starts
+
+    targets[rows, ranks] = cols
+    sims[rows, ranks] = similarities
+
+    return targets, sims
+
+
+def dense_top_k(scores, k):
+    """Keep the `k` best columns of each row of a dense score matrix
+
+    Args:
+        scores (np.ndarray): scores (rows x columns)
+        k (int): maximum number of columns kept for each row
+
+    Returns:
+        tuple: (columns, scores) arrays of shape (rows, min(k, columns)), ordered by descending score
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        best = np.argpartition(-scores, k-1, axis=1)[:, :k]
+    else:
+        best = np.broadcast_to(np.arange(k), scores.shape)
+    values = np.take_along_axis(scores, best, axis=1)
+
+    order = np.argsort(-values, axis=1, kind="stable")
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(values, order, axis=1)
+
+
+def merge_top_k(targets, sims, other_targets, other_sims):
+    """Merge two top-k results (see `padded_top_k`) computed against different target blocks
+
+    Returns:
+        tuple: (targets, similarities) arrays with the same shape as `targets`, ordered by descending similarity
+    """
+    k = targets.shape[1]
+    targets = np.concatenate([targets, other_targets], axis=1)
+    sims = np.concatenate([sims, other_sims], axis=1)
+
+    best = np.argpartition(-sims, k-1, axis=1)[:, :k]
+    targets = np.take_along_axis(targets, best, axis=1)
+    sims = np.take_along_axis(sims, best, axis=1)
+
+    order = np.argsort(-sims, axis=1, kind="stable")
+    return np.take_along_axis(targets, order, axis=1), np.take_along_axis(sims, order, axis=1)
+
+
+def similarity_records(source_rows, target_rows, similarities, content_ids, content_types, real_indice_name, content_type):
+    """Turn similar pairs (as TF-IDF row positions) to `similars_content` records
+
+    Pairs with a target of the wrong type, or between an item and itself, are skipped.
+
+    Args:
+        source_rows (np.ndarray): source row positions
+        target_rows (np.ndarray): target row positions
+        similarities (np.ndarray): similarities
+        content_ids (np.ndarray): uint32 content id of each TF-IDF row
+        content_types (np.ndarray): uint8 content type code (see `ContentType.code`) of each TF-IDF row
+        real_indice_name (str): name of the content id column
+        content_type (tuple): (source, target) `ContentType`
+
+    Yields:
+        dict: similarity record
+    """
+    source_ids = content_ids[source_rows]
+    target_ids = content_ids[target_rows]
+    keep = (content_types[target_rows] == content_type[1].code) & (
+        source_ids != target_ids)
+
+    for source_id, target_id, similarity in zip(source_ids[keep].tolist(), target_ids[keep].tolist(), similarities[keep].tolist()):
+        yield {
+            "%s0" % real_indice_name: source_id,
+            "%s1" % real_indice_name: target_id,
+            "similarity": similarity,
+            "content_type0": str(content_type[0]).upper(),
+            "content_type1": str(content_type[1]).upper(),
+        }
@@ -0,0 +1,12 @@
+from flask import Flask
+
+import pytest
+
+
+@pytest.fixture
+def app():
+    """Bare application: engines need an application context, not the database
+    """
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
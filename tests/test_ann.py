@@ -0,0 +1,52 @@
+from src.utils.ann import MinHashSimilarities, evaluate_recall
+from settings import SIMILARITY_ANN_BANDS, SIMILARITY_ANN_BAND_SIZE
+
+from sklearn.feature_extraction.text import TfidfTransformer
+from scipy.sparse import csr_matrix
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    """Soups of a catalog: items of a franchise share most of its rare tokens, plus a few common ones
+    """
+    rng = np.random.default_rng(0)
+    n_items, n_groups, n_common = 3000, 300, 30
+    rows, cols = [], []
+    for item in range(n_items):
+        group = item % n_groups
+        tokens = n_common + group * 12 + rng.choice(12, size=8, replace=False)
+        common = rng.choice(n_common, size=3, replace=False)
+        cols.extend(np.concatenate([tokens, common]).tolist())
+        rows.extend([item] * 11)
+
+    counts = csr_matrix((np.ones(len(rows)), (rows, cols)),
+                        shape=(n_items, n_common + n_groups * 12))
+    return TfidfTransformer().fit_transform(counts).tocsr()
+
+
+def test_recall(catalog, tmp_path):
+    result = evaluate_recall(catalog, sample=300, k=10, threshold=.5, n_bands=SIMILARITY_ANN_BANDS,
+                             band_size=SIMILARITY_ANN_BAND_SIZE, directory=str(tmp_path))
+
+    assert result["exact_pairs"] > 1000
+    assert result["recall"] >= .95
+
+
+def test_similarities_are_exact(catalog, tmp_path):
+    source_rows = np.arange(0, catalog.shape[0], 10)
+    with MinHashSimilarities(catalog, source_rows, k=11, threshold=.5, directory=str(tmp_path)) as ann:
+        ann.compute()
+        targets, similarities = np.asarray(ann.targets), np.asarray(ann.similarities)
+
+    found = targets >= 0
+    sources = np.broadcast_to(source_rows[:, None], targets.shape)[found]
+    exact = np.asarray(catalog[sources].multiply(
+        catalog[targets[found]]).sum(axis=1)).ravel()
+
+    np.testing.assert_allclose(similarities[found], exact, rtol=1e-5)
+    assert (similarities[found] >= .5).all()
+    # Candidates are re-ranked: descending similarities
+    assert (np.diff(np.where(found, similarities, -1), axis=1) <= 1e-6).all()
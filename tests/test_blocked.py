@@ -0,0 +1,38 @@
+from src.content import ContentType
+from src.utils.blocked import BlockedSimilarities
+from .test_topk import tfidf, exact_top_k
+
+import numpy as np
+import os
+
+
+def test_blocks_match_dense_cosine(tmp_path):
+    matrix = tfidf(n_rows=400)
+    source_rows = np.arange(0, 400, 3)
+    k, threshold = 8, .3
+
+    # A tiny budget: many source and target blocks
+    with BlockedSimilarities(matrix, source_rows, k, threshold=threshold, ram_budget=.01, directory=str(tmp_path)) as blocked:
+        rows, cols = blocked.block_sizes()
+        assert rows < source_rows.shape[0] and cols < matrix.shape[0]
+
+        blocked.compute()
+        expected = exact_top_k(matrix, k, threshold)
+        for position, row in enumerate(source_rows):
+            expected_cols, expected_sims = expected[row]
+            n = expected_cols.shape[0]
+            np.testing.assert_allclose(
+                blocked.similarities[position, :n], expected_sims, rtol=1e-6)
+            assert set(blocked.targets[position, :n]) == set(expected_cols)
+            assert (blocked.targets[position, n:] == -1).all()
+
+        content_ids = np.arange(1000, 1400, dtype=np.uint32)
+        content_types = np.full(400, ContentType.MOVIE.code, dtype=np.uint8)
+        records = list(blocked.records(content_ids, content_types, "content_id",
+                                       (ContentType.MOVIE, ContentType.MOVIE), rows_per_block=7))
+
+    # Every pair but the source itself
+    assert len(records) == sum(
+        (expected[row][0] != row).sum() for row in source_rows)
+    assert all(record["content_id0"] != record["content_id1"] for record in records)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,85 @@
+from src.utils.cache import LRUCache
+from src.engines import UserServing, Popularity
+import src.utils.cache
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.]
+    monkeypatch.setattr(src.utils.cache, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire(clock):
+    cache = LRUCache(maxsize=10, ttl=30)
+    cache.set("a", 1, owner=1)
+
+    clock[0] = 29
+    assert cache.get("a") == 1
+    clock[0] = 31
+    assert cache.get("a") is None
+    assert cache.metrics()["size"] == 0
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_is_dropped(clock):
+    cache = LRUCache(maxsize=2, ttl=30)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_invalidate_owners(clock):
+    cache = LRUCache(maxsize=10, ttl=30)
+    cache.set("a", 1, owner=1)
+    cache.set("b", 2, owner=1)
+    cache.set("c", 3, owner=2)
+
+    cache.invalidate([1])
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (None, None, 3)
+
+    cache.invalidate()
+    assert cache.get("c") is None
+    assert cache.invalidations == 3
+
+
+def test_value_computed_across_an_invalidation_is_dropped(clock):
+    cache = LRUCache(maxsize=10, ttl=30)
+
+    # An engine rewrites the recommendations of the owner while the value is computed
+    generation = cache.generation(1)
+    cache.invalidate([1])
+    assert cache.set("a", 1, owner=1, generation=generation) is False
+    assert cache.get("a") is None
+
+    # Other owners are not concerned, until every entry is invalidated
+    other = cache.generation(2)
+    assert cache.set("b", 2, owner=2, generation=other) is True
+    other = cache.generation(2)
+    cache.invalidate()
+    assert cache.set("b", 2, owner=2, generation=other) is False
+
+    generation = cache.generation(1)
+    assert cache.set("a", 1, owner=1, generation=generation) is True
+    assert cache.get("a") == 1
+
+
+def test_merge_weights_engines(app):
+    candidates = pd.DataFrame({
+        "content_id": [1, 2, 1, 3, 4],
+        "score": [.5, .9, 1., .2, 1.],
+        "engine": ["FromProfile", "FromSimilarContent", "Popularity", "CollaborativeFiltering", "Unknown"],
+    })
+    merged = UserServing.merge(candidates, k=2)
+
+    # Scores weighted by engine priority (FromProfile: 4, FromSimilarContent: 2, CollaborativeFiltering: 5), unknown engines left out
+    assert merged[0] == {"content_id": 1, "score": pytest.approx(.5 * 4 + Popularity.__engine_priority__),
+                         "engines": ["FromProfile", "Popularity"]}
+    assert len(merged) == 2 and merged[1]["content_id"] == 2
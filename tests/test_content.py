@@ -0,0 +1,19 @@
+from src.content import Application
+
+import pandas as pd
+import logging
+
+
+def test_tokenize_keeps_each_content_once():
+    m = Application(logger=logging.getLogger("test"))
+
+    # A row per genre, the rows of a content may be in two chunks
+    def prepare(content_ids, chunksize):
+        yield pd.DataFrame({"content_id": [1, 2, 2], "soup": ["chess board", "war", "war strategy"]})
+        yield pd.DataFrame({"content_id": [3, 2], "soup": ["puzzle", "strategy"]})
+
+    counts, vocabulary, content_ids = m._tokenize(prepare)
+
+    assert content_ids.tolist() == [1, 2, 3]
+    assert counts.shape[0] == 3
+    assert counts[1, vocabulary["war"]] == 1 and counts[1].sum() == 1
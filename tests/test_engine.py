@@ -0,0 +1,32 @@
+from src.content import Movie, Serie, Track
+from src.engines.engine import Engine
+
+from threading import Lock
+
+import pytest
+
+
+class Counting(Engine):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.runs = []
+        self._lock = Lock()
+
+    def train(self):
+        pass
+
+    def count(self, media):
+        with self._lock:
+            self.runs.append(media)
+        return media.content_type
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_for_each_media_runs_each_media_once(app, workers):
+    engine = Counting()
+    results = engine.for_each_media(
+        engine.count, medias=[Movie, Serie, Movie, Track, Serie], workers=workers, mode="thread")
+
+    assert sorted(engine.runs, key=str) == sorted([Movie, Serie, Track], key=str)
+    assert results == {Movie: Movie.content_type,
+                       Serie: Serie.content_type, Track: Track.content_type}
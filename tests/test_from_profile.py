@@ -0,0 +1,81 @@
+from src.content import Movie, Interactions
+from src.content.genre import Genre
+from src.engines import FromProfile
+
+import pandas as pd
+import numpy as np
+import logging
+import pytest
+import uuid
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    # "MOVIEaction" is in the genre table twice, "MOVIEwestern" is liked but no content has it
+    genre_df = pd.DataFrame({"genre_id": [1, 2, 3, 4, 5], "name": ["action", "drama", "action", "comedy", "western"],
+                             "content_type": ["MOVIE"] * 5})
+    monkeypatch.setattr(Genre, "get_genres", classmethod(
+        lambda cls, types=[]: genre_df))
+
+    m = Movie(logger=logging.getLogger("test"))
+    content_df = pd.DataFrame({"content_id": [1, 2, 3, 4, 5], "genres": [
+                              "MOVIEaction,MOVIEdrama", "MOVIEdrama", "MOVIEcomedy", None, "MOVIEaction"]})
+    monkeypatch.setattr(m, "get_for_profile", lambda: content_df.copy())
+
+    meta_df = pd.DataFrame({"content_id": [1, 3], "rating": [4, 2], "review_see_count": [1, 0]})
+    liked = Genre.liked_weights(
+        np.array([0]), np.array([0, 0]), np.array(["MOVIEaction", "MOVIEwestern"]), m.content_type)
+    liked.insert(0, "user_id", [0])
+
+    return m, content_df, meta_df, liked
+
+
+def former_scores(content_df, meta_df, interests):
+    """Scores of the former `prepare_from_user_profile` and `learning_user_profile` (row by row)
+    """
+    genres_df = content_df.copy()
+    for index, row in content_df.iterrows():
+        if isinstance(row["genres"], str):
+            for genre in row["genres"].split(","):
+                genres_df.at[index, genre] = 1
+    genres_df = genres_df.fillna(0).drop(["genres"], axis=1)
+    genre_table = genres_df.set_index(genres_df["content_id"]).drop(["content_id"], axis=1)
+
+    user_input = meta_df.groupby(["content_id"]).sum()
+    user_genre_table = genre_table.loc[user_input.index]
+    user_profile = user_genre_table.transpose().dot(
+        user_input["rating"] + user_input["review_see_count"]).astype("float32")
+
+    user_profile = user_profile.apply(lambda x: 1.0 if x == 0 else x)
+    user_profile = user_profile.mul(interests.drop(["user_id"]))
+    user_profile = user_profile.apply(lambda x: 0.0 if x == 1 else x).fillna(0)
+
+    return (genre_table * user_profile).sum(axis=1) / user_profile.sum()
+
+
+def test_genre_matrix_only_has_used_genres(catalog):
+    m, _, _, _ = catalog
+    genres = m.genre_matrix()
+
+    assert sorted(genres.genres) == ["MOVIEaction", "MOVIEcomedy", "MOVIEdrama"]
+    assert genres.matrix.shape == (5, 3)
+    assert genres.matrix.sum() == 5
+
+
+def test_prepare_matches_former_profile(app, catalog):
+    m, content_df, meta_df, liked = catalog
+
+    fp = FromProfile(profile_uuid=str(uuid.uuid4()), event_id=1)
+    fp.obj_df = liked
+    fp.prepare(m, interactions=Interactions.from_frame(meta_df, m.id))
+
+    expected = former_scores(content_df, meta_df, liked.iloc[0])
+    scores = fp.genres.matrix.dot(fp.user_profiles[0]) / fp.profile_sums[0]
+    np.testing.assert_allclose(
+        scores, expected.loc[fp.genres.content_ids].to_numpy(), rtol=1e-6)
+
+    # Recommendations close to the best one
+    [(_, content_ids, top)] = fp.recommend(0, fp.users.shape[0])
+    kept = expected[expected >= expected.max() - 0.2].sort_values(ascending=False)
+    assert content_ids.tolist() == kept.index.tolist()
+    np.testing.assert_allclose(top, kept.to_numpy(), rtol=1e-6)
@@ -0,0 +1,59 @@
+from src.utils.parallel import map_chunks, process_pool, run_task
+
+from multiprocessing.shared_memory import SharedMemory
+from scipy.sparse import csr_matrix
+
+import numpy as np
+import pytest
+import uuid
+
+
+class Sums:
+    """Picklable task holding large arrays
+    """
+
+    def __init__(self, values, matrix, small):
+        self.values = values
+        self.matrix = matrix
+        self.small = small
+
+    def __call__(self, start, end):
+        return float(self.values[start:end].sum()), float(self.matrix[start:end].sum()), self.small[0]
+
+    def arrays(self, _):
+        return type(self.values).__name__, self.values.flags.writeable, self.matrix.data.flags.writeable, self.small.flags.writeable
+
+
+@pytest.fixture
+def sums(tmp_path):
+    path = str(tmp_path / "values.npy")
+    np.save(path, np.arange(300_000, dtype=np.float64))
+    matrix = csr_matrix(np.ones((300_000, 2), dtype=np.float64))
+    return Sums(np.load(path, mmap_mode="r"), matrix, np.array([7]))
+
+
+def test_map_chunks_matches_sequential(sums):
+    sequential = list(map_chunks(sums, 300_000, chunk_size=50_000, workers=1))
+    parallel = list(map_chunks(sums, 300_000, chunk_size=50_000, workers=3))
+
+    assert parallel == sequential
+    assert sum(values for values, _, _ in parallel) == sums.values.sum()
+
+
+def test_process_pool_shares_large_arrays(sums):
+    task = uuid.uuid4().hex
+    with process_pool(2, task, sums.arrays, shared_size=1 << 20) as executor:
+        blocks = list(executor._shared_blocks)
+        kind, values_writeable, matrix_writeable, small_writeable = executor.submit(
+            run_task, task, None).result()
+
+    # Memory-mapped file mapped again, sparse arrays in shared memory, small arrays copied
+    assert kind == "memmap" and not values_writeable
+    assert not matrix_writeable
+    assert small_writeable
+
+    # Blocks are released with the pool
+    assert len(blocks) == 3
+    for block in blocks:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name=block.name)
@@ -0,0 +1,74 @@
+from src.engines.engine import Engine
+from src.recommend import JobRegistry, pipeline_stage
+import src.recommend
+
+from threading import Event, Thread, Lock
+
+import pytest
+
+
+class Blocking(Engine):
+    """Engine whose runs are released by the test
+    """
+    __reads__ = ["content"]
+    __writes__ = ["recommended_content"]
+
+    release = Event()
+    runs = []
+    _lock = Lock()
+
+    def train(self):
+        with Blocking._lock:
+            Blocking.runs.append(self)
+        Blocking.release.wait(5)
+
+
+@pytest.fixture
+def jobs(app, monkeypatch):
+    registry = JobRegistry()
+    monkeypatch.setattr(src.recommend, "jobs", registry)
+    Blocking.release.clear()
+    Blocking.runs = []
+    yield registry
+    Blocking.release.set()
+
+
+def test_submit_coalesces_running_job(jobs):
+    job, coalesced = jobs.submit(Blocking)
+    same, duplicate = jobs.submit(Blocking)
+
+    assert not coalesced and duplicate
+    assert same is job and job.duplicates == 1
+
+    Blocking.release.set()
+    job.wait()
+    assert job.status == "succeeded"
+    assert len(Blocking.runs) == 1
+
+
+def test_pipeline_stage_waits_for_running_job(app, jobs):
+    # A run started before the stage was released, it may have missed what the stage dependencies wrote
+    in_flight, _ = jobs.submit(Blocking)
+
+    stage = pipeline_stage(Blocking)
+    result = {}
+
+    def run_stage():
+        # As `DagScheduler` does, in a thread of its own
+        with app.app_context():
+            result["job"] = stage.start()
+    thread = Thread(target=run_stage)
+    thread.start()
+
+    thread.join(0.2)
+    assert thread.is_alive()
+    assert in_flight.duplicates == 0
+
+    Blocking.release.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+    job = result["job"]
+    assert job is not in_flight
+    assert in_flight.status == job.status == "succeeded"
+    assert Blocking.runs == [in_flight.engine, job.engine]
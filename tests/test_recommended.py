@@ -0,0 +1,77 @@
+from src.content import AlreadyRecommended, ContentType
+import src.content.recommended
+
+import pandas as pd
+import pytest
+
+
+class FakeEngine:
+    """Database engine recording the queries of `pd.read_sql_query`
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def connect(self):
+        return self
+
+    def execution_options(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(src.content.recommended.db, "engine", engine, raising=False)
+
+    def read_sql_query(query, con, chunksize):
+        engine.queries.append(query)
+        yield pd.DataFrame({"user_id": [2, 1, 2], "content_id": [5, 3, 4], "engine": ["FromProfile", "FromSimilarContent", "FromProfile"]})
+    monkeypatch.setattr(src.content.recommended.pd,
+                        "read_sql_query", read_sql_query)
+    return engine.queries
+
+
+def test_load_filters_content_type_and_owners(queries):
+    recommended = AlreadyRecommended.load(
+        "recommended_content", "user_id", "content_id", ContentType.MOVIE, owner_ids=[2, 1])
+
+    assert queries == [
+        'SELECT user_id, content_id, engine FROM "recommended_content" WHERE content_type = \'MOVIE\' AND user_id IN (2, 1)']
+    assert recommended.owner_ids.tolist() == [1, 2]
+    assert recommended.user(2, "FromSimilarContent").tolist() == [4, 5]
+    assert recommended.user(2, "FromProfile").tolist() == []
+
+
+def test_load_without_owners(queries):
+    empty = AlreadyRecommended.load(
+        "recommended_content", "user_id", "content_id", ContentType.MOVIE, owner_ids=[])
+    assert queries == [] and empty.user(1, "FromProfile").tolist() == []
+
+    AlreadyRecommended.load("recommended_content", "user_id",
+                            "content_id", ContentType.MOVIE)
+    assert queries == [
+        'SELECT user_id, content_id, engine FROM "recommended_content" WHERE content_type = \'MOVIE\'']
+
+
+def test_shared_load_is_by_content_type(queries):
+    with AlreadyRecommended.shared():
+        # A run covers every owner
+        movies = AlreadyRecommended.load(
+            "recommended_content", "user_id", "content_id", ContentType.MOVIE, owner_ids=[1])
+        assert AlreadyRecommended.load(
+            "recommended_content", "user_id", "content_id", ContentType.MOVIE, owner_ids=[2]) is movies
+        AlreadyRecommended.load(
+            "recommended_content", "user_id", "content_id", ContentType.SERIE)
+        assert len(queries) == 2 and "IN" not in queries[0]
+
+        AlreadyRecommended.refresh("recommended_content")
+        assert AlreadyRecommended.load(
+            "recommended_content", "user_id", "content_id", ContentType.MOVIE) is not movies
+        assert len(queries) == 3
@@ -0,0 +1,102 @@
+from src.scheduler import Stage, DagScheduler
+
+from threading import Lock
+from time import sleep
+
+import logging
+import pytest
+
+
+class Job:
+    status = "succeeded"
+
+
+class Recorder:
+    """Start functions of stages recording the order of runs and the memory of running stages
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.events = []
+        self.running = {}
+        # Peak memory of stages running together
+        self.peak_memory = 0
+        self.peak_running = 0
+
+    def stage(self, name, reads=(), writes=(), memory=100, duration=.1):
+        def start():
+            with self.lock:
+                self.events.append(("start", name))
+                self.running[name] = memory
+                if len(self.running) > 1:
+                    self.peak_memory = max(self.peak_memory, sum(self.running.values()))
+                self.peak_running = max(self.peak_running, len(self.running))
+            sleep(duration)
+            with self.lock:
+                self.events.append(("end", name))
+                del self.running[name]
+            return Job()
+        return Stage(name, start, set(reads), set(writes), memory)
+
+    def position(self, event, name):
+        return self.events.index((event, name))
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+def run(app, stages, **kwargs):
+    scheduler = DagScheduler(stages, app, logging.getLogger("test"), **kwargs)
+    return scheduler, scheduler.run()
+
+
+def test_dependencies_are_ordered(app, recorder):
+    stages = [
+        recorder.stage("popularity", reads=["content"], writes=["content.popularity_score"]),
+        recorder.stage("similarities", reads=["content"], writes=["similars_content"], duration=.2),
+        recorder.stage("similar content", reads=["similars_content", "content.popularity_score"], writes=["recommended_content"]),
+        recorder.stage("profile", reads=["content"], writes=["recommended_content"]),
+        recorder.stage("groups", reads=["content"], writes=["recommended_content_for_group"]),
+    ]
+    scheduler, path = run(app, stages, concurrency=4, memory_budget=10_000)
+
+    assert scheduler.dependencies["similar content"] == ["popularity", "similarities"]
+    # Same written table: the declaration order is kept
+    assert scheduler.dependencies["profile"] == ["similar content"]
+    assert scheduler.dependencies["groups"] == []
+
+    assert recorder.position("start", "similar content") > recorder.position("end", "similarities")
+    assert recorder.position("start", "similar content") > recorder.position("end", "popularity")
+    assert recorder.position("start", "profile") > recorder.position("end", "similar content")
+    # Independent stages run concurrently
+    assert recorder.position("start", "groups") < recorder.position("end", "popularity")
+
+    assert [stage.name for stage in path] == ["similarities", "similar content", "profile"]
+    assert all(stage.job.status == "succeeded" for stage in stages)
+
+
+def test_concurrency_and_memory_budget(app, recorder):
+    stages = [recorder.stage("engine %s" % i, writes=["table %s" % i], memory=300) for i in range(6)] + \
+        [recorder.stage("large", writes=["large"], memory=2000)]
+    run(app, stages, concurrency=4, memory_budget=1000)
+
+    assert recorder.peak_running == 3
+    assert recorder.peak_memory == 900
+    # A stage over the budget runs alone
+    start, end = recorder.position("start", "large"), recorder.position("end", "large")
+    assert all(event == ("end", "large") for event in recorder.events[start+1:end+1])
+    assert len(recorder.events) == 14
+
+
+def test_failed_start_does_not_stop_dependents(app, recorder):
+    def fail():
+        raise Exception("no database")
+
+    stages = [Stage("failing", fail, set(), {"content"}, 100),
+              recorder.stage("dependent", reads=["content"])]
+    scheduler, _ = run(app, stages)
+
+    assert stages[0].job is None and stages[0].finished is not None
+    assert stages[1].job.status == "succeeded"
@@ -0,0 +1,60 @@
+from src.utils.spark import SparkRecords
+import src.utils.spark
+
+from contextlib import closing
+
+import pytest
+
+
+class Broadcast:
+    def __init__(self):
+        self.unpersisted = 0
+
+    def unpersist(self):
+        self.unpersisted += 1
+
+
+class RDD:
+    def __init__(self, records, error=None):
+        self.records = records
+        self.error = error
+
+    def toLocalIterator(self):
+        return iter(self.records)
+
+    def foreachPartition(self, func):
+        raise self.error
+
+
+def test_broadcasts_released_once_consumed():
+    broadcasts = [Broadcast(), Broadcast()]
+    records = SparkRecords(RDD([1, 2, 3]), write="driver", broadcasts=broadcasts)
+
+    assert list(records) == [1, 2, 3]
+    assert [b.unpersisted for b in broadcasts] == [1, 1]
+
+
+def test_broadcasts_released_when_consumer_stops():
+    broadcast = Broadcast()
+    with pytest.raises(Exception):
+        with closing(SparkRecords(RDD([1, 2, 3]), write="driver", broadcasts=[broadcast])) as records:
+            for record in records:
+                raise Exception("writer failed")
+
+    assert broadcast.unpersisted == 1
+
+
+class SparkContext:
+    def accumulator(self, value):
+        return None
+
+
+def test_broadcasts_released_when_executors_fail(monkeypatch):
+    monkeypatch.setattr(src.utils.spark, "spark_context", SparkContext)
+    broadcast = Broadcast()
+    with SparkRecords(RDD([], error=Exception("lost executor")), write="executors", broadcasts=[broadcast]) as records:
+        with pytest.raises(Exception, match="lost executor"):
+            records.copy("similars_content", ["content_id0"])
+        assert broadcast.unpersisted == 1
+
+    assert broadcast.unpersisted == 1
@@ -0,0 +1,78 @@
+from src.utils.topk import top_k_similarities, padded_top_k, dense_top_k, merge_top_k
+
+from sklearn.preprocessing import normalize
+from scipy.sparse import random as sparse_random
+
+import numpy as np
+import pytest
+
+
+def tfidf(n_rows=300, n_features=60, density=.08, seed=0):
+    """Random L2-normalized rows, dense enough for many pairs over the threshold
+    """
+    matrix = sparse_random(n_rows, n_features, density=density,
+                           format="csr", random_state=seed, dtype=np.float64)
+    return normalize(matrix).tocsr()
+
+
+def exact_top_k(matrix, k, threshold):
+    """Top-k of each row by sorting the dense cosine rows (former `find_matches_in_submatrix`)
+    """
+    sims = matrix.dot(matrix.T).toarray()
+    result = []
+    for row in sims:
+        order = np.argsort(-row, kind="stable")
+        order = order[row[order] >= threshold][:k]
+        result.append((order, row[order]))
+    return result
+
+
+@pytest.mark.parametrize("k, threshold", [(10, .5), (3, .2), (50, .0001)])
+def test_top_k_similarities_matches_dense_cosine(k, threshold):
+    matrix = tfidf()
+    rows, cols, sims = top_k_similarities(
+        matrix, matrix.T.tocsr(), k=k, threshold=threshold)
+    targets, similarities = padded_top_k(rows, cols, sims, matrix.shape[0], k)
+
+    for row, (expected_cols, expected_sims) in enumerate(exact_top_k(matrix, k, threshold)):
+        n = expected_cols.shape[0]
+        np.testing.assert_allclose(similarities[row, :n], expected_sims, rtol=1e-6)
+        assert set(targets[row, :n]) == set(expected_cols)
+        assert (targets[row, n:] == -1).all()
+
+    # Ordered by source, then by descending similarity
+    assert (np.diff(rows) >= 0).all()
+    assert ((np.diff(sims) <= 0) | (np.diff(rows) > 0)).all()
+
+
+def test_dense_top_k_matches_argsort():
+    scores = np.random.default_rng(0).random((20, 50))
+    cols, top = dense_top_k(scores, 7)
+
+    expected = np.argsort(-scores, axis=1)[:, :7]
+    np.testing.assert_array_equal(cols, expected)
+    np.testing.assert_array_equal(top, np.take_along_axis(scores, expected, axis=1))
+
+    # Less columns than k
+    cols, top = dense_top_k(scores[:, :5], 7)
+    assert cols.shape == (20, 5)
+    np.testing.assert_array_equal(cols, np.argsort(-scores[:, :5], axis=1))
+
+
+def test_merge_top_k_of_target_blocks():
+    matrix = tfidf(seed=1)
+    k, threshold = 5, .3
+    targets, similarities = np.full((matrix.shape[0], k), -1), np.full((matrix.shape[0], k), -1, dtype=np.float32)
+    for start in range(0, matrix.shape[0], 70):
+        rows, cols, sims = top_k_similarities(
+            matrix, matrix[start:start+70].T.tocsr(), k=k, threshold=threshold)
+        targets, similarities = merge_top_k(
+            targets, similarities, *padded_top_k(rows, cols + start, sims, matrix.shape[0], k))
+
+    rows, cols, sims = top_k_similarities(
+        matrix, matrix.T.tocsr(), k=k, threshold=threshold)
+    expected_targets, expected_sims = padded_top_k(rows, cols, sims, matrix.shape[0], k)
+
+    np.testing.assert_allclose(similarities, expected_sims, rtol=1e-6)
+    for row in range(matrix.shape[0]):
+        assert set(targets[row]) == set(expected_targets[row])